@@ -2,13 +2,17 @@
 from configtool import ConfigFile, defaultConfigFile
 import pbutil
 import tempfile, os, math, warnings, random, sys, subprocess, time
-import shutil
+import shutil, hashlib
+import threading, Queue
 import storagedirs
+import measurementcache
+import inputlibrary
+import tracing
 import tunerwarnings 
 import platform
 import numpy
 from storagedirs import timers
-from scipy import stats
+from scipy import special
 from tunerconfig import config, OperatorSelectionMethod
 from tunerwarnings import ComparisonFailed, InconsistentOutput
 from mutators import MutateFailed
@@ -56,16 +60,91 @@ class CrashException(Exception):
       import progress
       progress.pause('press any key to continue')
 
+def killTimeout(limit):
+  '''python side timeout for a run given --max-sec=limit'''
+  if limit is None:
+    return None
+  return limit+config.kill_grace_sec
+
+def welford(acc, x):
+  '''add x to a running (count, mean, sum of squared deviations)'''
+  n, m, m2 = acc
+  n += 1
+  d = x-m
+  m += d/n
+  return n, m, m2+d*(x-m)
+
+def choiceSiteBands(cfg, transform, choicesite, n):
+  '''
+  the rule used by a choice site for each input size up to n, as a tuple of
+  (first size, rule) bands; mirrors the decision tree in rulechoice.cpp
+  '''
+  bands = []
+  lo = 0
+  lvl = config.first_lvl
+  while lo <= n:
+    krn = config.fmt_rule % (transform, choicesite, lvl)
+    kco = config.fmt_cutoff % (transform, choicesite, lvl+1)
+    if krn not in cfg:
+      break
+    hi = cfg.get(kco, config.cutoff_max_val)
+    if hi > lo and (not bands or bands[-1][1] != cfg[krn]):
+      bands.append((lo, cfg[krn]))
+    lo = max(lo, hi)
+    lvl += 1
+  return tuple(bands)
+
+def effectiveFingerprint(cfg, info, n):
+  '''
+  digest of the behaviour of cfg at input size n, algchoice levels that
+  can't be reached at n (cutoffs above n, empty or repeated levels) don't
+  change it; assumes recursion never grows the input size
+  '''
+  values = dict(cfg.items())
+  for transform, choicesite in info.choiceSites():
+    bands = choiceSiteBands(cfg, transform, choicesite, n)
+    lvl = config.first_lvl
+    while config.fmt_rule % (transform, choicesite, lvl) in values:
+      del values[config.fmt_rule % (transform, choicesite, lvl)]
+      values.pop(config.fmt_cutoff % (transform, choicesite, lvl), None)
+      lvl += 1
+    values["%s_%d" % (transform, choicesite)] = bands
+  return hashlib.sha1("\n".join(map(lambda x: "%s = %r"%x, sorted(values.items())))).hexdigest()
+
 def debug_logcmd(cmd):
   #print ' '.join(cmd)
   pass
 
+class NormalDist:
+  '''normal distribution with the subset of the scipy.stats.norm interface we use'''
+  def __init__(self, mean, std):
+    self.m = mean
+    self.s = std
+
+  def cdf(self, x):
+    return special.ndtr((x-self.m)/self.s)
+
+  def sf(self, x):
+    return special.ndtr((self.m-x)/self.s)
+
+  def ppf(self, q):
+    return self.m + self.s*special.ndtri(q)
+
+  def isf(self, q):
+    return self.m - self.s*special.ndtri(q)
+
+  def stats(self):
+    return self.m, self.s*self.s
+
 class Results:
   '''stores a list of (timing|accuracy) test results and collects statistics'''
   def __init__(self, results=[]):
     self.realResults=[]         #listof(float)
     self.timeoutResults=[]      #listof(float)
-    self.interpolatedResults=[] #listof(float)
+    self.timeoutEstimates=[]    #listof(float), values assumed for timeoutResults
+    self.realStats=(0, 0.0, 0.0) #(count, mean, sum of squared deviations)
+    self.realMin=None
+    self.interpStats=(0, 0.0, 0.0) #same, over interpolatedResults()
     self.distribution = None
 
 
@@ -73,6 +152,8 @@ class Results:
     if len(self.realResults)>n:
       self.realResults = self.realResults[-n:]
       self.timeoutResults = []
+      self.realStats = reduce(welford, self.realResults, (0, 0.0, 0.0))
+      self.realMin = min(self.realResults)
       self.reinterpolate()
 
   def __repr__(self):
@@ -110,7 +191,16 @@ class Results:
 
   def add(self, p):
     self.realResults.append(p)
-    self.reinterpolate();
+    self.realStats = welford(self.realStats, p)
+    if self.realMin is None or p < self.realMin:
+      self.realMin = p
+    if self.timeoutResults:
+      self.reinterpolate()
+    else:
+      #no censored points, so only the new sample changes
+      self.interpStats = self.realStats
+      self.distribution = self.fitDistribution()
+      self.checkStats()
 
   def addTimeout(self, p):
     assert p is not None
@@ -120,39 +210,49 @@ class Results:
   def numTimeouts(self):
     return len(self.timeoutResults)
 
-  def reinterpolate(self):
-    '''recreate interpolatedResults from realResults and timeoutResults'''
-    self.interpolatedResults = list(self.realResults)
-    def mkdistrib():
-      m=numpy.mean(self.interpolatedResults) 
-      s=max(config.min_std_pct*m,numpy.std(self.interpolatedResults))
-      if s==0.0:
-        s = 1e-10
-      return stats.norm(m,s)
-    if len(self.interpolatedResults) == 0:
-      '''all tests timed out, seed with double the average timeout'''
-      self.interpolatedResults.append(sum(self.timeoutResults)/len(self.timeoutResults)*2.0)
-    if len(self.interpolatedResults) == 1:
+  def interpolatedResults(self):
+    '''realResults followed by estimated values for timeoutResults'''
+    return self.realResults + self.timeoutEstimates
+
+  def fitDistribution(self):
+    n, m, m2 = self.interpStats
+    if n == 1:
       '''only 1 test, use prior stddev'''
-      s = abs(self.interpolatedResults[0]*config.prior_stddev_pct)
-      if s==0.0:
-        s = 1e-10
-      self.distribution = stats.norm(self.interpolatedResults[0], s)
+      s = abs(m*config.prior_stddev_pct)
     else:
       '''estimate stddev with least squares'''
-      self.distribution = mkdistrib()
+      s = max(config.min_std_pct*m, math.sqrt(m2/n))
+    if s==0.0:
+      s = 1e-10
+    return NormalDist(m, s)
+
+  def reinterpolate(self):
+    '''recreate timeoutEstimates and the fitted distribution from realResults and timeoutResults'''
+    self.timeoutEstimates = []
+    self.interpStats = self.realStats
+    if self.interpStats[0] == 0:
+      '''all tests timed out, seed with double the average timeout'''
+      seed = sum(self.timeoutResults)/len(self.timeoutResults)*2.0
+      self.timeoutEstimates.append(seed)
+      self.interpStats = welford(self.interpStats, seed)
+    self.distribution = self.fitDistribution()
     for p in sorted(self.timeoutResults):
       '''now lets estimate values for the points that timed out'''
       '''new points are assigned the median value above their timeout'''
-      self.interpolatedResults.append(max(p, min(self.distribution.isf(self.distribution.sf(p)/2.0), p*4)))
-      self.distribution = mkdistrib()
+      v = max(p, min(self.distribution.isf(self.distribution.sf(p)/2.0), p*4))
+      self.timeoutEstimates.append(v)
+      self.interpStats = welford(self.interpStats, v)
+      self.distribution = self.fitDistribution()
+    self.checkStats()
+
+  def checkStats(self):
     if numpy.isnan(self.mean()) or numpy.isinf(self.mean()) \
         or numpy.isnan(self.variance()) or numpy.isinf(self.variance()):
       print "PROBLEM!!! EMAIL BELOW TO jansel"
       print self.mean(), self.variance()
       print self.realResults
       print self.timeoutResults
-      print self.interpolatedResults
+      print self.interpolatedResults()
       assert False
  
   def dataDistribution(self):
@@ -162,7 +262,7 @@ class Results:
   def meanDistribution(self):
     '''estimated probability distribution of the real mean value'''
     try:
-      return stats.norm(self.mean(), math.sqrt(self.meanVariance()))
+      return NormalDist(self.mean(), math.sqrt(self.meanVariance()))
     except OverflowError:
       return self.distribution
 
@@ -173,7 +273,9 @@ class Results:
   
   def min(self):
     assert len(self)>0
-    return min(self.interpolatedResults)
+    if self.realMin is None:
+      return min(self.timeoutEstimates)
+    return min([self.realMin] + self.timeoutEstimates)
 
   def variance(self):
     assert len(self)>0
@@ -198,7 +300,18 @@ class Results:
     '''estimate probability P(data | self and that have same mean)'''
     assert len(self)>0
     assert len(that)>0
-    return stats.ttest_ind(self.interpolatedResults, that.interpolatedResults, 0)[1]
+    #pooled two sample t-test, as in stats.ttest_ind
+    na, ma, m2a = self.interpStats
+    nb, mb, m2b = that.interpStats
+    df = na+nb-2
+    if df <= 0:
+      return numpy.nan
+    denom = math.sqrt((m2a+m2b)/df*(1.0/na+1.0/nb))
+    if denom == 0.0:
+      if ma == mb:
+        return numpy.nan
+      return 0.0
+    return 2.0*special.stdtr(df, -abs(ma-mb)/denom)
 
   def diffChance(self, that):
     '''estimate probability self and that have different means'''
@@ -207,7 +320,11 @@ class Results:
   def sameChance(self, that):
     '''estimate probability self and that have means within config.same_threshold_pct'''
     denom = min(self.mean(), that.mean())
-    dd=stats.norm((self.mean()-that.mean())/denom, math.sqrt(self.meanVariance()+that.meanVariance())/denom)
+    if denom == 0:
+      if self.mean() == that.mean():
+        return 1.0
+      return 0.0
+    dd=NormalDist((self.mean()-that.mean())/denom, math.sqrt(self.meanVariance()+that.meanVariance())/denom)
     return dd.cdf(config.same_threshold_pct/2.0)-dd.cdf(-config.same_threshold_pct/2.0)
 
   def last(self):
@@ -252,7 +369,8 @@ class Candidate:
     self.cid         = Candidate.nextCandidateId
     self.infoxml     = infoxml
     self.lastMutator = None
-    self.outputdir   = storagedirs.candidate(self.cid)
+    self.usage       = dict() #n -> list of rusage dicts, one per run
+    self.outputdir   = storagedirs.candidatedir(self.cid)
     self.C           = config.bandit_c    # exploration/exploitation trade-off in the DMAB algorithm
     
     self.mutatorScores = dict()
@@ -300,6 +418,10 @@ class Candidate:
 
   def cloneAndMutate(self, n, adaptive = False, mutatorLog = None, 
                      objectives = None, mutatorFilter=lambda m: True):
+    return tracing.wrap('mutate', 'mutation',
+                        lambda: self.cloneAndMutateInner(n, adaptive, mutatorLog, objectives, mutatorFilter))
+
+  def cloneAndMutateInner(self, n, adaptive, mutatorLog, objectives, mutatorFilter):
     c = self.clone()
 
     if adaptive:
@@ -386,7 +508,8 @@ class Candidate:
 
 
     (exploit, explore, total) = self.mutatorScores[bestMutator]
-    print "exploitation" if exploit > explore else "exploration"
+    if config.print_log:
+      print "exploitation" if exploit > explore else "exploration"
     self.lastMutator = bestMutator
     self.lastMutator.timesSelected += 1
     self.lastMutator.mutate(self, n)
@@ -427,8 +550,13 @@ class Candidate:
       return w*(-entry.dtime) + (1.0-w)*dacc
         
 
+    # the log split by mutator once, not filtered for each score
+    logged = dict()
+    for entry in mutatorLog.log:
+      logged.setdefault(entry.mutator, []).append(entry)
+
     def computeScore(m):
-      children = filter(lambda entry: entry.mutator == m, mutatorLog.log)
+      children = logged.get(m, [])
       if len(children) == 0:
         return 0
       else:
@@ -438,7 +566,7 @@ class Candidate:
 
 
   ''' like weightedSumMutate, but uses roulette whell instead of bandit selection'''
-  def rouletteWheelMutate(self, n, mutatorLog, objectives):
+  def rouletteWheelMutate(self, n, mutatorLog, objectives, mutatorFilter):
     
     def avg(lst):
       return sum(lst) / len(lst)
@@ -450,16 +578,25 @@ class Candidate:
       return w*(-entry.dtime) + (1.0-w)*dacc
         
 
+    # the log split by mutator once, not filtered for each score
+    logged = dict()
+    for entry in mutatorLog.log:
+      logged.setdefault(entry.mutator, []).append(entry)
+
     def computeScore(m):
-      children = filter(lambda entry: entry.mutator == m, mutatorLog.log)
+      children = logged.get(m, [])
       if len(children) == 0:
         return 0
       else:
         return avg(map(lambda entry: computeOneScore(m, entry), children))
 
+    filteredMutators = filter(mutatorFilter, self.mutators)
+    if not filteredMutators:
+      raise NoMutators()
+
     # compute unnormalized mutator scores    
     Z = 0 # normalization constant
-    for m in self.mutators:
+    for m in filteredMutators:
       score = max(0.02, computeScore(m))
       self.mutatorScores[m] = score
       Z += score
@@ -467,8 +604,8 @@ class Candidate:
     # roulette wheel selection
     r = random.random()
     
-    for m in self.mutators:
-      if r <= self.mutatorScores[m] / Z:
+    for m in filteredMutators:
+      if r <= self.mutatorScores[m] / Z or m == filteredMutators[-1]:
         self.lastMutator = m
         m.mutate(self, n)
         break
@@ -478,8 +615,8 @@ class Candidate:
       
 
 
-  def uniformRandomMutate(self, n, mutatorLog, objectives):
-    self.mutate(n)
+  def uniformRandomMutate(self, n, mutatorLog, objectives, mutatorFilter):
+    self.mutate(n, mutatorFilter)
     
 
 
@@ -515,12 +652,55 @@ class Candidate:
   def hasAccuracy(self, n, target):
     return self.metrics[config.accuracy_metric_idx][n].mean() >= target
 
+  def withinMemoryBudget(self, n):
+    if config.memory_budget is None:
+      return True
+    m = self.metrics[config.memory_metric_idx][n]
+    return len(m) == 0 or m.mean() <= config.memory_budget
+
+  def addUsage(self, n, usage):
+    self.usage.setdefault(n, []).append(usage)
+
+  def usageSummary(self, n):
+    '''
+    (cpu seconds mean, max rss in kB, voluntary and involuntary context
+    switches mean, minor and major page faults mean) over runs at size n
+    '''
+    u = self.usage.get(n)
+    if not u:
+      return (-1, -1, -1, -1, -1, -1)
+    def mean(f):
+      return sum(map(f, u))/float(len(u))
+    return (mean(lambda x: x['utime']+x['stime']),
+            max(map(lambda x: x['maxrss'], u)),
+            mean(lambda x: x['nvcsw']),
+            mean(lambda x: x['nivcsw']),
+            mean(lambda x: x['minflt']),
+            mean(lambda x: x['majflt']))
+
+  def fingerprint(self, n):
+    '''identifies candidates that behave the same at input size n'''
+    if self.infoxml is None:
+      return self.config.fingerprint()
+    return effectiveFingerprint(self.config, self.infoxml, n)
+
   def cfgfile(self):
+    return storagedirs.configfile(self.config)
+
+  def persist(self):
+    '''create the candidate directory, with a copy of the current config'''
+    storagedirs.candidate(self.cid)
     cf=os.path.join(self.outputdir,'config')
-    self.config.save(cf)
-    return cf
+    if os.path.isfile(cf):
+      os.unlink(cf)
+    try:
+      os.link(self.cfgfile(), cf)
+    except OSError:
+      shutil.copyfile(self.cfgfile(), cf)
 
   def rmfiles(self):
+    if not os.path.isdir(self.outputdir):
+      return
     for f in ('config', 'stats', 'stats_raw'):
       f=os.path.join(self.outputdir,f)
       if os.path.isfile(f):
@@ -538,6 +718,10 @@ class Candidate:
     return self.metrics[config.accuracy_metric_idx][n]
 
   def writestats(self, n, filename=None):
+    tracing.wrap('writestats', 'logging', lambda: self.writestatsInner(n, filename))
+
+  def writestatsInner(self, n, filename):
+    self.persist()
     if filename is None:
       filename=os.path.join(self.outputdir,'stats')
     first=not os.path.isfile(filename)
@@ -546,6 +730,7 @@ class Candidate:
       s.write("#input, ")
       for m in config.metrics:
         s.write("%s_mean, %s_stddev, %s_stderr, %s_ci, "%(m, m, m, m))
+      s.write("cpu_sec_mean, maxrss_kb, nvcsw_mean, nivcsw_mean, minflt_mean, majflt_mean, ")
       s.write("\n")
     s.write("%6d, "%n)
     for m in self.metrics:
@@ -566,6 +751,7 @@ class Candidate:
         sd = -1
 
       s.write("%.8f, %.8f, %.8f, %.8f, "%(avg,sd,se,ci))
+    s.write("%.6f, %d, %.1f, %.1f, %.1f, %.1f, "%self.usageSummary(n))
     s.write("\n")
     s.close()
 
@@ -590,6 +776,225 @@ class MutatorLogFile:
     self.mutatorScores.writerow([gen] + scores)
       
 
+class TrialSlot:
+  '''a disjoint share of the cores that one concurrent trial runs on'''
+  def __init__(self, cpus, threads, pin):
+    self.cpus = cpus
+    self.threads = threads
+    if pin:
+      self.prefix = pbutil.affinityPrefix(cpus)
+    else:
+      self.prefix = []
+
+  def wrap(self, cmd):
+    '''rewrite a benchmark command line to run within this slot'''
+    threads = "--threads=%d"%self.threads
+    return self.prefix + map(lambda x: threads if x.startswith("--threads=") else x, cmd)
+
+class TrialPool:
+  '''runs up to config.parallel_trials benchmark processes at once'''
+  def __init__(self, slots):
+    cpus = pbutil.partitionCpus(slots)
+    if len(cpus) == 1:
+      self.slots = [None]
+    else:
+      threads = max(1, config.threads/len(cpus))
+      self.slots = map(lambda c: TrialSlot(c, threads, config.parallel_affinity), cpus)
+
+  def __len__(self):
+    return len(self.slots)
+
+  def run(self, jobs):
+    '''
+    jobs is an iterable of (key, fn(slot)) pairs, only pulled once a slot is
+    free, yields (key, result, exception) in order of completion
+    '''
+    if len(self.slots) == 1:
+      for key, fn in jobs:
+        try:
+          yield key, fn(self.slots[0]), None
+        except Exception, e:
+          yield key, None, e
+      return
+
+    jobs = iter(jobs)
+    done = Queue.Queue()
+    free = list(self.slots)
+    running = [0]
+    threads = []
+    def worker(key, fn, slot):
+      try:
+        done.put((key, slot, tracing.wrap('trial', 'testing', lambda: fn(slot)), None))
+      except BaseException, e:
+        done.put((key, slot, None, e))
+    def wait(timeout=2**30):
+      #a timeout keeps the wait interruptible
+      rv = done.get(True, timeout)
+      running[0] -= 1
+      free.append(rv[1])
+      return rv
+    try:
+      exhausted = False
+      while True:
+        while free and not exhausted:
+          try:
+            key, fn = jobs.next()
+          except StopIteration:
+            exhausted = True
+            break
+          t = threading.Thread(target=worker, args=(key, fn, free.pop(0)))
+          t.daemon = True
+          running[0] += 1
+          threads.append(t)
+          t.start()
+        if running[0] == 0:
+          break
+        key, slot, rv, e = wait()
+        yield key, rv, e
+    finally:
+      if running[0] > 0:
+        #stopped early, by a crash or a ctrl-c, so the trials still running
+        #are cancelled rather than waited for, as they may have no limit
+        pbutil.killRuns(threads)
+        end = time.time()+config.kill_grace_sec
+        try:
+          while running[0] > 0:
+            wait(max(0.0, end-time.time()))
+        except Queue.Empty:
+          pass #the workers are daemon threads
+
+class InputGenerator:
+  '''creates the iogen inputs for one input size in background threads'''
+  def __init__(self, bin, cmd, n):
+    self.bin = bin
+    self.cmd = cmd
+    self.n = n
+    self.jobs = dict()        #testNumber -> InputJob
+    self.lock = threading.Lock()
+    self.slots = threading.Semaphore(max(1, config.inputgen_threads))
+
+  def start(self, testNumber, prefetch=False):
+    self.startMany([testNumber], prefetch)
+
+  def startMany(self, numbers, prefetch=False):
+    '''
+    begin generating the given inputs, up to config.inputgen_batch of them
+    per --iogen-create process, prefetches are skipped once the inputs of
+    this session are over config.prefetch_inputs_mb
+    '''
+    self.lock.acquire()
+    try:
+      lib = inputlibrary.library()
+      todo = []
+      for i in numbers:
+        if i in self.jobs or i in todo:
+          continue
+        if lib is not None and lib.has(self.bin, self.n, i):
+          self.jobs[i] = InputJob(None, self.slots)
+        else:
+          todo.append(i)
+      if not todo:
+        return
+      if prefetch:
+        used = storagedirs.inputBytes()
+        if lib is not None:
+          used += lib.pinnedBytes()
+        if used > config.prefetch_inputs_mb*1024*1024:
+          return
+      batch = max(1, config.inputgen_batch)
+      for first in xrange(0, len(todo), batch):
+        chunk = todo[first:first+batch]
+        tmp = tempfile.mkdtemp(prefix='tmp_', dir=storagedirs.inputdir())
+        cmd = self.cmd + ['--iogen-create='+os.path.join(tmp, 's'),
+                          '--iogen-count=%d'%len(chunk),
+                          "--n=%d"%self.n]
+        debug_logcmd(cmd)
+        job = InputJob(cmd, self.slots, lambda ok, tmp=tmp, chunk=chunk: self.publish(ok, tmp, chunk))
+        for i in chunk:
+          self.jobs[i] = job
+    finally:
+      self.lock.release()
+
+  def publish(self, ok, tmp, chunk):
+    '''move the sets generated into tmp to their input prefixes'''
+    lib = inputlibrary.library()
+    files = os.listdir(tmp)
+    for k, i in enumerate(chunk):
+      if not ok:
+        break
+      if lib is not None:
+        pfx, done = lib.staging(self.bin, self.n, i)
+      else:
+        pfx, done = storagedirs.inputpfx(self.n, i), None
+      s = 's%d' % k
+      for f in filter(lambda f: f.startswith(s+'_'), files):
+        shutil.move(os.path.join(tmp, f), pfx+f[len(s):])
+      if done is not None:
+        done(True)
+    shutil.rmtree(tmp, True)
+
+  def wait(self, testNumber):
+    self.start(testNumber)
+    if not self.jobs[testNumber].wait():
+      raise InputGenerationException(testNumber)
+
+  def stop(self):
+    for j in self.jobs.values():
+      j.kill()
+    for j in self.jobs.values():
+      j.wait()
+    self.jobs = dict()
+
+class InputJob:
+  '''
+  a single --iogen-create run, started once one of slots is free, cmd
+  None is an input that already exists
+  '''
+  def __init__(self, cmd, slots, publish=None):
+    self.cmd = cmd
+    self.slots = slots
+    self.publish = publish
+    self.proc = None
+    self.killed = False
+    self.ok = None
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    if self.cmd is None:
+      self.ok = True
+      return
+    self.slots.acquire()
+    try:
+      devnull = open("/dev/null", "w")
+      try:
+        if not self.killed:
+          self.proc = subprocess.Popen(self.cmd, stdout=devnull, stderr=devnull)
+          self.ok = tracing.wrap('iogen', 'inputgen', self.proc.wait) == 0
+      finally:
+        devnull.close()
+    finally:
+      self.slots.release()
+      if self.ok is None:
+        self.ok = False
+      if self.publish is not None:
+        self.publish(self.ok)
+
+  def kill(self):
+    self.killed = True
+    try:
+      if self.proc is not None and self.proc.returncode is None:
+        self.proc.kill()
+    except OSError:
+      pass
+
+  def wait(self):
+    while self.thread.isAlive():
+      #a timeout keeps the wait interruptible
+      self.thread.join(2**30)
+    return self.ok
+
 class CandidateTester:
   def __init__(self, app, n, args=[]):
     self.app = app
@@ -608,9 +1013,36 @@ class CandidateTester:
     self.timeoutCount = 0
     self.crashCount = 0
     self.wasTimeout = True 
+    self._pool = None
+    self.servers = dict()
+    self.cacheHits = 0
+    self.cpuSec = 0.0
+    self.maxRss = 0
+    self.inputgen = InputGenerator(self.bin, self.cmd, self.n)
+    self._next = None
 
   def nextTester(self):
-    return CandidateTester(self.app, (self.n-config.offset)*2, self.args)
+    if self._next is not None:
+      t, self._next = self._next, None
+      return t
+    return self.withInputSize((self.n-config.offset)*2)
+
+  def withInputSize(self, n):
+    '''a new tester like this one for input size n'''
+    return CandidateTester(self.app, n, self.args)
+
+  def prefetchInputs(self, count, prefetch=False):
+    '''start generating the first count inputs in the background'''
+    if config.use_iogen:
+      count = self.inputNumber(min(count, config.max_trials)-1)+1
+      self.inputgen.startMany(range(len(self.inputs), count), prefetch)
+
+  def prefetchNext(self, count):
+    '''start generating inputs for nextTester() while this size is still running'''
+    if config.use_iogen and config.prefetch_inputs:
+      if self._next is None:
+        self._next = self.nextTester()
+      self._next.prefetchInputs(count, True)
   
   def testN(self, candidate, trials, limit=None):
     for x in xrange(trials - candidate.numTests(self.n)):
@@ -618,18 +1050,11 @@ class CandidateTester:
 
   def getInputArg(self, testNumber):
     if config.use_iogen:
-      pfx=storagedirs.inputpfx(self.n, testNumber)
-      if len(self.inputs) <= testNumber:
-        assert len(self.inputs) == testNumber
-        cmd = self.cmd + ['--iogen-create='+pfx, "--n=%d"%self.n]
-        debug_logcmd(cmd)
-        devnull = open("/dev/null", "w")
-        try:
-          if subprocess.call(cmd, stdout=devnull, stderr=devnull) != 0:
-            raise InputGenerationException(testNumber)
-          self.inputs.append(Input(pfx))
-        finally:
-          devnull.close()
+      while len(self.inputs) <= testNumber:
+        #inputs skipped by cached trials are generated in order
+        self.inputgen.wait(len(self.inputs))
+        self.inputs.append(Input(storagedirs.inputpfx(self.n, len(self.inputs), self.bin)))
+      pfx=storagedirs.inputpfx(self.n, testNumber, self.bin)
       return ["--iogen-run="+pfx, "--iogen-n=%d"%self.n]
     else:
       return ["--n=%d"%self.n]
@@ -641,44 +1066,243 @@ class CandidateTester:
     elif self.inputs[i].outputHash != value:
       warnings.warn(InconsistentOutput(self.inputs[i].firstCanidate, candidate, self.inputs[i].pfx))
 
-  def test(self, candidate, limit=None):
+  def pool(self):
+    if self._pool is None:
+      self._pool = TrialPool(config.parallel_trials)
+    return self._pool
+
+  def parallelism(self):
+    return len(self.pool())
+
+  def inputNumber(self, testNumber):
+    '''each run records config.trials_per_run samples, all on one input'''
+    return testNumber/config.trials_per_run
+
+  def trialsInRun(self, testNumber):
+    '''samples recorded by the run of testNumber, the last run before config.max_trials is cut short'''
+    return max(1, min(config.trials_per_run, config.max_trials-testNumber))
+
+  def prepare(self, candidate, testNumber, limit):
+    '''build the per-trial arguments for a single trial, generating inputs if needed'''
     self.testCount += 1
     cfgfile = candidate.cfgfile()
-    testNumber = candidate.numTests(self.n)
     if testNumber>=config.max_trials:
       warnings.warn(tunerwarnings.TooManyTrials(testNumber+1))
-    cmd = list(self.cmd)
-    cmd.append("--config="+cfgfile)
-    cmd.extend(timers.inputgen.wrap(lambda:self.getInputArg(testNumber)))
+    args = ["--config="+cfgfile]
+    args.extend(timers.inputgen.wrap(lambda:self.getInputArg(self.inputNumber(testNumber))))
+    if self.trialsInRun(testNumber) > 1:
+      args.append("--trials=%d"%self.trialsInRun(testNumber))
     if limit is not None:
-      cmd.append("--max-sec=%f"%limit)
-    cmd.extend(getMemoryLimitArgs())
+      args.append("--max-sec=%f"%limit)
+    return args
+
+  def cacheKey(self, candidate, testNumber):
+    '''
+    key of a trial in the measurement cache, None if its iogen input is not
+    (yet) in the input library
+    '''
+    slot = self.pool().slots[0]
+    if slot is None:
+      threads = config.threads
+    else:
+      threads = slot.threads
+    if config.use_iogen:
+      lib = inputlibrary.library()
+      if lib is None:
+        return None
+      inp = lib.contentId(self.bin, self.n, self.inputNumber(testNumber))
+      if inp is None:
+        return None
+    else:
+      inp = "r%02d" % testNumber
+    if self.trialsInRun(testNumber) > 1:
+      inp += "x%d" % self.trialsInRun(testNumber)
+    return (measurementcache.binaryKey(self.bin, threads, self.parallelism()),
+            candidate.fingerprint(self.n), self.n, inp)
+
+  def cached(self, cache, key, limit):
+    '''
+    returns (results, error) for a trial that can be answered from the
+    cache, None if it must be run
+    '''
+    if cache is None or config.fresh_measurements:
+      return None
+    hit = cache.lookup(key)
+    if hit is None:
+      return None
+    values, timeout = hit
+    if timeout is not None:
+      #only reuse a timeout if it was given at least as long as this trial
+      if limit is not None and limit <= timeout:
+        return None, pbutil.TimingRunTimeout()
+      return None
+    def result(v):
+      if v is None:
+        return None
+      if type(v) is not list:
+        v = [v]
+      return {'average': sum(v)/len(v), 'samples': v}
+    #entries stored with a different set of metrics are padded or truncated
+    values = (list(values) + [None]*len(config.metrics))[0:len(config.metrics)]
+    results = map(result, values) + [None] #no rusage for cached trials
+    if limit is not None and results[config.timing_metric_idx]['average'] > limit:
+      return None, pbutil.TimingRunTimeout()
+    return results, None
+
+  def remember(self, cache, key, limit, results, error):
+    if cache is None:
+      return
+    if isinstance(error, pbutil.TimingRunTimeout):
+      cache.store(key, None, limit)
+    elif error is None:
+      cache.store(key, map(lambda r: r if r is None else r.get('samples', [r['average']]),
+                           results[0:len(config.metrics)]))
+
+  def basecmd(self):
+    return self.cmd + getMemoryLimitArgs()
+
+  def server(self, slot, cmd):
+    s = self.servers.get(slot)
+    if s is None or s.cmd != cmd:
+      if s is not None:
+        s.stop()
+      s = self.servers[slot] = pbutil.BenchmarkServer(cmd)
+    return s
+
+  def execute(self, args, slot=None, limit=None):
+    cmd = self.basecmd()
+    tags = config.metrics
+    if config.check:
+      cmd = cmd + ['--hash']
+      tags = tags + ['outputhash']
+    tags = tags + ['rusage']
+    if slot is not None:
+      cmd = slot.wrap(cmd)
+    if config.use_server:
+      return pbutil.executeServerRun(self.server(slot, cmd), args, tags, killTimeout(limit))
+    debug_logcmd(cmd+args)
+    return pbutil.executeRun(cmd+args, tags, timeout=killTimeout(limit))
+
+  def record(self, candidate, testNumber, limit, cmd, results=None, error=None):
+    '''add the outcome of a single trial to candidate.metrics'''
     try:
-      debug_logcmd(cmd)
+      if error is not None:
+        raise error
+      usage = results.pop()
       if config.check:
-        results = timers.testing.wrap(lambda: pbutil.executeRun(cmd+['--hash'], config.metrics+['outputhash']))
-        self.checkOutputHash(candidate, testNumber, results[-1]['value'])
+        self.checkOutputHash(candidate, self.inputNumber(testNumber), results[-1]['value'])
         del results[-1]
-      else:
-        results = timers.testing.wrap(lambda: pbutil.executeRun(cmd, config.metrics))
       for i,result in enumerate(results):
         if result is not None:
-          v=result['average']
-          if numpy.isnan(v) or numpy.isinf(v):
-            warnings.warn(tunerwarnings.NanAccuracy())
-            raise pbutil.TimingRunFailed(None)
-          candidate.metrics[i][self.n].add(v)
+          for v in result.get('samples', [result['average']]):
+            if numpy.isnan(v) or numpy.isinf(v):
+              warnings.warn(tunerwarnings.NanAccuracy())
+              raise pbutil.TimingRunFailed(None)
+      for i,result in enumerate(results):
+        if result is not None:
+          for v in result.get('samples', [result['average']]):
+            candidate.metrics[i][self.n].add(v)
+      if usage is not None:
+        candidate.addUsage(self.n, usage)
+        self.cpuSec += usage['utime']+usage['stime']
+        self.maxRss = max(self.maxRss, usage['maxrss'])
       return True
     except pbutil.TimingRunTimeout:
       assert limit is not None
       warnings.warn(tunerwarnings.ProgramTimeout(candidate, self.n, limit))
-      candidate.metrics[config.timing_metric_idx][self.n].addTimeout(limit)
+      #the run counted as trialsInRun tests, later test numbers (and so
+      #inputs) depend on it adding as many samples
+      for i in xrange(self.trialsInRun(testNumber)):
+        candidate.metrics[config.timing_metric_idx][self.n].addTimeout(limit)
       self.timeoutCount += 1
       return False
     except pbutil.TimingRunFailed, e:
       self.crashCount += 1
       raise CrashException(testNumber, self.n, candidate, cmd)
 
+  def test(self, candidate, limit=None):
+    return self.testMany([(candidate, limit)])[0]
+
+  def sharedResults(self, candidate):
+    '''the results of candidate at this size, which clones share with their parent, and so its test numbers'''
+    return candidate.metrics[config.timing_metric_idx][self.n]
+
+  def distinct(self, candidates):
+    '''candidates without those sharing results with an earlier one, so a batch adds each test number once'''
+    seen = set()
+    rv = []
+    for c in candidates:
+      if self.sharedResults(c) not in seen:
+        seen.add(self.sharedResults(c))
+        rv.append(c)
+    return rv
+
+  def testMany(self, trials, accept=lambda candidate, testNumber: True, onCrash=None):
+    '''
+    run each (candidate, limit) pair in trials, up to config.parallel_trials
+    at once, adding results to candidate.metrics as each one completes
+    trials where accept(candidate, testNumber) is false at launch are skipped
+    crashes are passed to onCrash, or raised if it is None
+    '''
+    pending = dict()
+    shared = self.sharedResults
+    rv = []
+    cache = measurementcache.cache()
+    counts = dict()
+    for candidate, limit in trials:
+      counts[candidate] = counts.get(candidate, 0) + 1
+    if counts:
+      self.prefetchInputs(max(map(lambda c: c.numTests(self.n)+counts[c], counts)))
+    def record(candidate, testNumber, limit, cmd, results, error):
+      try:
+        rv.append(self.record(candidate, testNumber, limit, cmd, results, error))
+      except CrashException, e:
+        if onCrash is None:
+          raise
+        onCrash(e)
+    def jobs():
+      for candidate, limit in trials:
+        testNumber = candidate.numTests(self.n) + pending.get(shared(candidate), 0)
+        if not accept(candidate, testNumber):
+          continue
+        key = None
+        if cache is not None:
+          key = self.cacheKey(candidate, testNumber)
+        if key is not None:
+          hit = self.cached(cache, key, limit)
+          if hit is not None:
+            self.testCount += 1
+            self.cacheHits += 1
+            record(candidate, testNumber, limit, None, *hit)
+            continue
+        pending[shared(candidate)] = pending.get(shared(candidate), 0) + self.trialsInRun(testNumber)
+        timers.testing.stop()
+        try:
+          args = self.prepare(candidate, testNumber, limit)
+        finally:
+          timers.testing.start()
+        yield ((candidate, testNumber, limit, self.basecmd()+args, key),
+               lambda slot, args=args, limit=limit: self.execute(args, slot, limit))
+    def run():
+      completions = self.pool().run(jobs())
+      try:
+        for (candidate, testNumber, limit, cmd, key), results, error in completions:
+          pending[shared(candidate)] -= self.trialsInRun(testNumber)
+          if error is not None and not isinstance(error, (pbutil.TimingRunTimeout,
+                                                          pbutil.TimingRunFailed)):
+            raise error
+          if cache is not None and key is None:
+            #the input was generated for this trial
+            key = self.cacheKey(candidate, testNumber)
+          if key is not None:
+            self.remember(cache, key, limit, results, error)
+          record(candidate, testNumber, limit, cmd, results, error)
+      finally:
+        completions.close()
+    tracing.wrap('testMany', 'testing', lambda: timers.testing.wrap(run),
+                 {'n': self.n, 'trials': len(trials)})
+    return rv
+
   def race(self, candidatea, candidateb, limit=None, accuracy_target=None):
     self.testCount += 1
     cfgfilea = candidatea.cfgfile()
@@ -697,8 +1321,8 @@ class CandidateTester:
     if accuracy_target:
       cmd.append("--race-accuracy=%f"%accuracy_target)
     try:
-      debug_logcmd(cmd)
-      resulta,resultb = timers.testing.wrap(lambda: pbutil.executeRaceRun(cmd, cfgfilea, cfgfileb))
+      resulta,resultb = timers.testing.wrap(lambda: tracing.wrap('race', 'testing',
+                                            lambda: self.executeRace(cmd, cfgfilea, cfgfileb, limit)))
       best = min(min(resulta['timing'], resultb['timing']), 2**31)
       if limit is not None and best>limit*2:
         best=limit
@@ -706,7 +1330,9 @@ class CandidateTester:
         if result['timing'] < 2**31:
           candidate.wasTimeout = False
           for i,metric in enumerate(config.metrics):
-            candidate.metrics[i][self.n].add(result[metric])
+            #memory is not known per candidate, both share one process
+            if metric in result:
+              candidate.metrics[i][self.n].add(result[metric])
         elif candidate is not None:
           candidate.metrics[config.timing_metric_idx][self.n].addTimeout(best)
           candidate.wasTimeout = True
@@ -721,9 +1347,37 @@ class CandidateTester:
       self.crashCount += 1
       raise CrashException(0, self.n, candidatea, cmd)
   
+  def executeRace(self, cmd, cfgfilea, cfgfileb, limit=None):
+    debug_logcmd(cmd)
+    return pbutil.executeRaceRun(cmd, cfgfilea, cfgfileb, timeout=killTimeout(limit))
+
+  def testMemory(self, candidate, limit=None):
+    '''
+    run candidate on its own to record only its peak memory, for candidates
+    only tested through race() where the two configs share one process
+    '''
+    args = self.prepare(candidate, 0, limit)
+    try:
+      results = timers.testing.wrap(lambda: self.execute(args, None, limit))
+    except pbutil.TimingRunTimeout:
+      self.timeoutCount += 1
+      return False
+    except pbutil.TimingRunFailed, e:
+      self.crashCount += 1
+      raise CrashException(0, self.n, candidate, self.basecmd()+args)
+    memory = results[config.memory_metric_idx]
+    if memory is not None:
+      candidate.metrics[config.memory_metric_idx][self.n].add(memory['average'])
+    return True
+
   def comparer(self, metricIdx, confidence, maxTests):
     '''return a cmp like function that dynamically runs more tests to improve confidence'''
     def compare(a, b):
+      if maxTests == 0:
+        return docompare(a, b)
+      return tracing.wrap('compare', 'comparison', lambda: docompare(a, b),
+                          {'n': self.n, 'metric': config.metrics[metricIdx]})
+    def docompare(a, b):
       assert a.numTests(self.n)>0
       assert b.numTests(self.n)>0
       if metricIdx != config.timing_metric_idx:
@@ -737,12 +1391,15 @@ class CandidateTester:
       for x in xrange(2*maxTests+1):
         ra=a.metrics[metricIdx][self.n]
         rb=b.metrics[metricIdx][self.n]
-        if ra.diffChance(rb) >= confidence:
-          # we can eliminate the null hypothesis, just compare
-          return config.metric_orders[metricIdx]*cmp(ra.mean(), rb.mean())
-        if ra.sameChance(rb) >= confidence:
-          return 0
-        if ra.estimatedBenifitNextTest() >= rb.estimatedBenifitNextTest() and a.numTests(self.n)<maxTests:
+        rv = self.resolve(a, b, metricIdx, confidence)
+        if rv is not None:
+          return rv
+        if self.parallelism()>1:
+          batch = filter(lambda c: c.numTests(self.n)<maxTests, self.distinct((a, b)))
+          if not batch:
+            break
+          self.testMany(map(lambda c: (c, None), batch))
+        elif ra.estimatedBenifitNextTest() >= rb.estimatedBenifitNextTest() and a.numTests(self.n)<maxTests:
           self.test(a)
         elif b.numTests(self.n)<maxTests:
           self.test(b)
@@ -754,11 +1411,80 @@ class CandidateTester:
       return 0
     return compare
 
+  def resolve(self, a, b, metricIdx, confidence):
+    '''cmp(a, b) if the results so far decide it at confidence, otherwise None'''
+    ra=a.metrics[metricIdx][self.n]
+    rb=b.metrics[metricIdx][self.n]
+    def decide():
+      if len(ra)==0 or len(rb)==0:
+        return 0
+      if ra.diffChance(rb) >= confidence:
+        # we can eliminate the null hypothesis, just compare
+        return config.metric_orders[metricIdx]*cmp(ra.mean(), rb.mean())
+      if ra.sameChance(rb) >= confidence:
+        return 0
+      return None
+    return tracing.wrap('resolve', 'statistics', decide)
+
+  def selectBestN(self, population, n, metricIdx, confidence, maxTests):
+    '''
+    race population down to its best n members, each round retesting (as
+    one batch) every candidate whose place in the ordering of the top n is
+    still undecided and dropping those that are settled below the cutoff
+    returns the best n in order
+    '''
+    return tracing.wrap('selectBestN', 'comparison',
+                        lambda: self.selectBestNInner(population, n, metricIdx, confidence, maxTests),
+                        {'n': self.n, 'population': len(population), 'keep': n})
+
+  def selectBestNInner(self, population, n, metricIdx, confidence, maxTests):
+    fastCmp = self.comparer(metricIdx, 0.00, 0)
+    alive = list(population)
+    while True:
+      alive.sort(cmp=fastCmp)
+      best = alive[0:n]
+      undecided = []
+      # adjacent pairs order the top n
+      for i in xrange(len(best)-1):
+        if self.resolve(best[i], best[i+1], metricIdx, confidence) is None:
+          undecided.append((best[i], best[i+1]))
+      # the rest only need to be compared to the cutoff
+      cutoff = best[-1]
+      for c in alive[n:]:
+        rv = self.resolve(cutoff, c, metricIdx, confidence)
+        if rv is None:
+          undecided.append((cutoff, c))
+        elif rv <= 0:
+          alive.remove(c)
+      batch = []
+      for pair in undecided:
+        for c in pair:
+          if c not in batch and c.numTests(self.n)<maxTests:
+            batch.append(c)
+      batch = self.distinct(batch)
+      if not batch:
+        for a, b in undecided:
+          warnings.warn(ComparisonFailed(self.n, a, b))
+        return best
+      self.testMany(map(lambda c: (c, None), batch))
+
   def cleanup(self):
+    '''done with this input size, inputs prefetched for nextTester() are kept'''
+    for s in self.servers.values():
+      s.stop()
+    self.servers = dict()
+    self.inputgen.stop()
     if config.cleanup_inputs:
-      storagedirs.clearInputs();
+      storagedirs.clearInputs(self.n);
       self.inputs=[]
 
+  def teardown(self):
+    '''cleanup, also of the prefetched nextTester() if it was never taken'''
+    if self._next is not None:
+      self._next.teardown()
+      self._next = None
+    self.cleanup()
+
 if __name__ == "__main__":
   print "TESTING CANDIDATETESTER"
   pbutil.chdirToPetabricksRoot();
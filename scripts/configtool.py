@@ -1,5 +1,5 @@
 #!/usr/bin/python
-import re, sys, os, tempfile, subprocess, logging
+import re, sys, os, tempfile, subprocess, logging, hashlib, weakref
 
 CONFIGLINERE=re.compile("[ \t]*([a-z0-9_-]+)[ \t]*[=][ \t]*([.0-9-]+)(.*)", re.IGNORECASE)
 USAGE='''USAGE:
@@ -10,33 +10,117 @@ USAGE='''USAGE:
   configtool <FILE> print
 '''
 
+def isFloatComment(com):
+  return "double" in com or "float" in com
+
+class ConfigSchema:
+  '''the keys and comments of a config file, shared by all configs with the same layout'''
+  #only while some config uses them, so long lived processes don't keep
+  #every layout they ever built
+  interned = weakref.WeakValueDictionary()
+
+  def __init__(self, keys, comments):
+    self.keys = keys
+    self.comments = comments
+    self.index = dict(map(lambda x: (x[1], x[0]), enumerate(keys)))
+    self.isfloat = map(isFloatComment, comments)
+    #slots in key order, so values can be compared between schemas
+    self.sortedslots = map(lambda k: self.index[k], sorted(keys))
+
+  @staticmethod
+  def get(keys, comments):
+    k = (tuple(keys), tuple(comments))
+    s = ConfigSchema.interned.get(k)
+    if s is None:
+      s = ConfigSchema(list(keys), list(comments))
+      ConfigSchema.interned[k] = s
+    return s
+
+  def extend(self, key, com):
+    '''schema with key added, or with its comment replaced'''
+    keys = list(self.keys)
+    comments = list(self.comments)
+    if key in self.index:
+      comments[self.index[key]] = com
+    else:
+      keys.append(key)
+      comments.append(com)
+    return ConfigSchema.get(keys, comments)
+
 class ConfigFile:
-  '''manages a config file with dict()-like semantics, no further documentation needed'''
+  '''
+  manages a config file with dict()-like semantics, values are stored in a
+  list laid out by a shared ConfigSchema, copies share that list and only
+  keep the values changed since
+  '''
+  maxdelta = 32
+
   def __init__(self, src):
     if type(src) == type(self):
       '''copy constructor'''
-      self.values = dict(src.values)
+      src.compact(ConfigFile.maxdelta)
+      self.schema = src.schema
+      self.base   = src.base
+      self.delta  = dict(src.delta)
+      self._hash  = src._hash
+      self._fingerprint = src._fingerprint
     elif type(src) == type(""):
       '''construct from file'''
-      self.values = dict()
+      self.schema = ConfigSchema.get([], [])
+      self.base   = []
+      self.delta  = dict()
+      self._hash  = None
+      self._fingerprint = None
       self.load(src)
     else:
       raise Exception("invalid arg:"+src)
 
+  def compact(self, maxdelta=0):
+    '''fold changes into a new value list once there are more than maxdelta'''
+    if len(self.delta) > maxdelta:
+      self.base = self.valuelist()
+      self.delta = dict()
+
+  def valuelist(self):
+    rv = list(self.base)
+    for i,v in self.delta.iteritems():
+      rv[i] = v
+    return rv
+
   def load(self, filename):
+    keys = list(self.schema.keys)
+    comments = list(self.schema.comments)
+    values = self.valuelist()
+    index = dict(self.schema.index)
     fd = open(filename)
     for n, line in enumerate(fd):
       try:
         key,val,com = CONFIGLINERE.match(line).group(1,2,3)
-        self.add(key, val, com.strip())
+        com = com.strip()
+        if isFloatComment(com):
+          val = float(val)
+        else:
+          val = int(val)
+        if key in index:
+          comments[index[key]] = com
+          values[index[key]] = val
+        else:
+          index[key] = len(keys)
+          keys.append(key)
+          comments.append(com)
+          values.append(val)
       except:
         sys.stderr.write("WARNING: %s:%d -- failed to parse config line\n" % (filename,n))
     fd.close()
+    self.schema = ConfigSchema.get(keys, comments)
+    self.base = values
+    self.delta = dict()
+    self._hash = None
+    self._fingerprint = None
 
   def save(self, filename):
     fd = open(filename, "w")
-    for k,valcom in self.values.iteritems():
-      val, com = valcom
+    for k,val,com in zip(self.schema.keys, self.valuelist(), self.schema.comments):
       if type(val) is type(0.1):
         fd.write("%s = %.25e %s\n" % (k, val, com))
       else:
@@ -44,33 +128,69 @@ class ConfigFile:
     fd.close()
         
   def __str__(self):
-    return "\n".join(map(lambda x: "%s = %d"%(x[0],x[1][0]), sorted(self.values.items())))
+    return "\n".join(map(lambda x: "%s = %d"%x, sorted(self.items())))
 
   def __getitem__(self, k):
-    return self.values[k][0]
+    i = self.schema.index[k]
+    if i in self.delta:
+      return self.delta[i]
+    return self.base[i]
   
   def __setitem__(self, k, v):
     #logging.debug("configtool: changing %s from %d to %d", k, self[k], v)
-    com=self.values[k][1]
-    if type(v) is type(0.1) or "double" in com or "float" in com:
-      self.values[k] = (float(v), com)
+    i = self.schema.index[k]
+    if type(v) is type(0.1) or self.schema.isfloat[i]:
+      self.delta[i] = float(v)
     else:
-      self.values[k] = (int(v), com)
+      self.delta[i] = int(v)
+    self._hash = None
+    self._fingerprint = None
+
+  def __contains__(self, k):
+    return k in self.schema.index
+
+  def get(self, k, default=None):
+    if k in self.schema.index:
+      return self[k]
+    return default
 
   def __hash__(self):
-    return hash(str(self))
+    if self._hash is None:
+      values = self.valuelist()
+      self._hash = hash(tuple(map(lambda i: values[i], self.schema.sortedslots)))
+    return self._hash
+
+  def fingerprint(self):
+    '''stable digest of all values, for identifying configs across runs'''
+    if self._fingerprint is None:
+      self._fingerprint = hashlib.sha1("\n".join(map(lambda x: "%s = %r"%x, sorted(self.items())))).hexdigest()
+    return self._fingerprint
   
   def __cmp__(a, b):
-    return cmp(a.values, b.values)
+    if a.schema is b.schema:
+      return cmp(a.valuelist(), b.valuelist())
+    return cmp(dict(a.items()), dict(b.items()))
 
   def add(self, k, v, com="# added in script"):
-    if type(v) is type(0.1) or "double" in com or "float" in com:
-      self.values[k] = (float(v), com)
+    if k not in self.schema.index or self.schema.comments[self.schema.index[k]] != com:
+      values = self.valuelist()
+      self.schema = self.schema.extend(k, com)
+      values.extend([0]*(len(self.schema.keys)-len(values)))
+      self.base = values
+      self.delta = dict()
+    i = self.schema.index[k]
+    if type(v) is type(0.1) or self.schema.isfloat[i]:
+      self.delta[i] = float(v)
     else:
-      self.values[k] = (int(v), com)
+      self.delta[i] = int(v)
+    self._hash = None
+    self._fingerprint = None
 
   def keys(self):
-    return self.values.keys()
+    return list(self.schema.keys)
+
+  def items(self):
+    return zip(self.schema.keys, self.valuelist())
 
 def defaultConfigFile(bin):
   fd, name = tempfile.mkstemp(suffix='.cfg')
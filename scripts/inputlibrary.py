@@ -0,0 +1,147 @@
+#!/usr/bin/python
+import hashlib, os, shutil, tempfile, time, threading
+import pbutil
+from tunerconfig import config
+
+#entries used by any session this recently are not evicted, pins only
+#protect the entries of this process
+RECENT_SEC = 6*3600
+
+class InputLibrary:
+  '''
+  iogen inputs kept between tuning sessions, one directory per
+  (benchmark, binary hash, n, input number), least recently used entries
+  are deleted once the library is over maxbytes
+  '''
+  def __init__(self, root, maxbytes):
+    self.root = root
+    self.maxbytes = maxbytes
+    self.entries = dict() #path -> (last use, bytes)
+    self.pinned = set()   #entries used by this session are never evicted
+    self.lock = threading.Lock()
+    if not os.path.isdir(root):
+      os.makedirs(root)
+    for d, dirs, files in os.walk(root):
+      if files and os.path.basename(d)[0:4] != 'tmp_':
+        self.entries[d] = (os.path.getmtime(d), dirBytes(d))
+
+  def entry(self, bin, n, number):
+    return os.path.join(self.root,
+                        os.path.basename(bin)+'_'+pbutil.fileHash(bin)[0:16],
+                        "n%010d_i%02d" % (n, number))
+
+  def pfx(self, bin, n, number):
+    return os.path.join(self.entry(bin, n, number), "n%010d_i%02d_" % (n, number))
+
+  def has(self, bin, n, number):
+    d = self.entry(bin, n, number)
+    if os.path.isdir(d):
+      self.touch(d)
+      return True
+    return False
+
+  def contentId(self, bin, n, number):
+    '''
+    hash of the inputs of an entry, so that measurements on them are not
+    confused with those on an earlier entry that was evicted and generated
+    again, None if the entry does not exist
+    '''
+    d = self.entry(bin, n, number)
+    p = os.path.join(d, 'id')
+    try:
+      return open(p).read().strip()
+    except IOError:
+      pass
+    try:
+      h = hashlib.sha1()
+      for f in sorted(os.listdir(d)):
+        if f != 'id' and not f.startswith('id.tmp'):
+          h.update("%s %s\n" % (f, pbutil.fileHash(os.path.join(d, f))))
+      cid = h.hexdigest()[0:16]
+      #sessions racing here write the same id
+      tmp = p+'.tmp%d' % os.getpid()
+      open(tmp, 'w').write(cid+'\n')
+      os.rename(tmp, p)
+      return cid
+    except (IOError, OSError):
+      return None
+
+  def touch(self, d):
+    now = time.time()
+    try:
+      os.utime(d, (now, now))
+    except OSError:
+      pass
+    self.lock.acquire()
+    try:
+      self.pinned.add(d)
+      self.entries[d] = (now, self.entries.get(d, (0, dirBytes(d)))[1])
+    finally:
+      self.lock.release()
+
+  def staging(self, bin, n, number):
+    '''returns (prefix to generate into, fn to publish it once complete)'''
+    d = self.entry(bin, n, number)
+    if not os.path.isdir(os.path.dirname(d)):
+      os.makedirs(os.path.dirname(d))
+    tmp = tempfile.mkdtemp(prefix='tmp_', dir=os.path.dirname(d))
+    def publish(ok):
+      if ok:
+        try:
+          os.rename(tmp, d)
+        except OSError:
+          #another session got there first
+          shutil.rmtree(tmp, True)
+        self.touch(d)
+        self.evict()
+      else:
+        shutil.rmtree(tmp, True)
+    return os.path.join(tmp, "n%010d_i%02d_" % (n, number)), publish
+
+  def evict(self):
+    now = time.time()
+    self.lock.acquire()
+    try:
+      total = sum(map(lambda x: x[1], self.entries.values()))
+      for used, d in sorted(map(lambda x: (x[1][0], x[0]), self.entries.items())):
+        if total <= self.maxbytes:
+          break
+        if d in self.pinned:
+          continue
+        try:
+          #other sessions touch the entries they use
+          used = os.path.getmtime(d)
+        except OSError:
+          total -= self.entries.pop(d)[1]
+          continue
+        if used > now-RECENT_SEC:
+          self.entries[d] = (used, self.entries[d][1])
+          continue
+        total -= self.entries.pop(d)[1]
+        shutil.rmtree(d, True)
+    finally:
+      self.lock.release()
+
+  def pinnedBytes(self):
+    '''size of the entries used by this session'''
+    self.lock.acquire()
+    try:
+      return sum(map(lambda d: self.entries.get(d, (0, 0))[1], self.pinned))
+    finally:
+      self.lock.release()
+
+def dirBytes(d):
+  return sum(map(lambda f: os.path.getsize(os.path.join(d, f)), os.listdir(d)))
+
+_library = None
+def library():
+  '''the shared InputLibrary, or None if disabled'''
+  global _library
+  if not config.input_library or not config.use_iogen:
+    return None
+  if _library is None:
+    _library = InputLibrary(os.path.join(os.path.expanduser(config.output_dir),
+                                         os.path.expanduser(config.input_library)),
+                            config.input_library_mb*1024*1024)
+  return _library
+
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+'''
+runs python functions as jobs in forked children, highest priority first,
+each child in its own process group so that cancelling a job also stops the
+pbc or benchmark processes it started
+
+  runner = JobRunner(4, logdir='./testdata/.logs')
+  runner.submit(Job('Sort', lambda job: compile('Sort'), priority=cost))
+  for job in runner.run():        #in order of completion
+    print job.name, job.status, job.duration()
+  runner.writeSummary('./testdata/.logs/summary.json')
+
+the stdout and stderr of each job (and of everything it runs) are streamed
+to its log as they are written, a job passes if its function returns true
+'''
+import collections, errno, fcntl, heapq, json, os, re, select, signal, sys, time
+import progress
+
+PENDING   = 'pending'
+RUNNING   = 'running'
+PASSED    = 'passed'
+FAILED    = 'failed'
+CANCELLED = 'cancelled'
+
+#how often running jobs are checked for having exited while something they
+#started still holds their output open
+POLL_SEC = 1.0
+
+class Job:
+  def __init__(self, name, fn, priority=0.0):
+    self.name = name
+    self.fn = fn
+    self.priority = priority
+    self.id = None
+    self.status = PENDING
+    self.pid = None
+    self.fd = None
+    self.log = None
+    self.logfd = None
+    self.output = []
+    self.rv = None
+    self.start = None
+    self.end = None
+
+  def fork(self):
+    r, w = os.pipe()
+    self.pid = os.fork()
+    if self.pid == 0:
+      #child, never returns
+      code = 1
+      try:
+        os.setpgid(0, 0)
+        os.close(r)
+        progress.disable()
+        null = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null, 0)
+        os.dup2(w, 1)
+        os.dup2(w, 2)
+        sys.stdout = os.fdopen(1, 'w', 0)
+        sys.stderr = sys.stdout
+        try:
+          if self.fn(self):
+            code = 0
+        except Exception, e:
+          print "Exception:", e
+      finally:
+        os._exit(code)
+    #parent, the child may not have moved itself to its group yet
+    try:
+      os.setpgid(self.pid, self.pid)
+    except OSError:
+      pass
+    os.close(w)
+    fcntl.fcntl(r, fcntl.F_SETFL, fcntl.fcntl(r, fcntl.F_GETFL) | os.O_NONBLOCK)
+    self.fd = r
+    return self
+
+  def write(self, s):
+    self.output.append(s)
+    if self.logfd is not None:
+      self.logfd.write(s)
+      self.logfd.flush()
+
+  def kill(self):
+    '''kill the job and every process in its group'''
+    if self.pid is not None and self.end is None:
+      try:
+        os.killpg(self.pid, signal.SIGKILL)
+      except OSError:
+        pass
+
+  def duration(self):
+    if self.start is None:
+      return 0.0
+    return (self.end or time.time())-self.start
+
+  def getoutput(self):
+    return ''.join(self.output)
+
+  def getmsg(self):
+    '''the output on one line'''
+    return self.getoutput().replace('\n',' ').strip()
+
+  def summary(self):
+    return {'id'       : self.id,
+            'name'     : self.name,
+            'priority' : self.priority,
+            'status'   : self.status,
+            'rv'       : self.rv,
+            'start'    : self.start,
+            'end'      : self.end,
+            'duration' : self.duration(),
+            'log'      : self.log}
+
+class JobRunner:
+  '''
+  runs up to slots jobs at once; admit(job, running, pending) may hold back
+  the highest priority pending job while the running ones leave no room for
+  it (a job is always started when nothing else runs), and may set what the
+  job gets, e.g. job.cores, before it is forked
+  '''
+  def __init__(self, slots, logdir=None, admit=lambda job, running, pending: True):
+    self.slots = slots
+    self.logdir = logdir
+    self.admit = admit
+    self.jobs = []
+    self.pending = []                     #heap of (-priority, id, job)
+    self.npending = 0
+    self.running = dict()                 #fd -> job
+    self.finished = collections.deque()   #done but not yet returned by run()
+    self.counts = collections.defaultdict(int)
+    self.poll = select.poll()
+    self.t0 = time.time()
+    if logdir is not None and not os.path.isdir(logdir):
+      os.makedirs(logdir)
+
+  def submit(self, job):
+    job.id = len(self.jobs)
+    self.jobs.append(job)
+    heapq.heappush(self.pending, (-job.priority, job.id, job))
+    self.npending += 1
+    return job
+
+  def cancel(self, job):
+    '''stop a job, and everything it started, or drop it if it is pending'''
+    if job.status == PENDING:
+      self.npending -= 1
+      job.write("INTERRUPTED")
+      job.status = CANCELLED
+      job.end = time.time()
+      self.done(job)
+    elif job.status == RUNNING:
+      job.write("INTERRUPTED")
+      job.status = CANCELLED
+      job.kill()
+
+  def cancelAll(self):
+    for job in self.jobs:
+      self.cancel(job)
+    for job in self.running.values():
+      self.reap(job)
+
+  def startjobs(self):
+    '''
+    start the highest priority pending jobs admit accepts, looking at most
+    slots jobs past those it holds back
+    '''
+    held = []
+    while self.npending > len(held) and len(self.running) < self.slots and len(held) < self.slots:
+      job = heapq.heappop(self.pending)[2]
+      if job.status != PENDING:
+        continue #cancelled
+      running = self.running.values()
+      if self.admit(job, running, self.npending) or not running:
+        self.npending -= 1
+        self.launch(job)
+      else:
+        held.append(job)
+    for job in held:
+      heapq.heappush(self.pending, (-job.priority, job.id, job))
+
+  def launch(self, job):
+    if self.logdir is not None:
+      job.log = os.path.join(self.logdir, "%04d_%s.log" % (job.id, re.sub("[^a-zA-Z0-9_.-]", "_", job.name)))
+      job.logfd = open(job.log, 'w')
+    job.status = RUNNING
+    job.start = time.time()
+    job.fork()
+    self.running[job.fd] = job
+    self.poll.register(job.fd, select.POLLIN)
+
+  def reap(self, job, status=None):
+    '''the job's child has exited (status) or closed its output'''
+    del self.running[job.fd]
+    self.poll.unregister(job.fd)
+    while True:
+      try:
+        data = os.read(job.fd, 65536)
+      except OSError:
+        break
+      if not data:
+        break
+      job.write(data)
+    os.close(job.fd)
+    job.fd = None
+    if status is None:
+      status = os.waitpid(job.pid, 0)[1]
+    job.rv = status
+    job.end = time.time()
+    if job.status == RUNNING:
+      if status == 0:
+        job.status = PASSED
+      else:
+        job.status = FAILED
+    if job.logfd is not None:
+      job.logfd.close()
+      job.logfd = None
+    self.done(job)
+
+  def done(self, job):
+    self.counts[job.status] += 1
+    self.finished.append(job)
+
+  def wait(self):
+    try:
+      events = self.poll.poll(int(POLL_SEC*1000))
+    except select.error, e:
+      if e.args[0] == errno.EINTR:
+        return
+      raise
+    for fd, event in events:
+      job = self.running[fd]
+      data = ''
+      if event & select.POLLIN:
+        data = os.read(fd, 65536)
+      if data:
+        job.write(data)
+      else:
+        self.reap(job)
+    if not events:
+      for job in self.running.values():
+        pid, status = os.waitpid(job.pid, os.WNOHANG)
+        if pid:
+          self.reap(job, status)
+
+  def run(self):
+    '''run the submitted jobs, yielding each as it finishes'''
+    try:
+      while self.npending or self.running or self.finished:
+        self.startjobs()
+        if not self.finished:
+          self.wait()
+        while self.finished:
+          yield self.finished.popleft()
+    except BaseException:
+      self.cancelAll()
+      raise
+
+  def remaining(self):
+    return self.npending+len(self.running)
+
+  def summary(self):
+    return {'slots'   : self.slots,
+            'start'   : self.t0,
+            'wall'    : time.time()-self.t0,
+            'counts'  : dict(self.counts),
+            'jobs'    : map(Job.summary, self.jobs)}
+
+  def writeSummary(self, path):
+    '''per job durations and statuses as json'''
+    fd = open(path, 'w')
+    json.dump(self.summary(), fd, indent=2)
+    fd.close()
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+import os, sqlite3, time, json, socket
+import inputlibrary
+import pbutil
+from tunerconfig import config
+
+class MeasurementCache:
+  '''
+  on-disk store of raw trial results shared between tuning sessions, keyed
+  by (binary, config fingerprint, input size, input id)
+  '''
+  def __init__(self, path, maxrows=None):
+    self.db = sqlite3.connect(path)
+    self.db.execute('''CREATE TABLE IF NOT EXISTS trials (
+                         binary  TEXT,
+                         config  TEXT,
+                         n       INTEGER,
+                         input   TEXT,
+                         results TEXT,
+                         timeout REAL,
+                         used    REAL,
+                         PRIMARY KEY (binary, config, n, input))''')
+    self.db.commit()
+    if maxrows:
+      self.evict(maxrows)
+
+  def lookup(self, key):
+    '''
+    returns (results, timeout) where results maps metric name to value and
+    timeout is the time limit that was hit (or None), or None on a miss
+    '''
+    row = self.db.execute('''SELECT results, timeout FROM trials
+                             WHERE binary=? AND config=? AND n=? AND input=?''', key).fetchone()
+    if row is None:
+      return None
+    self.db.execute('''UPDATE trials SET used=?
+                       WHERE binary=? AND config=? AND n=? AND input=?''', (time.time(),)+tuple(key))
+    self.db.commit()
+    return json.loads(row[0]), row[1]
+
+  def store(self, key, results, timeout=None):
+    self.db.execute('INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    tuple(key)+(json.dumps(results), timeout, time.time()))
+    self.db.commit()
+
+  def evict(self, maxrows):
+    '''drop the least recently used rows until at most maxrows remain'''
+    count = self.db.execute('SELECT COUNT(*) FROM trials').fetchone()[0]
+    if count > maxrows:
+      self.db.execute('''DELETE FROM trials WHERE rowid IN
+                         (SELECT rowid FROM trials ORDER BY used ASC LIMIT ?)''', (count-maxrows,))
+      self.db.commit()
+
+  def __len__(self):
+    return self.db.execute('SELECT COUNT(*) FROM trials').fetchone()[0]
+
+def binaryKey(path, threads, slots):
+  '''identifies a binary and the machine setup it was timed on'''
+  return "%s %s threads=%d slots=%d" % (pbutil.fileHash(path), socket.gethostname(), threads, slots)
+
+_cache = None
+def cache():
+  '''the shared MeasurementCache, or None if disabled'''
+  global _cache
+  enabled = config.measurement_cache
+  if enabled is None:
+    #trials on inputs that are not kept can't be matched to later sessions
+    enabled = inputlibrary.library() is not None
+  if not enabled or config.check:
+    return None
+  if _cache is None:
+    d = os.path.expanduser(config.output_dir)
+    if not os.path.isdir(d):
+      os.makedirs(d)
+    _cache = MeasurementCache(os.path.join(d, 'measurements.db'), config.measurement_cache_rows)
+  return _cache
+
@@ -0,0 +1,342 @@
+#!/usr/bin/python
+'''
+a stand in for a compiled benchmark, for measuring the tuner itself
+
+it takes the same command line as a binary built by pbc and prints the
+same xml, but reports times from a synthetic cost model of the config
+instead of running anything
+
+  mockbenchmark.py create PATH [MODEL]  write PATH, PATH.info, PATH.cfg and
+                                        PATH.model (json, default MODEL below)
+  PATH [benchmark options]              behave like a benchmark binary
+
+if $MOCKBENCHMARK_LOG is set, the number of timing trials of each run is
+appended to it
+'''
+import json, math, os, random, stat, sys, time
+from configtool import ConfigFile
+
+MAXINT = 2147483647
+MAXVAL = sys.float_info.max
+FMT_CUTOFF = "%s_%d_lvl%d_cutoff"
+FMT_RULE   = "%s_%d_lvl%d_rule"
+
+#rules cost fixed + a*n**e seconds, plus recursive calls on n/recursive
+DEFAULT_MODEL = {
+  'main'   : 'MockSort',
+  'levels' : 4,
+  'noise'  : 0.05,   #stddev of the log of each trial's time
+  'sleep'  : 0.0,    #fraction of the modeled time to actually sleep
+  'transforms' : [
+    {'name'  : 'MockSort',
+     'sites' : [[{'a': 2.0e-9, 'e': 2.0},
+                 {'a': 1.5e-8, 'e': 1.0, 'recursive': 2},
+                 {'a': 1.0e-8, 'e': 1.0, 'recursive': 2, 'fixed': 2.0e-6},
+                 {'a': 4.0e-8, 'e': 1.0, 'fixed': 1.0e-4}]],
+     'tunables' : [
+       {'name': 'MockSort_blocksize', 'type': 'user.tunable',
+        'initial': 16, 'min': 1, 'max': 4096, 'best': 256, 'weight': 0.05},
+       {'name': 'MockSort_splitsize', 'type': 'system.cutoff.splitsize',
+        'initial': 64, 'min': 1, 'max': MAXINT, 'best': 2048, 'weight': 0.02}],
+     'calls' : ['MockMerge']},
+    {'name'  : 'MockMerge',
+     'sites' : [[{'a': 3.0e-9, 'e': 1.0},
+                 {'a': 1.0e-9, 'e': 1.0, 'fixed': 5.0e-5}]],
+     'tunables' : [],
+     'calls' : []},
+  ],
+}
+
+class CostModel:
+  def __init__(self, model):
+    self.model = model
+    self.levels = model['levels']
+    self.transforms = dict(map(lambda t: (t['name'], t), model['transforms']))
+
+  def rule(self, cfg, tx, site, n):
+    '''the rule the generated decision tree picks for input size n'''
+    rules = self.transforms[tx]['sites'][site]
+    lvl = self.levels
+    for l in xrange(1, self.levels):
+      if n < cfg.get(FMT_CUTOFF % (tx, site, l+1), MAXINT):
+        lvl = l
+        break
+    r = int(cfg.get(FMT_RULE % (tx, site, lvl), 0))
+    return rules[max(0, min(r, len(rules)-1))]
+
+  def penalty(self, cfg, tx):
+    '''slowdown from tunables away from their best value'''
+    p = 1.0
+    for t in self.transforms[tx]['tunables']:
+      v = max(1.0, float(cfg.get(t['name'], t['initial'])))
+      p += t.get('weight', 0.0)*math.log(v/t['best'], 2)**2
+    return p
+
+  def time(self, cfg, tx, n, memo=None):
+    if memo is None:
+      memo = dict()
+    if (tx, n) in memo:
+      return memo[(tx, n)]
+    #tunables slow down the work of this call, not that of the calls it makes
+    t = 0.0
+    for site in xrange(len(self.transforms[tx]['sites'])):
+      r = self.rule(cfg, tx, site, n)
+      t += r.get('fixed', 0.0) + r['a']*n**r.get('e', 1.0)
+    t *= self.penalty(cfg, tx)
+    for site in xrange(len(self.transforms[tx]['sites'])):
+      k = self.rule(cfg, tx, site, n).get('recursive', 0)
+      if k and n > 1:
+        t += k*self.time(cfg, tx, n/k, memo)
+    for c in self.transforms[tx]['calls']:
+      t += self.time(cfg, c, n, memo)
+    memo[(tx, n)] = t
+    return t
+
+  def accuracy(self, cfg, tx, n):
+    rules = map(lambda s: self.rule(cfg, tx, s, n), xrange(len(self.transforms[tx]['sites'])))
+    return min([1.0] + map(lambda r: r.get('accuracy', 1.0), rules))
+
+  def sample(self, cfg, tx, n):
+    return self.time(cfg, tx, n)*math.exp(random.gauss(0.0, self.model['noise']))
+
+  def defaults(self):
+    '''(name, value, type, min, max) of each entry of a reset config'''
+    rv = []
+    for tx in self.model['transforms']:
+      for site, rules in enumerate(tx['sites']):
+        for lvl in xrange(1, self.levels+1):
+          rv.append((FMT_RULE % (tx['name'], site, lvl), 0, 'algchoice.alg', 0, len(rules)))
+          if lvl < self.levels:
+            rv.append((FMT_CUTOFF % (tx['name'], site, lvl+1), MAXINT, 'algchoice.cutoff', 1, MAXINT))
+      for t in tx['tunables']:
+        rv.append((t['name'], t['initial'], t['type'], t['min'], t['max']))
+    return rv
+
+  def writeConfig(self, path):
+    fd = open(path, 'w')
+    for name, val, typ, lo, hi in self.defaults():
+      fd.write("%s = %d     # int, valid range: %d to %d\n" % (name, val, lo, hi))
+    fd.close()
+
+  def writeInfo(self, path):
+    fd = open(path, 'w')
+    fd.write("<traininginfo>\n")
+    fd.write("  <global>\n  </global>\n")
+    defaults = self.defaults()
+    for tx in self.model['transforms']:
+      fd.write('  <transform  name="%s" templateName="%s" isTemplateInstance="no"'
+               ' templateChoice="-1" isVariableAccuracy="0" accuracyTarget="0">\n'
+               % (tx['name'], tx['name']))
+      for site, rules in enumerate(tx['sites']):
+        fd.write('    <algchoice  name="%s_%d" rules="%d" />\n' % (tx['name'], site, len(rules)))
+      for name, val, typ, lo, hi in defaults:
+        if name.startswith(tx['name']+'_'):
+          fd.write('    <tunable name="%s" type="%s" initial="%d" min="%d" max="%d" />\n'
+                   % (name, typ, val, lo, hi))
+      for c in tx['calls']:
+        fd.write('    <calls caller="%s" callee="%s" />\n' % (tx['name'], c))
+      fd.write("  </transform>\n")
+    fd.write("</traininginfo>\n")
+    fd.close()
+
+def create(path, model=DEFAULT_MODEL):
+  '''write a mock benchmark binary at path, with its .info, .cfg and .model files'''
+  path = os.path.abspath(path)
+  m = CostModel(model)
+  fd = open(path+'.model', 'w')
+  json.dump(model, fd, indent=2)
+  fd.close()
+  m.writeInfo(path+'.info')
+  m.writeConfig(path+'.cfg')
+  fd = open(path, 'w')
+  fd.write('#!/bin/sh\nexec "%s" "%s" --model="%s" "$@"\n'
+           % (sys.executable, os.path.abspath(__file__), path+'.model'))
+  fd.close()
+  os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+  return path
+
+def statsxml(tag, data):
+  if not data:
+    return ""
+  s = sorted(data)
+  mean = sum(s)/len(s)
+  var = sum(map(lambda x: (x-mean)**2, s))/len(s)
+  mid = (len(s)-1)/2.0
+  median = s[int(math.ceil(mid))]/2.0+s[int(math.floor(mid))]/2.0
+  return ('    <%s count="%d" average="%.15g" min="%.15g" max="%.15g" median="%.15g"'
+          ' variance="%.15g" stddev="%.15g" samples="%s" />\n'
+          % (tag, len(s), mean, s[0], s[-1], median, var, math.sqrt(var),
+             ' '.join(map(lambda x: "%.15g" % x, data))))
+
+class MockRun:
+  def __init__(self, model, args):
+    self.model = model
+    self.args = args
+
+  def opt(self, k, default=None, fn=str):
+    if k in self.args:
+      return fn(self.args[k])
+    return default
+
+  def config(self, path):
+    if path is None or path == 'None' or not os.path.isfile(path):
+      return dict()
+    return ConfigFile(path)
+
+  def transform(self):
+    return self.opt('transform', self.model.model['main'])
+
+  def checkInput(self, pfx):
+    if not os.path.isfile(pfx+'_in0.dat'):
+      sys.stderr.write("missing input %s\n" % pfx)
+      sys.exit(1)
+
+  def log(self, trials):
+    if os.environ.get('MOCKBENCHMARK_LOG'):
+      fd = open(os.environ['MOCKBENCHMARK_LOG'], 'a')
+      fd.write("%d\n" % trials)
+      fd.close()
+
+  def trials(self, cfg, n, count, maxsec, pfx=None):
+    '''the xml printed by --time/--accuracy for count trials of cfg'''
+    timings = []
+    accuracies = []
+    for i in xrange(count):
+      t = self.model.sample(cfg, self.transform(), n)
+      if self.model.model['sleep'] > 0:
+        time.sleep(min(t*self.model.model['sleep'], maxsec))
+      if t > maxsec:
+        timings.append(MAXVAL)
+        break
+      timings.append(t)
+      accuracies.append(self.model.accuracy(cfg, self.transform(), n))
+    self.log(len(timings))
+    o = "<root>\n  <stats>\n"
+    if 'accuracy' in self.args:
+      o += statsxml('accuracy', accuracies)
+    o += statsxml('timing', timings)
+    if 'hash' in self.args:
+      o += '    <outputhash value="0x%016x" />\n' % (hash((n, pfx)) & 0xffffffffffffffff)
+    return o + "  </stats>\n</root>\n"
+
+  def n(self):
+    if 'iogen-run' in self.args:
+      self.checkInput(self.args['iogen-run'])
+      return self.opt('iogen-n', 1, int)
+    return self.opt('n', 1, int)
+
+  def run(self):
+    maxsec = self.opt('max-sec', MAXVAL, float)
+    if 'reset' in self.args:
+      self.model.writeConfig(self.opt('config'))
+    elif 'name' in self.args:
+      print self.model.model['main']
+    elif 'iogen-create' in self.args:
+      pfx = self.args['iogen-create']
+      if 'iogen-count' in self.args:
+        pfxs = map(lambda i: pfx+str(i), xrange(self.opt('iogen-count', 1, int)))
+      else:
+        pfxs = [pfx]
+      for p in pfxs:
+        for f in ('_in0.dat', '_out0.dat'):
+          open(p+f, 'w').write("%d\n" % self.opt('n', 1, int))
+    elif 'race-with' in self.args:
+      self.race(maxsec)
+    elif 'serve' in self.args:
+      self.serve()
+    elif 'autotune' in self.args:
+      self.autotune(maxsec)
+    else:
+      sys.stdout.write(self.trials(self.config(self.opt('config')), self.n(),
+                                   self.opt('trials', 1, int), maxsec, self.opt('iogen-run')))
+
+  def race(self, maxsec):
+    n = self.n()
+    results = []
+    for path in (self.opt('config'), self.args['race-with']):
+      if path == 'None':
+        results.append((MAXVAL, -MAXVAL))
+      else:
+        cfg = self.config(path)
+        results.append((self.model.sample(cfg, self.transform(), n),
+                        self.model.accuracy(cfg, self.transform(), n)))
+    #the slower racer is stopped once it runs past a multiple of the faster one
+    t, acc = min(results)
+    if acc >= self.opt('race-accuracy', -MAXVAL, float):
+      limit = min(maxsec, t*self.opt('race-multiplier', 1.0, float))
+    else:
+      limit = min(maxsec, t*self.opt('race-multiplier-lowacc', 1.0, float))
+    self.log(len(filter(lambda r: r[0] < MAXVAL, results)))
+    print "<raceresult>"
+    for label, (t, acc) in enumerate(results):
+      if t > limit:
+        t, acc = MAXVAL, -MAXVAL
+      print ('<testresult label="%d" timing="%.15g" accuracy="%.15g" crashed="0" hash="0" />'
+             % (label, t, acc))
+    print "</raceresult>"
+
+  def serve(self):
+    while True:
+      line = sys.stdin.readline()
+      if not line:
+        break
+      req = dict(map(lambda kv: kv.split('=', 1), line.split()))
+      cfg = self.config(req.get('config', self.opt('config')))
+      if 'iogen-run' in req:
+        self.checkInput(req['iogen-run'])
+        n = int(req.get('iogen-n', 1))
+      else:
+        n = int(req['n'])
+      sys.stdout.write(self.trials(cfg, n, int(req.get('trials', 1)),
+                                   float(req.get('max-sec', MAXVAL)), req.get('iogen-run')))
+      sys.stdout.flush()
+
+  def autotune(self, maxsec):
+    '''a rough stand in for the runtime's --autotune mode, tunes lvl1 of one choice site'''
+    path = self.opt('config')
+    cfg = ConfigFile(path)
+    tx = self.opt('autotune-transform', self.transform())
+    site = self.opt('autotune-site', 0, int)
+    if site < 0 or site >= len(self.model.transforms[tx]['sites']):
+      return
+    key = FMT_RULE % (tx, site, 1)
+    n = 1
+    it = 0
+    while n <= self.opt('max', 4096, int):
+      it += 1
+      print "BEGIN ITERATION %d / %d" % (it, n)
+      best = None
+      for r in xrange(len(self.model.transforms[tx]['sites'][site])):
+        print "  * TRY %s = %d" % (key, r)
+        cfg[key] = r
+        t = self.model.sample(cfg, self.transform(), n)
+        self.log(1)
+        if t < maxsec and (best is None or t < best[0]):
+          best = (t, r)
+      if best is not None:
+        cfg[key] = best[1]
+        print "SLOT[0] KEEP %s = %d = %.6f" % (key, best[1], best[0])
+      n *= 2
+    cfg.save(path)
+
+def main(argv):
+  if len(argv) >= 3 and argv[1] == 'create':
+    model = DEFAULT_MODEL
+    if len(argv) > 3:
+      model = json.load(open(argv[3]))
+    print create(argv[2], model)
+    return
+  args = dict()
+  for a in argv[1:]:
+    if a.startswith('--'):
+      if '=' in a:
+        k, v = a[2:].split('=', 1)
+      else:
+        k, v = a[2:], None
+      args[k] = v
+  model = CostModel(json.load(open(args.pop('model'))))
+  MockRun(model, args).run()
+
+if __name__ == "__main__":
+  main(sys.argv)
+
@@ -350,6 +350,7 @@ def main(argv):
   parser.add_option("--trials-sec", type="float", dest="trialssec", default=None)
   parser.add_option("--trials-max", type="int", dest="trialsmax", default=None)
   parser.add_option("--transform", dest="transform", default=None)
+  parser.add_option("--nocompile", action="store_true", dest="nocompile", default=False)
   options,args = parser.parse_args()
 
   if len(args) != 1:
@@ -359,9 +360,11 @@ def main(argv):
   app=args[0]
 
   pbutil.chdirToPetabricksRoot()
-  pbutil.compilePetabricks()
+  if not options.nocompile:
+    pbutil.compilePetabricks()
   app = pbutil.normalizeBenchmarkName(app)
-  pbutil.compileBenchmarks([app])
+  if not options.nocompile:
+    pbutil.compileBenchmarks([app])
   
   if options.debug:
     substderr = sys.__stderr__
@@ -12,6 +12,7 @@ import numpy
 import storagedirs
 import configtool
 import random
+import tracing
 from tunerconfig import config, option_callback
 from candidatetester import Candidate, CandidateTester, MutatorLogFile
 from traininginfo import TrainingInfo
@@ -40,6 +41,12 @@ getacc      = lambda c: c.metrics[config.accuracy_metric_idx][config.n].mean()
 lastacc     = lambda c: c.metrics[config.accuracy_metric_idx][config.n].last() 
 lasttime    = lambda c: c.metrics[config.timing_metric_idx][config.n].last() 
 parentlimit = lambda c: c.metrics[config.timing_metric_idx][config.n].dataDistribution().ppf(0.70)
+def getmem(c):
+  '''mean peak memory, 0 if it could not be measured'''
+  m = c.metrics[config.memory_metric_idx][config.n]
+  if len(m) == 0:
+    return 0.0
+  return m.mean()
 def getconf(c):
   if c.numTests(config.n) > 1:
     return 1+c.metrics[config.timing_metric_idx][config.n].invstderr()+\
@@ -47,6 +54,17 @@ def getconf(c):
   else:
     return 1
 
+def measureMemory(tester, c, limit):
+  '''
+  races run both configs in one process, so peak memory needs a run of its
+  own, returns False if that run timed out; a run without resource usage
+  (use_server) adds no sample and the config counts as within the memory
+  budget, as in withinMemoryBudget
+  '''
+  if config.memory_metric_idx is None:
+    return True
+  return tester.testMemory(c, limit)
+
 
 lastMutatorId = 0
 class MutatorLogEntry:
@@ -117,9 +135,13 @@ class OnlinePopulation:
     self.fns = []
     self.n = config.n
     self.wt = (1.0, 1.0, 1.0)
+    self.memwt = 1.0
     for c in (0.0, 0.3, 0.6):
       for b in pctrange(25):
         self.fns.append(self.linearFitness(1.0-b, b, c))
+    if config.memory_metric_idx is not None:
+      for d in pctrange(5)[1:]:
+        self.fns.append(self.memoryFitness(1.0-d, d))
     if config.accuracy_target is not None:
       for t in (config.accuracy_target*0.90,
                 config.accuracy_target*0.95,
@@ -143,6 +165,16 @@ class OnlinePopulation:
       return lambda c: self.wt[0]*a*gettime(c) - self.wt[1]*b*getacc(c)
     return lambda c: self.wt[0]*a*gettime(c) - self.wt[1]*b*getacc(c) - self.wt[2]*cw*getconf(c)
   
+  def memoryFitness(self, a, d):
+    return lambda c: self.wt[0]*a*gettime(c) + self.memwt*d*getmem(c)
+
+  def affordable(self, members):
+    '''members within the memory budget, all of them if none are'''
+    t = filter(lambda x: x.withinMemoryBudget(self.n), members)
+    if len(t):
+      return t
+    return members
+
   def thresholdAccuracyFitness(self, target, mult=config.threshold_multiplier_default):
     def fitness(c):
       t=gettime(c)
@@ -171,19 +203,23 @@ class OnlinePopulation:
   def prune(self):
     for m in self.members:
       m.keep = False
+    t = self.affordable(self.members)
     for fn in self.fns:
-      m = min(self.members, key=fn)
+      m = min(t, key=fn)
       m.keep = True
+    if config.memory_budget is not None:
+      #keep the leanest candidate, to search back under the budget from
+      min(self.members, key=getmem).keep = True
     self.members = filter(lambda x: x.keep, self.members)
     self.members.sort(key=self.linearFitness(1,0,0))
 
   def select(self, fn):
     if len(self.members)<=1:
       return self.members[0]
-    return min(self.members, key=fn)
+    return min(self.affordable(self.members), key=fn)
 
   def choice(self, timelimit, fn):
-    return weightedChoice(filter(lambda x: gettime(x)<=timelimit, self.members), fn)
+    return weightedChoice(filter(lambda x: gettime(x)<=timelimit, self.affordable(self.members)), fn)
 
   def output(self, active=[]):
     for m in self.members:
@@ -198,6 +234,8 @@ class OnlinePopulation:
          abs(sum(map(getconf, self.members))))
     t = sum(s)
     self.wt = map(lambda x: t/x, s)
+    if config.memory_metric_idx is not None and sum(map(getmem, self.members)) != 0:
+      self.memwt = t/abs(sum(map(getmem, self.members)))
     logging.debug("weights = "+str(self.wt))
 
   statsHeader = ['gen', 'pop_size', 'weight_time', 'weight_acc', 'weight_conf']
@@ -313,8 +351,8 @@ def createChoiceSiteMutatorsOnline(candidate, info, ac, weight):
           mutators.AddLevelChoiceSiteMutator(transform, number, weight=weight),
           mutators.RemoveLevelChoiceSiteMutator(transform, number, weight=weight)]
 
-def onlinelearnInner(benchmark):
-  candidate, tester = sgatuner.init(benchmark, createChoiceSiteMutatorsOnline)
+def onlinelearnInner(benchmark, newTester=CandidateTester):
+  candidate, tester = sgatuner.init(benchmark, createChoiceSiteMutatorsOnline, newTester=newTester)
   pop = OnlinePopulation()
   objectives = ObjectiveTuner(pop)
 
@@ -333,88 +371,97 @@ def onlinelearnInner(benchmark):
   try:
     timers.total.start()
 
-    '''seed first round'''
-    p = candidate
-    if config.online_baseline:
-      c = None
-    else:
-      c = p.clone()
-    if not tester.race(p, c):
-      raise Exception()
-    if not p.wasTimeout:
-      pop.add(p)
-    if c and not c.wasTimeout:
-      pop.add(c)
-
-    if not config.online_baseline:
-      mlog = MutatorLogFile(c.mutators)
-
-    '''now normal rounds'''  
-    for gen in itertools.count(1):
-      if config.max_time and objectives.elapsed>config.max_time:
-        break
-      if config.max_gen and gen>config.max_gen:
-        break
-      if gen%config.reweight_interval==0:
-        pop.reweight()
-
-      p = pop.select(objectives.fitness)
-      #s = pop.choice(parentlimit(p), getacc)
-      s = p
-
-      if config.fixed_safe_alg:
-        p = candidate
-
+    try:
+      '''seed first round'''
+      p = candidate
       if config.online_baseline:
         c = None
       else:
-        if(objectives.needAccuracy()):
-          mfilter = lambda x: x.accuracyHint
+        c = p.clone()
+      if not tester.race(p, c):
+        raise Exception()
+      if not p.wasTimeout and measureMemory(tester, p, None):
+        pop.add(p)
+      if c and not c.wasTimeout and measureMemory(tester, c, None):
+        pop.add(c)
+
+      if not config.online_baseline:
+        mlog = MutatorLogFile(c.mutators)
+
+      '''now normal rounds'''  
+      for gen in itertools.count(1):
+        if config.max_time and objectives.elapsed>config.max_time:
+          break
+        if config.max_gen and gen>config.max_gen:
+          break
+        tracing.begin('generation', 'tuner', {'gen': gen, 'n': config.n})
+        if gen%config.reweight_interval==0:
+          pop.reweight()
+
+        p = pop.select(objectives.fitness)
+        #s = pop.choice(parentlimit(p), getacc)
+        s = p
+
+        if config.fixed_safe_alg:
+          p = candidate
+
+        if config.online_baseline:
+          c = None
         else:
-          mfilter = lambda x: True
+          if(objectives.needAccuracy()):
+            mfilter = lambda x: x.accuracyHint
+          else:
+            mfilter = lambda x: True
         
-        c = s.cloneAndMutate(tester.n,
-                             adaptive = True,
-                             mutatorLog = mutatorLog,
-                             objectives = objectives,
-                             mutatorFilter = mfilter)
-      tlim, atarg = objectives.getlimits(p, s, c)
-      if tester.race(p, c, tlim, atarg) and not (p.wasTimeout and c.wasTimeout):
-        p.discardResults(config.max_trials)
-        if c and not c.wasTimeout:
-          pop.add(c)
-          pop.prune()
-
-        if c is None:
-          c=p
+          c = s.cloneAndMutate(tester.n,
+                               adaptive = True,
+                               mutatorLog = mutatorLog,
+                               objectives = objectives,
+                               mutatorFilter = mfilter)
+        tlim, atarg = objectives.getlimits(p, s, c)
+        if tester.race(p, c, tlim, atarg) and not (p.wasTimeout and c.wasTimeout):
+          p.discardResults(config.max_trials)
+          if c and not c.wasTimeout and measureMemory(tester, c, tlim):
+            pop.add(c)
+            pop.prune()
+
+          if c is None:
+            c=p
         
-        logging.debug("Child vs parent, better=%d, %f vs. %f" % (int(gettime(c) < gettime(p)), gettime(c), gettime(p)))
-        clog.writerow([gen, lasttime(p), lastacc(p), lasttime(c), lastacc(c)]
-                      +map(storagedirs.relpath,[p.cfgfile(), s.cfgfile(), c.cfgfile()]))
-
-        dtime = gettime(c) - gettime(p)
-        dacc = None if c.wasTimeout else (getacc(c) - getacc(p))
-
-        if c is not None:          
-          mutatorLog.add(c, dtime, dacc, gettime(c), None if c.wasTimeout else getacc(c));
-
-
-        if not config.online_baseline:
-          mlog.logPerformance(gen, gettime(c), "None" if c.wasTimeout else getacc(c), dtime, dacc, str(c.lastMutator));
-          mlog.logScores(gen, c.mutatorScores)
-
-        t,a = resultingTimeAcc(p, c)
-        print "Generation", gen, "elapsed",objectives.elapsed,"time", t,"accuracy",a, getconf(p)
-        print "Objectives", objectives
-        if a is not None and t is not None:
-          objectives.result(t,a)
-        pop.output((p,c,s))
-        ostats.writerow(objectives.stats(gen))
-        pstats.writerow(pop.stats(gen))
-      else:
-        print 'error'
+          logging.debug("Child vs parent, better=%d, %f vs. %f" % (int(gettime(c) < gettime(p)), gettime(c), gettime(p)))
+          clog.writerow([gen, lasttime(p), lastacc(p), lasttime(c), lastacc(c)]
+                        +map(storagedirs.relpath,[p.cfgfile(), s.cfgfile(), c.cfgfile()]))
+
+          dtime = gettime(c) - gettime(p)
+          dacc = None if c.wasTimeout else (getacc(c) - getacc(p))
+
+          if c is not None:          
+            mutatorLog.add(c, dtime, dacc, gettime(c), None if c.wasTimeout else getacc(c));
+
+
+          if not config.online_baseline:
+            mlog.logPerformance(gen, gettime(c), "None" if c.wasTimeout else getacc(c), dtime, dacc, str(c.lastMutator));
+            mlog.logScores(gen, c.mutatorScores)
+
+          t,a = resultingTimeAcc(p, c)
+          if config.print_log:
+            print "Generation", gen, "elapsed",objectives.elapsed,"time", t,"accuracy",a, getconf(p)
+            print "Objectives", objectives
+          if a is not None and t is not None:
+            objectives.result(t,a)
+          if config.print_log:
+            pop.output((p,c,s))
+          ostats.writerow(objectives.stats(gen))
+          pstats.writerow(pop.stats(gen))
+        else:
+          print 'error'
+        tracing.end()
+    except sgatuner.TrainingTimeout:
+      pass
 
     timers.total.stop()
+    if len(pop.members):
+      return pop.select(objectives.fitness)
   finally:
     at = storagedirs.getactivetimers()
     if len(at):
@@ -422,7 +469,7 @@ def onlinelearnInner(benchmark):
     tester.cleanup()
 
 def onlinelearn(benchmark):
-  storagedirs.callWithLogDir(lambda: onlinelearnInner(benchmark),
+  return storagedirs.callWithLogDir(lambda: onlinelearnInner(benchmark),
                              config.output_dir,
                              config.delete_output_dir)
 
@@ -433,6 +480,9 @@ if __name__ == "__main__":
   parser.add_option("--debug",
                     action="store_true", dest="debug", default=False,
                     help="enable debugging options")
+  parser.add_option("--memory_metric",
+                    action="store_true", dest="memory_metric", default=False,
+                    help="tune peak memory as an additional metric")
   parser.add_option("-n", type="int", help="input size to train for")
   parser.add_option("--max_time",        type="float",  action="callback", callback=option_callback)
   parser.add_option("--max_gen",         type="int",  action="callback", callback=option_callback)
@@ -446,11 +496,13 @@ if __name__ == "__main__":
   parser.add_option("--name",            type="string", action="callback", callback=option_callback)
   parser.add_option("--accuracy_target", type="float",  action="callback", callback=option_callback)
   parser.add_option("--timing_target",   type="float",  action="callback", callback=option_callback)
+  parser.add_option("--memory_budget",   type="float",  action="callback", callback=option_callback)
   parser.add_option("--use_bandit",      type="int",    action="callback", callback=option_callback)
   parser.add_option("--window_size",     type="int",    action="callback", callback=option_callback)
   parser.add_option("--bandit_c",        type="float",  action="callback", callback=option_callback)
   parser.add_option("--os_method",       type="int",    action="callback", callback=option_callback)
   parser.add_option("--threads",         type="int",    action="callback", callback=option_callback)
+  parser.add_option("--trace_timeline",  type="int",    action="callback", callback=option_callback)
 
   (options, args) = parser.parse_args()
   if len(args)!=1 or not options.n:
@@ -458,6 +510,8 @@ if __name__ == "__main__":
     sys.exit(1)
   if options.debug:
     tunerconfig.applypatch(tunerconfig.patch_debug)
+  if options.memory_metric:
+    config.memory_metric = True
   assert not (config.accuracy_target and config.timing_target)
   
   config.min_input_size = options.n
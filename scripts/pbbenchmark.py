@@ -1,8 +1,11 @@
 #!/usr/bin/python
 import pbutil, progress, tunerconfig, sgatuner, tunerwarnings
+import candidatetester, jobrunner, perfdb
+import json
 import math 
 import os
-import scipy
+import scipy, scipy.stats
+import shutil
 import socket 
 import sys
 import tempfile 
@@ -10,7 +13,10 @@ import csv
 import time
 import warnings
 
-TRAILS   = 5
+MIN_TRIALS    = 3     #trials of a measurement before checking its confidence interval
+CI_WIDTH      = 0.02  #stop once the confidence interval is within this fraction of the mean
+CI_CONFIDENCE = 0.95
+TRIAL_SEC     = 60.0  #or once a measurement has taken this long
 SHORTBAR = '-'*40
 LONGBAR  = '='*50
 VERSION  = "2.0"
@@ -52,11 +58,48 @@ def geomean(nums):
 def perfScore(perf, baseline):
   return 100.0*baseline/perf['average']
 
+def halfWidth(samples):
+  '''half width of the CI_CONFIDENCE confidence interval on the mean of samples'''
+  n = len(samples)
+  if n < 2:
+    return float('inf')
+  mean = sum(samples)/n
+  sd = math.sqrt(sum(map(lambda x: (x-mean)**2, samples))/(n-1))
+  return scipy.stats.t.ppf(0.5+CI_CONFIDENCE/2.0, n-1)*sd/math.sqrt(n)
+
+def trialsOf(result):
+  '''
+  the trial values of a pbutil.executeTimingRun result, binaries that don't
+  report samples only give a mean and stddev, which stand in for them
+  '''
+  if 'samples' in result:
+    return result['samples']
+  return perfdb.trialsOf(result['average'], result.get('stddev'), result.get('count', 1), None)
+
+def summarize(samples):
+  '''statistics of samples in the format of pbutil.executeTimingRun results'''
+  s = sorted(samples)
+  n = len(s)
+  mean = sum(s)/n
+  variance = sum(map(lambda x: (x-mean)**2, s))/n
+  mid = (n-1)/2.0
+  return {'count'   : n,
+          'average' : mean,
+          'min'     : s[0],
+          'max'     : s[-1],
+          'median'  : (s[int(math.ceil(mid))]+s[int(math.floor(mid))])/2.0,
+          'variance': variance,
+          'stddev'  : math.sqrt(variance),
+          'samples' : list(samples)}
+
 def fmtPerf(perf, baseline):
   baseline=100.0*baseline
   mean      = baseline/perf['average']
-  #meanprime = baseline/(perf['average']+perf['stddev']/math.sqrt(TRAILS))
-  meanprime = baseline/(perf['average']+perf['stddev'])
+  if perf.get('samples'):
+    err = halfWidth(perf['samples'])
+  else:
+    err = perf['stddev']
+  meanprime = baseline/(perf['average']+err)
   std  = mean-meanprime
   return "perf:%6.1f +- %2.0f" % (mean, std)
 
@@ -93,8 +136,14 @@ class Benchmark:
     self.tuned_acc  = None
     self.tuned_candidate = None
     self.tuning_time = 0.0
+    self.limits = []
     assert os.path.isfile(expandCfg(cfg))
 
+  def args(self):
+    '''constructor arguments, to recreate this benchmark in a job process'''
+    return [self.benchmark, self.cfg, str(self.n), repr(self.acc_target),
+            repr(self.baseline), repr(self.tuning_baseline)]
+
   def scoreFixed(self):
     return perfScore(self.fixed_perf, self.baseline)
   
@@ -105,13 +154,35 @@ class Benchmark:
     return 100.0*self.tuning_baseline/self.tuning_time
 
   def run(self, cfg):
-    return pbutil.executeTimingRun(pbutil.benchmarkToBin(self.benchmark),
-                                   int(self.n),
-                                   ['--trials=%d'%TRAILS,
-                                    '--config='+cfg,
-                                    '--accuracy'],
-                                   None,
-                                   ['timing', 'accuracy'])
+    '''
+    time cfg in batches of trials until the confidence interval on the mean
+    is within CI_WIDTH of it, or TRIAL_SEC have passed
+    '''
+    timing = []
+    accuracy = []
+    trials = MIN_TRIALS
+    start = time.time()
+    while True:
+      perf, acc = pbutil.executeTimingRun(pbutil.benchmarkToBin(self.benchmark),
+                                          int(self.n),
+                                          ['--trials=%d'%trials,
+                                           '--config='+cfg,
+                                           '--accuracy']+self.limits,
+                                          None,
+                                          ['timing', 'accuracy'])
+      timing.extend(trialsOf(perf))
+      accuracy.extend(trialsOf(acc))
+      mean = sum(timing)/len(timing)
+      w = halfWidth(timing)
+      elapsed = time.time()-start
+      if w <= CI_WIDTH*mean or elapsed >= TRIAL_SEC:
+        break
+      #the trials the interval needs to shrink enough, at most doubling the
+      #count, and no more than fit in the time left
+      need = (w/(CI_WIDTH*mean))**2*len(timing) - len(timing)
+      left = (TRIAL_SEC-elapsed)*len(timing)/max(elapsed, 1e-6)
+      trials = max(1, int(min(math.ceil(need), len(timing), left)))
+    return summarize(timing), summarize(accuracy)
   
   def runFixed(self):
     self.fixed_perf, self.fixed_acc = self.run(expandCfg(self.cfg))
@@ -155,6 +226,13 @@ class Benchmark:
     self.tuning_time += time.time()
 
 
+  def store(self, db, run):
+    '''add the results to a perfdb.PerfDB'''
+    db.store(run, self.benchmark, self.cfg, self.n, self.acc_target, 'fixed',
+             self.fixed_perf, self.fixed_acc)
+    db.store(run, self.benchmark, self.cfg, self.n, self.acc_target, 'tuned',
+             self.tuned_perf, self.tuned_acc, self.tuning_time)
+
   def logEntry(self):
     return {
         'name'                : self.benchmark,
@@ -177,7 +255,130 @@ class Benchmark:
 
 
 
+class BenchmarkJob:
+  '''
+  the fixed or tuned phase of one benchmark, run in a child pbbenchmark
+  process pinned to its own share of the cores and memory
+  '''
+  def __init__(self, benchmark, phase, tmpdir):
+    self.benchmark = benchmark
+    self.phase = phase
+    self.result = os.path.join(tempfile.mkdtemp(prefix="%s_%s_" % (benchmark.cfg.replace('.cfg',''), phase),
+                                                dir=tmpdir), 'result.json')
+
+  def cost(self):
+    '''expected run time, tuning dominates everything else'''
+    if self.phase == 'tuned':
+      return self.benchmark.tuning_baseline
+    return 0.0
+
+  def run(self, cpus, memoryshare):
+    '''(in the forked job) become the child pbbenchmark'''
+    cmd = pbutil.affinityPrefix(cpus) + [sys.executable, os.path.abspath(__file__),
+           '--job='+self.phase, '--threads=%d'%len(cpus), '--memory-share=%f'%memoryshare,
+           '--ci-width=%r'%CI_WIDTH, '--trial-sec=%r'%TRIAL_SEC,
+           '--result='+self.result, '--'] + self.benchmark.args()
+    os.execv(cmd[0], cmd)
+
+  def finish(self, job):
+    '''copy the results of the finished jobrunner.Job into its Benchmark'''
+    if job.rv != 0 or not os.path.isfile(self.result):
+      print "%s %s %s, output follows" % (fmtCfg(self.benchmark.cfg), self.phase, job.status.upper())
+      print job.getoutput()
+      return False
+    r = json.load(open(self.result))
+    if self.phase == 'fixed':
+      self.benchmark.fixed_perf, self.benchmark.fixed_acc = r['perf'], r['acc']
+    else:
+      self.benchmark.tuned_perf, self.benchmark.tuned_acc = r['perf'], r['acc']
+      self.benchmark.tuning_time = r['tuning_time']
+    return True
+
+def runParallel(benchmarks, slots, logdir=None):
+  '''
+  run the fixed and tuned phases of all benchmarks as concurrent jobs, each
+  on a disjoint share of the cores and of the memory, longest jobs first;
+  the output of each job and a summary.json of their durations are kept in
+  logdir, if given
+  '''
+  cpus = pbutil.partitionCpus(slots)
+  tmpdir = tempfile.mkdtemp(prefix='pbbenchmark_')
+
+  def admit(job, running, pending):
+    job.slot = min(set(range(len(cpus))) - set(map(lambda j: j.slot, running)))
+    return True
+
+  runner = jobrunner.JobRunner(len(cpus), logdir or tmpdir, admit)
+  jobs = dict() #job id -> BenchmarkJob
+  for phase in ('tuned', 'fixed'):
+    for b in benchmarks:
+      bj = BenchmarkJob(b, phase, tmpdir)
+      job = runner.submit(jobrunner.Job("%s_%s" % (b.cfg.replace('.cfg',''), phase),
+                                        (lambda bj: lambda job: bj.run(cpus[job.slot], 1.0/len(cpus)))(bj),
+                                        bj.cost()))
+      jobs[job.id] = bj
+  ok = True
+  progress.push()
+  progress.remainingTicks(len(runner.jobs))
+  try:
+    progress.status(lambda: "running %d jobs on %d slots, %d pending" % (len(runner.running), len(cpus), runner.npending))
+    for job in runner.run():
+      ok = jobs[job.id].finish(job) and ok
+      progress.tick()
+  finally:
+    if logdir is not None:
+      runner.writeSummary(os.path.join(logdir, 'summary.json'))
+    progress.pop()
+    shutil.rmtree(tmpdir, True)
+  return ok
+
+def runJob(phase, args, options):
+  '''
+  (internal) run one phase of one benchmark, in a process started by
+  runParallel, and write its results to options.result
+  '''
+  warnings.simplefilter('ignore', tunerwarnings.NewProgramCrash)
+  warnings.simplefilter('ignore', tunerwarnings.TargetNotMet)
+  warnings.simplefilter('ignore', tunerwarnings.NanAccuracy)
+  progress.disable()
+  pbutil.chdirToPetabricksRoot()
+  tunerconfig.config.threads = options.threads
+  tunerconfig.config.memory_limit_pct *= options.memory_share
+  b = Benchmark(*args)
+  b.limits = ['--threads=%d'%options.threads] + candidatetester.getMemoryLimitArgs()
+  if phase == 'fixed':
+    b.runFixed()
+    r = {'perf': b.fixed_perf, 'acc': b.fixed_acc}
+  else:
+    b.autotune()
+    b.runTuned()
+    r = {'perf': b.tuned_perf, 'acc': b.tuned_acc, 'tuning_time': b.tuning_time}
+  fd = open(options.result, 'w')
+  json.dump(r, fd)
+  fd.close()
+
 def main():
+  global CI_WIDTH, TRIAL_SEC
+  from optparse import OptionParser
+  parser = OptionParser(usage="usage: pbbenchmark.py [options]")
+  parser.add_option("--parallel", type="int", default=1,
+                    help="benchmarks to run at once, each on its own share of the cores and memory")
+  parser.add_option("--ci-width", type="float", default=CI_WIDTH,
+                    help="repeat trials until the confidence interval on the mean is within this fraction of it")
+  parser.add_option("--trial-sec", type="float", default=TRIAL_SEC,
+                    help="or until a measurement has taken this many seconds")
+  parser.add_option("--logdir", help="keep the output of each --parallel job and a summary.json of their durations here")
+  parser.add_option("--job", help="(internal) run one phase of the benchmark given as arguments")
+  parser.add_option("--threads", type="int", help="(internal) cores given to --job")
+  parser.add_option("--memory-share", type="float", default=1.0, help="(internal) memory share given to --job")
+  parser.add_option("--result", help="(internal) where --job writes its results")
+  (options, args) = parser.parse_args()
+  CI_WIDTH = options.ci_width
+  TRIAL_SEC = options.trial_sec
+  if options.job:
+    runJob(options.job, args, options)
+    return
+
   warnings.simplefilter('ignore', tunerwarnings.NewProgramCrash)
   warnings.simplefilter('ignore', tunerwarnings.TargetNotMet)
   warnings.simplefilter('ignore', tunerwarnings.NanAccuracy)
@@ -212,6 +413,12 @@ def main():
       baseline = (1.0, 1.0)
     benchmarks.append(Benchmark(benchmark, cfg, n, accTarg, baseline[0], baseline[1]))
 
+  start = time.time()
+  if options.parallel > 1:
+    progress.status("running %d benchmarks in parallel" % len(benchmarks))
+    if not runParallel(benchmarks, options.parallel, options.logdir):
+      print "benchmark jobs failed"
+      sys.exit(1)
 
   print LONGBAR
   print "Fixed (no autotuning) scores:"
@@ -219,8 +426,9 @@ def main():
   progress.remainingTicks(len(benchmarks)+3)
   progress.tick()
   for b in benchmarks:
-    progress.status("running fixed "+fmtCfg(b.cfg))
-    b.runFixed()
+    if b.fixed_perf is None:
+      progress.status("running fixed "+fmtCfg(b.cfg))
+      b.runFixed()
     b.printFixed()
   progress.tick()
   score_fixed = geomean(map(Benchmark.scoreFixed, benchmarks))
@@ -236,10 +444,11 @@ def main():
   print "Tuned scores:"
   print SHORTBAR
   for b in benchmarks:
-    progress.status("running tuned "+fmtCfg(b.cfg))
-    progress.status("autotuning")
-    b.autotune()
-    b.runTuned()
+    if b.tuned_perf is None:
+      progress.status("running tuned "+fmtCfg(b.cfg))
+      progress.status("autotuning")
+      b.autotune()
+      b.runTuned()
     b.printTuned()
     progress.tick()
   
@@ -249,6 +458,8 @@ def main():
   print SHORTBAR
   print "Tuned Score (pbbenchmark v%s): %.2f" % (VERSION, score_tuned)
   print "Training Time Score (pbbenchmark v%s): %.2f" % (VERSION, score_training_time)
+  print "Wall-clock time: %.0f sec (total tuning time %.0f sec, %d at once)" % (
+        time.time()-start, sum(map(lambda b: b.tuning_time, benchmarks)), max(1, options.parallel))
   print LONGBAR
   print
 
@@ -271,6 +482,11 @@ def main():
   
   for b in benchmarks:
     writelog(expandLog(b.cfg), b.logEntry())
+
+  db = perfdb.PerfDB(LOGDIR+'/results.db')
+  run = (TIMESTAMP, socket.gethostname(), perfdb.gitRevision())
+  for b in benchmarks:
+    b.store(db, run)
     
   writelog(expandLog('scores.log'), {
       'version'             : VERSION,
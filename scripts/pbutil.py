@@ -2,16 +2,22 @@
 
 import errno
 import getopt
+import hashlib
+import jobrunner
 import math
 import os
 import progress
 import re
 import select
+import shutil
 import signal
 import socket
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import tracing
 from xml.dom.minidom import parse,parseString
 from xml.dom import DOMException
 from pprint import pprint
@@ -49,6 +55,13 @@ def getmemorysize():
     sys.stderr.write("failed to get total memory\n")
     return 8 * (1024**3) # guess 8gb
 
+def getavailablememory():
+  '''bytes of memory that can be used without swapping'''
+  try:
+    return int(re.search("MemAvailable: *([0-9]+) *kB", open("/proc/meminfo").read()).group(1))*1024
+  except:
+    return getmemorysize()
+
 def setmemlimit(n = getmemorysize()):
   try:
     import resource
@@ -56,145 +69,127 @@ def setmemlimit(n = getmemorysize()):
   except:
     sys.stderr.write("failed to set memory limit\n")
 
-
-
-def parallelRunJobs(jobs):
-  class JobInfo:
-    def __init__(self, id, fn):
-      self.id=id
-      self.fn=fn
-      self.pid=None
-      self.fd=None
-      self.msg=""
-      self.rv=None
-    def __cmp__(this, that):
-      return this.id-that.id
-    def fileno(self):
-      return self.fd.fileno()
-    def forkrun(self):
-      self.fd, w = socket.socketpair()
-      self.pid = os.fork()
-      if self.pid == 0:
-        #child
-        progress.disable()
-        self.fd.close()
-        class Redir():
-          def __init__(self, fd):
-            self.fd=fd
-          def write(self, s):
-            self.fd.sendall(s)
-        sys.stdout = Redir(w)
-        try:
-          rv = self.fn()
-        except Exception, e:
-          #import traceback
-          #traceback.print_exc()
-          print "Exception:",e
-          rv = False
-        print exitval
-        if rv:
-          sys.exit(0)
-        else:
-          sys.exit(1)
-      else:
-        #parent
-        w.close()
-        self.fd.setblocking(0)
-        return self 
-    def handleevent(self):
-      if self.pid is None:
-        return None
-      try:
-        m=self.fd.recv(1024)
-        if m is not None:
-          self.msg+=m
-        if self.msg.rfind(exitval) >= 0:
-          raise Exception("done")
-      except:
-        pid, self.rv = os.waitpid(self.pid, 0)
-        assert self.pid == pid
-        self.pid = None
-        self.fd.close()
-        self.fd = None
-    def kill(self):
-      if self.pid is not None:
-        os.kill(self.pid, signal.SIGKILL)
-    def addmsg(self, msg):
-      self.msg+=msg
-    def getmsg(self):
-      return self.msg.replace(exitval,"") \
-                     .replace('\n',' ')   \
-                     .strip()
-    
-  startline = progress.currentline()
+def findExecutable(name):
+  for d in os.environ.get("PATH", "").split(os.pathsep):
+    p=os.path.join(d, name)
+    if os.path.isfile(p) and os.access(p, os.X_OK):
+      return p
+  return None
+
+_fileHashes = dict()
+def fileHash(path):
+  '''sha1 of a file's contents, cached until the file changes'''
+  st = os.stat(path)
+  k = (path, st.st_mtime, st.st_size)
+  if k not in _fileHashes:
+    h = hashlib.sha1()
+    fd = open(path, 'rb')
+    try:
+      for block in iter(lambda: fd.read(1<<20), ''):
+        h.update(block)
+    finally:
+      fd.close()
+    _fileHashes[k] = h.hexdigest()
+  return _fileHashes[k]
+
+def allowedCpus():
+  '''
+  the cpus this process may run on, from its affinity mask, which a cpuset,
+  a container or taskset (as in pbbenchmark --parallel) may have narrowed
+  '''
+  try:
+    for line in open("/proc/self/status"):
+      if line.startswith("Cpus_allowed_list:"):
+        cpus = []
+        for r in line.split(':', 1)[1].strip().split(','):
+          lo, hi = (r.split('-')+[r])[0:2]
+          cpus.extend(range(int(lo), int(hi)+1))
+        if cpus:
+          return cpus
+  except (IOError, ValueError):
+    pass
+  return range(cpuCount())
+
+def partitionCpus(slots, cpus=None):
+  '''split the allowed cpus into (at most) slots disjoint sets'''
+  if cpus is None:
+    cpus=allowedCpus()
+  slots=max(1, min(slots, len(cpus)))
+  per=len(cpus)/slots
+  return map(lambda i: cpus[i*per:(i+1)*per], xrange(slots))
+
+def affinityPrefix(cpus):
+  '''command prefix that pins a child process to the given cpus'''
+  taskset=findExecutable("taskset")
+  if taskset is None or not cpus:
+    return []
+  return [taskset, "-c", ",".join(map(str, cpus))]
+
+
+def parallelRunJobs(jobs, cost=lambda id: 0.0, memory=lambda id, cores: 0, names=None,
+                    logdir=None, summary=None):
+  '''
+  run each of jobs in a forked child, up to one per cpu at once, and print
+  their output in order; each job is called with the number of cores it may
+  use, its share of 2*cpus cores not taken by the running jobs
+  cost(id) estimates how long job id takes, longer jobs are started first
+  memory(id, cores) estimates its peak memory in bytes, jobs are held back
+  while they would not fit in the memory left by the running ones
+  the output of each job is also written to logdir, if given, and the
+  duration and status of each to the json file summary
+  returns the jobrunner.Job of each job, rv is 0 for those that passed
+  '''
   NCPU=cpuCount()
-  exitval="!EXIT!"
-  maxprinted=[0]
-
-  jobs_pending = map(lambda id: JobInfo(id, jobs[id]), xrange(len(jobs)))
-  jobs_running = []   # JobInfo list
-  jobs_done    = []   # JobInfo list
+  memfree = int(0.9*getavailablememory())
+
+  def admit(job, running, pending):
+    used = sum(map(lambda j: j.cores, running))
+    could = min(pending, NCPU-len(running))
+    job.cores = max(1, (2*NCPU-used)/could)
+    job.memory = memory(job.id, job.cores)
+    return sum(map(lambda j: j.memory, running))+job.memory <= memfree
+
+  runner = jobrunner.JobRunner(NCPU, logdir, admit)
+  for id in xrange(len(jobs)):
+    if names is None:
+      name = str(id)
+    else:
+      name = names[id]
+    runner.submit(jobrunner.Job(name, (lambda fn: lambda job: fn(job.cores))(jobs[id]), cost(id)))
+  printed=[0]
 
   def mkstatus():
     s="running jobs: "
-    failed=len(filter(lambda x: x.rv!=0, jobs_done))
-    complete=(len(jobs_done)-failed)
+    failed=runner.counts[jobrunner.FAILED]+runner.counts[jobrunner.CANCELLED]
+    complete=runner.counts[jobrunner.PASSED]
     if complete>0:
       s += "%d complete, "%complete
     if failed>0:
       s += "%d failed, "%failed
-    s += "%d running, "%len(jobs_running)
-    s += "%d pending"%len(jobs_pending)
+    s += "%d running, "%len(runner.running)
+    s += "%d pending"%runner.npending
     return s
-  def updatestatus(fast=False):
-    progress.remaining(2*len(jobs_pending)+len(jobs_running))
-    if not fast:
-      for j in jobs_done[maxprinted[0]:]:
-        if j.id==maxprinted[0]:
-          print j.getmsg()
-          maxprinted[0]+=1
-        else:
-          break
+  def updatestatus():
+    progress.remaining(2*runner.npending+len(runner.running))
+    while printed[0]<len(runner.jobs) and runner.jobs[printed[0]].end is not None:
+      print runner.jobs[printed[0]].getmsg()
+      printed[0]+=1
 
   progress.push()
   progress.status(mkstatus)
   updatestatus()
-
   try:
-    while len(jobs_pending)>0 or len(jobs_running)>0:
-      #spawn new jobs
-      while len(jobs_pending)>0 and len(jobs_running)<NCPU:
-        jobs_running.append(jobs_pending.pop(0).forkrun())
+    for j in runner.run():
       updatestatus()
-        
-      #wait for an event
-      rj, wj, xj = select.select(jobs_running, [], jobs_running)
-
-      #handle pending data
-      for j in rj:
-        j.handleevent()
-      for j in wj:
-        j.handleevent()
-      for j in xj:
-        j.handleevent()
-
-      #move completed jobs to jobs_done list
-      newdone=filter(lambda x: x.pid is None, jobs_running)
-      jobs_running = filter(lambda x: x.pid is not None, jobs_running)
-      jobs_done.extend(newdone)
-      jobs_done.sort()
-      updatestatus(True)
-  except KeyboardInterrupt:
-    for j in jobs_running:
-      j.kill()
-      j.addmsg("INTERRUPTED")
-    jobs_done.extend(jobs_running)
-    jobs_done.sort()
+  except:
+    runner.cancelAll()
     updatestatus()
     raise
-  updatestatus()
+  finally:
+    if summary is not None:
+      runner.writeSummary(summary)
   progress.pop()
-  return jobs_done
+  return runner.jobs
 
 def getscriptpath():
   try:
@@ -274,39 +269,153 @@ def normalizeBenchmarkName(orig, search=True):
       raise
 
 
-def compileBenchmarks(benchmarks):
+#shared store of compiled benchmarks, see BuildCache
+BUILD_CACHE = os.environ.get("PETABRICKS_BUILD_CACHE", os.path.expanduser("~/.petabricks/buildcache"))
+
+def sourceFiles(src, seen=None):
+  '''src and every file it #includes with quotes, recursively'''
+  if seen is None:
+    seen = []
+  src = os.path.normpath(src)
+  if src in seen or not os.path.isfile(src):
+    return seen
+  seen.append(src)
+  for m in re.finditer('^[ \t]*#include[ \t]*"([^"]+)"', open(src).read(), re.M):
+    sourceFiles(os.path.join(os.path.dirname(src), m.group(1)), seen)
+  return seen
+
+def buildKey(src, libdepends):
+  '''
+  identifies the binary pbc builds from src: a digest of the source and its
+  includes, of pbc, the runtime libraries and the preprocessor, and of the
+  compiler and flags, None if one of them can't be read
+  '''
+  try:
+    h = hashlib.sha1()
+    files = sourceFiles(src)
+    h.update(os.path.basename(src))
+    for f in files[1:]:
+      h.update(os.path.relpath(f, os.path.dirname(files[0])))
+    for f in files + libdepends + [os.path.join(getscriptpath(), "preprocessor.py")]:
+      h.update(fileHash(f))
+    h.update(getCXX())
+    h.update(getCXXFLAGS())
+    return h.hexdigest()
+  except (IOError, OSError, IndexError):
+    return None
+
+class BuildCache:
+  '''
+  compiled benchmark binaries and .info files keyed by buildKey, shared
+  between checkouts (and users) through the directory BUILD_CACHE
+  '''
+  def __init__(self, root=BUILD_CACHE):
+    self.root = root
+
+  def path(self, key):
+    return os.path.join(self.root, key[0:2], key)
+
+  def restore(self, key, bin, info):
+    '''copy a cached build to bin and info, returns False on a miss'''
+    d = self.path(key)
+    if not os.path.isfile(os.path.join(d, "info")):
+      return False
+    for f, dst in (("bin", bin), ("info", info)):
+      tmp = dst+".tmp%d"%os.getpid()
+      shutil.copy(os.path.join(d, f), tmp)
+      os.rename(tmp, dst)
+    return True
+
+  def store(self, key, bin, info):
+    d = self.path(key)
+    if os.path.isdir(d) or not os.path.isfile(info):
+      return
+    try:
+      if not os.path.isdir(os.path.dirname(d)):
+        os.makedirs(os.path.dirname(d))
+      #build the entry next to it and rename, so concurrent readers never see half of one
+      tmp = tempfile.mkdtemp(dir=os.path.dirname(d))
+      shutil.copy(bin, os.path.join(tmp, "bin"))
+      shutil.copy(info, os.path.join(tmp, "info"))
+      os.rename(tmp, d)
+    except (IOError, OSError), e:
+      sys.stderr.write("failed to store build in cache: %s\n" % e)
+
+class CompileHistory:
+  '''
+  wall time and peak memory of the last compile of each benchmark on this
+  host, one file per benchmark so that concurrent compiles can record theirs
+  '''
+  def __init__(self, root=os.path.join(BUILD_CACHE, "history", socket.gethostname())):
+    self.root = root
+
+  def path(self, name):
+    return os.path.join(self.root, re.sub("[^a-zA-Z0-9_.-]", "_", name))
+
+  def get(self, name):
+    '''(sec, peak kB of one compiler process), None if name was never compiled'''
+    try:
+      sec, maxrss = map(float, open(self.path(name)).read().split())
+      return sec, maxrss
+    except (IOError, ValueError):
+      return None
+
+  def record(self, name, sec, maxrss):
+    try:
+      if not os.path.isdir(self.root):
+        os.makedirs(self.root)
+      tmp = self.path(name)+".tmp%d"%os.getpid()
+      open(tmp, "w").write("%f %d\n" % (sec, maxrss))
+      os.rename(tmp, self.path(name))
+    except (IOError, OSError), e:
+      sys.stderr.write("failed to record compile time: %s\n" % e)
+
+def compileBenchmarks(benchmarks, logdir=None, summary=None):
   NULL=open("/dev/null","w")
   pbc="./src/pbc"
   libdepends=[pbc, "./src/libpbmain.a", "./src/libpbruntime.a", "./src/libpbcommon.a"]
   assert os.path.isfile(pbc)
   benchmarkMaxLen=0
-  jobs_per_pbc=max(1, 2*cpuCount() / len(benchmarks))
+  cache=BuildCache()
+  history=CompileHistory()
 
-  def compileBenchmark(name):
+  def compileBenchmark(name, jobs_per_pbc):
     print name.ljust(benchmarkMaxLen)
     src=benchmarkToSrc(name)
     bin=benchmarkToBin(name)
+    info=benchmarkToInfo(name)
     if not os.path.isfile(src):
       print "invalid benchmark"
       return False
-    srcModTime=max(os.path.getmtime(src), reduce(max, map(os.path.getmtime, libdepends)))
+    srcModTime=max(map(os.path.getmtime, sourceFiles(src)+libdepends))
     if os.path.isfile(bin) and os.path.getmtime(bin) > srcModTime:
       print "compile SKIPPED"
       return True
     else:
+      key = buildKey(src, libdepends)
+      if key is not None and cache.restore(key, bin, info):
+        print "compile CACHED"
+        return True
       if os.path.isfile(bin):
         os.unlink(bin)
+      start = time.time()
       p = subprocess.Popen([pbc, '--jobs='+str(jobs_per_pbc), src], stdout=NULL, stderr=NULL)
-      status = p.wait()
+      ru = goodwait4(p)
+      status = p.returncode
       if status == 0:
+        if ru is not None:
+          #maxrss is that of the largest single process, pbc or one of its compilers
+          history.record(name, time.time()-start, ru['maxrss'])
+        if key is not None:
+          cache.store(key, bin, info)
         print "compile PASSED"
         return True
       else:
         print "compile FAILED (rc=%d)"%status
         return False
   
-  newjob = lambda name, fn: lambda: compileBenchmark(name) and fn()
-  mergejob = lambda oldfn, fn: lambda: oldfn() and fn()
+  newjob = lambda name, fn: lambda cores: compileBenchmark(name, cores) and fn()
+  mergejob = lambda oldfn, fn: lambda cores: oldfn(cores) and fn()
 
   jobs=[]
   # build jobs list
@@ -322,11 +431,19 @@ def compileBenchmarks(benchmarks):
       jobs.append(name)
     else:
       jobsdata[name][0] = mergejob(jobsdata[name][0], fn)
+  names = jobs
   jobs = map(lambda n: mergejob(*jobsdata[n]), jobs)
 
-  return parallelRunJobs(jobs)
+  #benchmarks never compiled here are assumed to be as costly as the worst known
+  known = filter(lambda h: h is not None, map(history.get, names))
+  worst = (max(map(lambda h: h[0], known+[(0.0, 0)])), max(map(lambda h: h[1], known+[(0.0, 0)])))
+  estimate = lambda id: history.get(names[id]) or worst
+  cost = lambda id: estimate(id)[0]
+  memory = lambda id, cores: int(estimate(id)[1]*1024*cores)
+  return parallelRunJobs(jobs, cost, memory, names, logdir, summary)
 
-def loadAndCompileBenchmarks(file, searchterms=[], extrafn=lambda b: True, postfn=lambda b: True):
+def loadAndCompileBenchmarks(file, searchterms=[], extrafn=lambda b: True, postfn=lambda b: True,
+                             logdir=None, summary=None):
   chdirToPetabricksRoot()
   compilePetabricks()
   benchmarks=open(file)
@@ -342,7 +459,8 @@ def loadAndCompileBenchmarks(file, searchterms=[], extrafn=lambda b: True, postf
   for b in benchmarks:
     b[0]=normalizeBenchmarkName(b[0])
 
-  return compileBenchmarks(map(lambda x: (x[0], lambda: extrafn(x), lambda: postfn(x[0])), benchmarks)), benchmarks
+  return compileBenchmarks(map(lambda x: (x[0], lambda: extrafn(x), lambda: postfn(x[0])), benchmarks),
+                           logdir, summary), benchmarks
 
 def killSubprocess(p):
   if p.poll() is None:
@@ -351,6 +469,48 @@ def killSubprocess(p):
     except:
       os.kill(p.pid, signal.SIGTERM)
 
+def killProcessGroup(p):
+  '''
+  kill p and everything it started, p must have been started in its own
+  session (preexec_fn=os.setsid) and not been waited for yet, so that its
+  group can not have been reused
+  '''
+  if p.returncode is None:
+    try:
+      os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+      pass
+
+#process groups being waited for, and the thread waiting for each, so that
+#killRuns can stop the runs of other threads
+waiting = dict()
+waitingLock = threading.Lock()
+
+def trackRun(p):
+  waitingLock.acquire()
+  try:
+    waiting[p] = threading.currentThread()
+  finally:
+    waitingLock.release()
+
+def untrackRun(p):
+  '''must be called before p is reaped, after which its group id may be reused'''
+  waitingLock.acquire()
+  try:
+    waiting.pop(p, None)
+  finally:
+    waitingLock.release()
+
+def killRuns(threads):
+  '''kill the process groups the given threads are waiting for'''
+  waitingLock.acquire()
+  try:
+    for p, t in waiting.items():
+      if t in threads:
+        killProcessGroup(p)
+  finally:
+    waitingLock.release()
+
 def tryAorB(A, B):
   def tryAorBinst(x):
     try:
@@ -386,12 +546,42 @@ def goodwait(p):
       if e.errno != errno.EINTR:
         raise
 
+RUSAGE_FIELDS = ['utime', 'stime', 'maxrss', 'nvcsw', 'nivcsw', 'minflt', 'majflt']
+
+def goodwait4(p):
+  '''
+  like goodwait, but reaps p with os.wait4 and returns its resource usage
+  as a dict of RUSAGE_FIELDS (maxrss in kB), None if p was already reaped
+  '''
+  if p.returncode is not None:
+    return None
+  while True:
+    try:
+      pid, status, ru = os.wait4(p.pid, 0)
+      break
+    except OSError, e:
+      if e.errno == errno.ECHILD:
+        goodwait(p)
+        return None
+      if e.errno != errno.EINTR:
+        raise
+  if os.WIFSIGNALED(status):
+    p.returncode = -os.WTERMSIG(status)
+  else:
+    p.returncode = os.WEXITSTATUS(status)
+  return dict(map(lambda f: (f, getattr(ru, 'ru_'+f)), RUSAGE_FIELDS))
+
 def xmlToDict(xml, tag, fn=tryIntFloat, idx=0):
   try:
     rslt = xml.getElementsByTagName(tag)[idx].attributes
     attrs=dict()
     for x in xrange(rslt.length):
-      attrs[str(rslt.item(x).name)]=fn(rslt.item(x).nodeValue)
+      k=str(rslt.item(x).name)
+      if k=='samples':
+        #per trial values, space separated
+        attrs[k]=map(fn, rslt.item(x).nodeValue.split())
+      else:
+        attrs[k]=fn(rslt.item(x).nodeValue)
     return attrs
   except Exception,e:
     return None
@@ -407,49 +597,291 @@ def callAndWait(cmd):
     raise TimingRunFailed(p.returncode)
   return p
 
-#parse timing results with a given time limit
-def executeRun(cmd, returnTags=['timing', 'accuracy', 'outputhash'], retries=3):
-  p = callAndWait(cmd)
-  try:
-    xml = parse(p.stdout)
-  except Exception, e:
-    print 'program crash',e
-    if retries>1:
-      return executeRun(cmd, returnTags, retries-1)
-    else:
-      p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=NULL)
-      goodwait(p)
-      print p.stdout.read()
-      sys.exit(99)
-
+def parseResults(xml, returnTags, rusage=None):
+  '''
+  the tags 'rusage' and 'memory' (peak resident MB) in returnTags come from
+  the resource usage of the run, None if it is not known
+  '''
   timing = xmlToDict(xml, "timing")
   if timing['average'] > 2**31:
     raise TimingRunTimeout()
+  def get(t):
+    if t == 'rusage':
+      return rusage
+    if t == 'memory':
+      if rusage is None:
+        return None
+      return {'average': rusage['maxrss']/1024.0}
+    return xmlToDict(xml, t)
   if type(returnTags) is type(""):
-    return xmlToDict(xml, returnTags)
+    return get(returnTags)
   else:
-    return map(lambda t: xmlToDict(xml, t), returnTags)
+    return map(get, returnTags)
 
-def executeRaceRun(_cmd, configa, configb, retries=3):
-  cmd = _cmd + ['--config='+configa, '--race-with='+configb]
-  p = callAndWait(cmd)
-  try:
-    xml = parse(p.stdout)
-  except Exception, e:
-    print 'program crash',e
-    if retries>1:
-      return executeRaceRun(_cmd, configa, configb, retries-1)
+class RunCancelled(Exception):
+  pass
+
+class InvalidRunOutput(Exception):
+  '''the program exited cleanly but its output did not parse'''
+  def __init__(self, error, output):
+    self.error = error
+    self.output = output
+  def __str__(self):
+    return str(self.error)
+
+class PendingRun:
+  '''
+  a benchmark process started without blocking the caller, stdout is read
+  incrementally as it arrives and parsed with parsefn(xml, rusage) once the
+  process exits
+  '''
+  def __init__(self, cmd, parsefn, timeout=None):
+    self.cmd = cmd
+    self.parsefn = parsefn
+    self.output = []
+    self.result = None
+    self.error = None
+    self.rusage = None
+    self.done = False
+    if timeout is not None:
+      self.deadline = time.time()+timeout
     else:
-      p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=NULL)
-      goodwait(p)
-      print p.stdout.read()
-      sys.exit(99)
+      self.deadline = None
+    self.p = tracing.wrap('spawn', 'process',
+                          lambda: subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=NULL,
+                                                   preexec_fn=os.setsid),
+                          {'bin': os.path.basename(cmd[0])})
+    trackRun(self.p)
+
+  def fileno(self):
+    return self.p.stdout.fileno()
+
+  def timeleft(self):
+    if self.deadline is None:
+      return None
+    return max(0.0, self.deadline-time.time())
+
+  def handleevent(self):
+    '''read the output that is available, finishing the run on EOF'''
+    try:
+      m = os.read(self.fileno(), 65536)
+    except OSError, e:
+      if e.errno in (errno.EINTR, errno.EAGAIN):
+        return
+      raise
+    if m:
+      self.output.append(m)
+    else:
+      self.finish()
+
+  def finish(self, error=None):
+    if self.done:
+      return
+    untrackRun(self.p)
+    if error is not None:
+      #SubprocessTestIsolation children would keep running otherwise
+      killProcessGroup(self.p)
+    self.rusage = goodwait4(self.p)
+    self.p.stdout.close()
+    self.done = True
+    if error is not None:
+      self.error = error
+    elif self.p.returncode == -15:
+      self.error = TimingRunTimeout()
+    elif self.p.returncode != 0:
+      self.error = TimingRunFailed(self.p.returncode)
+    else:
+      tracing.wrap('parse xml', 'xml', self.parse)
+
+  def parse(self):
+    output = ''.join(self.output)
+    try:
+      xml = parseString(output)
+    except Exception, e:
+      self.error = InvalidRunOutput(e, output)
+      return
+    try:
+      self.result = self.parsefn(xml, self.rusage)
+    except Exception, e:
+      self.error = e
+
+  def cancel(self):
+    self.finish(RunCancelled())
+
+  def get(self):
+    '''result of a finished run, raises the exception if the run failed'''
+    assert self.done
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+  def wait(self):
+    while not self.done:
+      waitRuns([self])
+    return self.get()
+
+def waitRuns(runs, timeout=None):
+  '''
+  block until at least one of runs has finished, or until timeout seconds
+  pass, returns the list of finished runs, the runs are cancelled if the
+  wait is interrupted
+  '''
+  try:
+    return waitRunsInner(runs, timeout)
+  except BaseException:
+    #they are in their own sessions, so a ctrl-c would not reach them
+    for r in runs:
+      r.cancel()
+    raise
+
+def waitRunsInner(runs, timeout):
+  end = None
+  if timeout is not None:
+    end = time.time()+timeout
+  while True:
+    for r in runs:
+      if not r.done and r.timeleft() == 0.0:
+        r.finish(TimingRunTimeout())
+    done = filter(lambda r: r.done, runs)
+    pending = filter(lambda r: not r.done, runs)
+    if done or not pending:
+      return done
+    waits = filter(lambda x: x is not None, map(lambda r: r.timeleft(), pending))
+    if end is not None:
+      waits.append(max(0.0, end-time.time()))
+    try:
+      if waits:
+        rj, wj, xj = select.select(pending, [], [], min(waits))
+      else:
+        rj, wj, xj = select.select(pending, [], [])
+    except select.error, e:
+      if e.args[0] == errno.EINTR:
+        continue
+      raise
+    for r in rj:
+      r.handleevent()
+    if end is not None and time.time() >= end:
+      return filter(lambda r: r.done, runs)
+
+def startRun(cmd, returnTags=['timing', 'accuracy', 'outputhash'], timeout=None):
+  return PendingRun(cmd, lambda xml, rusage: parseResults(xml, returnTags, rusage), timeout)
+
+def parseRaceResults(xml):
   aresult = xmlToDict(xml, "testresult", tryIntFloat, 0)
   bresult = xmlToDict(xml, "testresult", tryIntFloat, 1)
   assert aresult['label']==0
   assert bresult['label']==1
   return aresult, bresult
 
+def startRaceRun(_cmd, configa, configb, timeout=None):
+  cmd = _cmd + ['--config='+configa, '--race-with='+configb]
+  return PendingRun(cmd, lambda xml, rusage: parseRaceResults(xml), timeout)
+
+def waitRetry(start, retries):
+  '''wait for the run made by start(), rerunning it if the output was garbled'''
+  try:
+    return start().wait()
+  except InvalidRunOutput, e:
+    print 'program crash',e
+    if retries>1:
+      return waitRetry(start, retries-1)
+    else:
+      print e.output
+      sys.exit(99)
+
+#parse timing results with a given time limit
+def executeRun(cmd, returnTags=['timing', 'accuracy', 'outputhash'], retries=3, timeout=None):
+  return waitRetry(lambda: startRun(cmd, returnTags, timeout), retries)
+
+class BenchmarkServer:
+  '''
+  a benchmark binary started with --serve, it answers one timing request per
+  line on stdin so config, inputs and process startup are not paid per trial
+  '''
+  def __init__(self, cmd):
+    self.cmd = list(cmd)
+    self.p = None
+
+  def start(self):
+    self.p = subprocess.Popen(self.cmd+['--serve'], stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, stderr=NULL, preexec_fn=os.setsid)
+
+  def stop(self):
+    if self.p is not None:
+      try:
+        self.p.stdin.close()
+      except IOError:
+        pass
+      killProcessGroup(self.p)
+      goodwait(self.p)
+      self.p = None
+
+  def running(self):
+    return self.p is not None and self.p.poll() is None
+
+  def request(self, args, timeout=None):
+    '''
+    send per-trial args such as --config=FILE and return the reply xml, the
+    server is killed if no reply came within timeout seconds
+    '''
+    if not self.running():
+      self.stop()
+      self.start()
+    end = None
+    if timeout is not None:
+      end = time.time()+timeout
+    reply = ''
+    trackRun(self.p)
+    try:
+      try:
+        self.p.stdin.write(' '.join(map(lambda a: a.lstrip('-'), args))+'\n')
+        self.p.stdin.flush()
+        fd = self.p.stdout.fileno()
+        while not reply.rstrip().endswith('</root>'):
+          if end is None:
+            rj = selectRetry([fd])
+          elif time.time() >= end:
+            raise TimingRunTimeout()
+          else:
+            rj = selectRetry([fd], max(0.0, end-time.time()))
+          if rj:
+            m = os.read(fd, 65536)
+            if not m:
+              raise IOError("server exited")
+            reply += m
+      finally:
+        untrackRun(self.p)
+    except (IOError, OSError), e:
+      self.stop()
+      raise TimingRunFailed(e)
+    except BaseException:
+      #a timeout or an interrupt, the reply would be read by the next request
+      self.stop()
+      raise
+    return parseString(reply)
+
+def selectRetry(fds, timeout=None):
+  '''the fds that are ready to read, retrying on EINTR'''
+  while True:
+    try:
+      if timeout is None:
+        return select.select(fds, [], [])[0]
+      return select.select(fds, [], [], timeout)[0]
+    except select.error, e:
+      if e.args[0] != errno.EINTR:
+        raise
+
+def executeServerRun(server, args, returnTags=['timing', 'accuracy', 'outputhash'], timeout=None):
+  '''like executeRun, but through a BenchmarkServer, which is restarted on timeout'''
+  try:
+    return parseResults(server.request(args, timeout), returnTags)
+  except TimingRunTimeout:
+    server.stop()
+    raise
+
+def executeRaceRun(_cmd, configa, configb, retries=3, timeout=None):
+  return waitRetry(lambda: startRaceRun(_cmd, configa, configb, timeout), retries)
+
 #parse timing results with a given time limit
 def executeTimingRun(prog, n, args=[], limit=None, returnTags='timing'):
   cmd = [ prog, "--n=%d"%n, "--time" ]
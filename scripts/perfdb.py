@@ -0,0 +1,255 @@
+#!/usr/bin/python
+'''
+store of pbbenchmark results across commits and hosts, with the per trial
+samples of every fixed and tuned measurement so that runs can be compared
+
+  perfdb.py runs                      list the recorded runs of this host
+  perfdb.py compare                   runs of the latest commit against those of the one before it
+  perfdb.py compare --base=1a2b3c     runs of the latest commit against all runs of another
+  perfdb.py import testdata/perflogs/*.log
+
+compare flags benchmarks that got slower by more than --threshold with a
+one-sided Welch's t-test at level --alpha, and exits with status 1 if any
+did; the test is on the mean of each run, as the trials of one run share a
+build, a machine state and, when tuned, a config, so it needs at least 2
+runs on each side (see --base and --new)
+'''
+import csv, json, math, os, socket, sqlite3, subprocess, sys, time
+import pbutil
+from scipy import stats
+
+PHASES = ['fixed', 'tuned']
+
+def gitRevision():
+  '''the commit the scripts are run from, '' if unknown'''
+  try:
+    p = subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                         stderr=open(os.devnull, 'w'), cwd=os.path.dirname(os.path.abspath(__file__)))
+    out = p.communicate()[0].strip()
+    if p.returncode == 0:
+      return out
+  except OSError:
+    pass
+  return ''
+
+class PerfDB:
+  '''
+  results of pbbenchmark runs, one row per (run, benchmark, phase), a run
+  being identified by its (timestamp, hostname)
+  '''
+  def __init__(self, path):
+    self.db = sqlite3.connect(path)
+    self.db.execute('''CREATE TABLE IF NOT EXISTS results (
+                         timestamp   REAL,
+                         hostname    TEXT,
+                         revision    TEXT,
+                         name        TEXT,
+                         cfg         TEXT,
+                         n           INTEGER,
+                         acc_target  REAL,
+                         phase       TEXT,
+                         mean        REAL,
+                         stddev      REAL,
+                         count       INTEGER,
+                         samples     TEXT,
+                         accuracy    REAL,
+                         tuning_time REAL,
+                         PRIMARY KEY (timestamp, hostname, name, cfg, phase))''')
+    self.db.commit()
+
+  def store(self, run, name, cfg, n, acc_target, phase, perf, acc, tuning_time=None):
+    '''
+    run is (timestamp, hostname, revision), perf and acc are results as
+    returned by pbutil.executeTimingRun
+    '''
+    samples = perf.get('samples')
+    if samples is not None:
+      samples = json.dumps(samples)
+    self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    tuple(run)+(name, cfg, n, acc_target, phase, perf['average'],
+                                perf.get('stddev'), perf.get('count', 1), samples,
+                                acc and acc.get('average'), tuning_time))
+    self.db.commit()
+
+  def runs(self, hostname):
+    '''(timestamp, revision, benchmarks) of every run on hostname, oldest first'''
+    return self.db.execute('''SELECT timestamp, revision, COUNT(DISTINCT cfg) FROM results
+                              WHERE hostname=? GROUP BY timestamp, revision
+                              ORDER BY timestamp''', (hostname,)).fetchall()
+
+  def trials(self, hostname, timestamps, phase):
+    '''maps (name, cfg, n) to a list of the trial times of phase in each of the given runs'''
+    rv = dict()
+    for ts in timestamps:
+      for name, cfg, n, mean, stddev, count, samples in self.db.execute(
+          '''SELECT name, cfg, n, mean, stddev, count, samples FROM results
+             WHERE hostname=? AND timestamp=? AND phase=?''', (hostname, ts, phase)):
+        rv.setdefault((name, cfg, n), []).append(trialsOf(mean, stddev, count, samples))
+    return rv
+
+def trialsOf(mean, stddev, count, samples):
+  '''
+  the trial times of a result, runs logged before samples were recorded
+  are stood in for by count trials with the same mean and stddev
+  '''
+  if samples is not None:
+    return json.loads(samples)
+  if not stddev or not count or count < 2:
+    return [mean]
+  d = stddev*math.sqrt(count/(count-1.0))
+  return [mean-d, mean+d]*(count/2) + [mean]*(count%2)
+
+def runMeans(runs):
+  '''the mean of the trials of each run'''
+  return map(lambda t: sum(t)/len(t), runs)
+
+def compareRuns(a, b):
+  '''
+  (base mean, new mean, p-value of a slowdown) of a benchmark given its trials
+  in each base and new run, the p-value is None with fewer than 2 runs a side
+  '''
+  ma = runMeans(a)
+  mb = runMeans(b)
+  return sum(ma)/len(ma), sum(mb)/len(mb), welch(ma, mb)
+
+def welch(a, b):
+  '''
+  one-sided p-value of mean(b) > mean(a) by Welch's t-test, None if either
+  side has fewer than 2 trials
+  '''
+  if len(a) < 2 or len(b) < 2:
+    return None
+  ma = sum(a)/len(a)
+  mb = sum(b)/len(b)
+  va = sum(map(lambda x: (x-ma)**2, a))/(len(a)-1)/len(a)
+  vb = sum(map(lambda x: (x-mb)**2, b))/(len(b)-1)/len(b)
+  if va+vb == 0:
+    if mb > ma:
+      return 0.0
+    return 1.0
+  t = (mb-ma)/math.sqrt(va+vb)
+  df = (va+vb)**2/(va**2/(len(a)-1)+vb**2/(len(b)-1))
+  return stats.t.sf(t, df)
+
+def importLog(db, path, revision=''):
+  '''add the rows of a pbbenchmark perflog, which only has means'''
+  cfg = os.path.basename(path).replace('.log', '.cfg')
+  rows = csv.reader(open(path), dialect=csv.excel_tab)
+  header = rows.next()
+  header[0] = header[0].lstrip('#')
+  count = 0
+  for row in rows:
+    r = dict(zip(header, row))
+    if 'fixed_perf' not in r:
+      continue #scores.log
+    run = (float(r['timestamp']), r['hostname'], revision)
+    for phase in PHASES:
+      db.store(run, r['name'], cfg, int(r['n']), float(r['acc_target']), phase,
+               {'average': float(r[phase+'_perf'])}, {'average': float(r[phase+'_acc'])},
+               float(r['tuning_time']) if phase == 'tuned' else None)
+    count += 1
+  return count
+
+def selectRuns(runs, spec):
+  '''timestamps of the runs whose revision starts with spec'''
+  return map(lambda r: r[0], filter(lambda r: r[1] and r[1].startswith(spec), runs))
+
+def lastRevision(runs):
+  '''timestamps of every run of the revision of the last run, or just of the last run if unknown'''
+  if runs[-1][1]:
+    return selectRuns(runs, runs[-1][1])
+  return [runs[-1][0]]
+
+def compare(db, options):
+  runs = db.runs(options.host)
+  if not runs:
+    print "no runs recorded for", options.host
+    return 1
+  if options.new:
+    new = selectRuns(runs, options.new)
+  else:
+    new = lastRevision(runs)
+  if options.base:
+    base = selectRuns(runs, options.base)
+  elif new:
+    older = filter(lambda r: r[0] < min(new) and r[0] not in new, runs)
+    base = older and lastRevision(older)
+  else:
+    base = []
+  base = filter(lambda ts: ts not in new, base)
+  if not new or not base:
+    print "nothing to compare, see: perfdb.py runs"
+    return 1
+
+  regressions = 0
+  for phase in options.phase.split(','):
+    a = db.trials(options.host, base, phase)
+    b = db.trials(options.host, new, phase)
+    print "%s: %d base runs, %d new runs" % (phase, len(base), len(new))
+    print "%-34s %12s %12s %8s %8s" % ('benchmark', 'base', 'new', 'change', 'p')
+    ratios = []
+    for k in sorted(set(a.keys()) & set(b.keys())):
+      ma, mb, p = compareRuns(a[k], b[k])
+      ratios.append(mb/ma)
+      flag = ''
+      if mb/ma-1.0 > options.threshold and p is not None and p < options.alpha:
+        flag = 'SLOWER'
+        regressions += 1
+      if p is None:
+        p = '-'
+      else:
+        p = '%.4f' % p
+      print "%-34s %12.6f %12.6f %+7.1f%% %8s %s" % ("%s %s" % (k[1].replace('.cfg', ''), k[2]),
+                                                   ma, mb, 100.0*(mb/ma-1.0), p, flag)
+    if ratios:
+      geo = math.exp(sum(map(math.log, ratios))/len(ratios))
+      print "%-34s %12s %12s %+7.1f%%" % ('geomean', '', '', 100.0*(geo-1.0))
+    print
+  if regressions:
+    print "%d significant slowdowns" % regressions
+    return 1
+  return 0
+
+def test_phases():
+  '''both phases are judged on the runs only, whatever their trials'''
+  base = [1.0, 1.1, 0.9]
+  new  = [1.2, 1.3, 1.1]
+  tight  = lambda means: map(lambda m: [m-0.001, m, m+0.001], means)
+  spread = lambda means: map(lambda m: [m-0.5, m, m+0.5], means)
+  fixed = compareRuns(tight(base), tight(new))
+  tuned = compareRuns(spread(base), spread(new))
+  assert abs(fixed[2]-tuned[2]) < 1e-12, (fixed, tuned)
+  assert fixed[0:2] == tuned[0:2]
+  assert compareRuns(tight(base[0:1]), tight(new))[2] is None
+
+def main():
+  from optparse import OptionParser
+  parser = OptionParser(usage="usage: perfdb.py [options] runs|compare|import LOGFILE...")
+  parser.add_option("--db", default="./testdata/perflogs/results.db")
+  parser.add_option("--host", default=socket.gethostname(), help="compare runs of this host")
+  parser.add_option("--base", help="revision (prefix) of the runs to compare against (default: the revision run before --new)")
+  parser.add_option("--new", help="revision (prefix) of the runs to compare (default: the revision of the latest run)")
+  parser.add_option("--phase", default="tuned", help="comma separated, fixed and/or tuned")
+  parser.add_option("--alpha", type="float", default=0.01, help="significance level of a slowdown")
+  parser.add_option("--threshold", type="float", default=0.02, help="smallest relative slowdown reported")
+  parser.add_option("--revision", default='', help="revision recorded for imported logs")
+  (options, args) = parser.parse_args()
+  if not args or args[0] not in ('runs', 'compare', 'import'):
+    parser.print_usage()
+    sys.exit(1)
+
+  args[1:] = map(os.path.abspath, args[1:])
+  pbutil.chdirToPetabricksRoot()
+  db = PerfDB(options.db)
+  if args[0] == 'runs':
+    for ts, revision, count in db.runs(options.host):
+      print "%s  %-40s %3d benchmarks" % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)),
+                                          revision or '?', count)
+  elif args[0] == 'import':
+    for path in args[1:]:
+      print path, importLog(db, path, options.revision), "rows"
+  else:
+    sys.exit(compare(db, options))
+
+if __name__ == "__main__":
+  main()
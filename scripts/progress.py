@@ -1,6 +1,7 @@
 #!/usr/bin/python
 import sys
 import math 
+import tracing
 
 barwidth=15
 barchars=" -=#"
@@ -19,10 +20,12 @@ class StatusWrapper:
       self.status(old)
   def status(self, m):
     if self.displayed!=m:
-      sys.__stderr__.write("\r"+m+"".ljust(len(self.displayed)-len(m)))
-      if m == "":
-        sys.__stderr__.write("\r")
-      self.displayed=m
+      tracing.wrap('redraw', 'progress', lambda: self.redraw(m))
+  def redraw(self, m):
+    sys.__stderr__.write("\r"+m+"".ljust(len(self.displayed)-len(m)))
+    if m == "":
+      sys.__stderr__.write("\r")
+    self.displayed=m
   def flush(self):
     self.fd.flush()
 
@@ -0,0 +1,293 @@
+#!/usr/bin/python
+'''
+re-run sgatuner or onlinelearning in process against the measurements
+recorded by earlier tuning runs of a benchmark, without running it
+
+  replay.py --tuner=onlinelearning --vary=os_method=ROC_AREA,WEIGHTED_SUM ~/tunerout/pbtunerun_Sort_*
+
+the runs must have kept their output dir (delete_output_dir=False), every
+trial is answered from their recorded measurements: the measurement cache,
+the stats of each candidate and the races in onlinecandidates.csv
+(mutatorperf.csv holds the same measurements as the latter), configs that
+were never measured get the measurements of the nearest recorded config and
+input sizes that were never tuned are scaled from the nearest one that was
+
+the convergence table is that of simtuner.py, the true time of a config is
+the mean of its recorded (or estimated) trials at the target input size
+'''
+import ast, csv, json, math, os, random, sys, time
+import measurementcache
+import pbutil
+import progress
+import storagedirs
+from candidatetester import choiceSiteBands, effectiveFingerprint
+from configtool import ConfigFile
+from mockbenchmark import MAXVAL
+from simtuner import Session, TUNERS, addOptions, label, parseSetting, report, \
+                     settingsFromOptions, simulate
+from traininginfo import TrainingInfo
+
+#a trial that hit its time limit is taken to run this many times the limit
+TIMEOUT_FACTOR = 2.0
+
+def recordedConfig(rundir):
+  '''the settings a run was tuned with, from its tunerconfig/config.py dump'''
+  rv = dict()
+  for line in open(os.path.join(rundir, 'tunerconfig', 'config.py')):
+    if not line.startswith('  ') or ' = ' not in line:
+      continue
+    k, v = line.strip().split(' = ', 1)
+    try:
+      rv[k] = ast.literal_eval(v)
+    except (ValueError, SyntaxError):
+      pass #settings whose repr isn't a literal are not needed here
+  return rv
+
+def readCsvStats(path):
+  '''rows of a storagedirs.openCsvStats file as dicts'''
+  rows = csv.reader(open(path), dialect=storagedirs.dialect)
+  header = rows.next()
+  header[0] = header[0].lstrip('#')
+  return map(lambda r: dict(zip(header, r)), rows)
+
+def initialConfig(rundir):
+  '''the config a run started from'''
+  p = os.path.join(rundir, 'candidate', '00000', 'config')
+  if os.path.isfile(p):
+    return p
+  p = os.path.join(rundir, 'stats', 'onlinecandidates.csv')
+  if os.path.isfile(p):
+    for row in readCsvStats(p):
+      return os.path.join(rundir, row['safe'])
+  raise Exception("no initial config recorded in "+rundir)
+
+def distance(a, b):
+  '''
+  how differently two (config, choice site bands) pairs behave at the input
+  size of the bands, 1 for each choice site whose rule at that size differs,
+  0.5 for each that differs below it, plus the log2 ratio of each numeric
+  tunable over 10 (at most 1 each)
+  '''
+  d = 0.0
+  for ba, bb in zip(a[1], b[1]):
+    if ba[-1:] != bb[-1:]:
+      d += 1.0
+    elif ba != bb:
+      d += 0.5
+  for k, x in a[0].items():
+    y = b[0].get(k, x)
+    if x != y and type(x) in (int, float) and type(y) in (int, float):
+      d += min(1.0, abs(math.log((1.0+abs(x))/(1.0+abs(y)), 2))/10.0)
+  return d
+
+class Recording:
+  '''
+  every measurement recorded by a set of tuning runs of one benchmark,
+  (time, accuracy) samples keyed by (effective fingerprint, input size)
+  '''
+  def __init__(self, rundirs, caches=[]):
+    self.settings = recordedConfig(rundirs[0])
+    self.main = self.settings['main']
+    self.rundir = rundirs[0]
+    tc = os.path.join(self.rundir, 'tunerconfig')
+    self.bin = os.path.join(tc, os.path.basename(pbutil.benchmarkToBin(self.settings['benchmark'])))
+    self.info = TrainingInfo(pbutil.benchmarkToInfo(self.bin)).transform(self.main)
+    self.samples = dict()
+    self.configs = dict() #n -> fingerprint -> a config with samples at n
+    self.estimates = dict()
+    self.exact = 0
+    self.estimated = 0
+    timeidx = self.settings['metrics'].index('timing')
+    accidx = self.settings['metrics'].index('accuracy')
+
+    cfgs = []
+    hashes = set()
+    for d in rundirs:
+      s = recordedConfig(d)
+      if s['main'] != self.main:
+        raise Exception("%s tuned %s, not %s" % (d, s['main'], self.main))
+      hashes.add(pbutil.fileHash(os.path.join(d, 'tunerconfig', os.path.basename(self.bin))))
+      cfgs.extend(map(lambda f: os.path.join(d, 'configs', f), os.listdir(os.path.join(d, 'configs'))))
+      cfgs.extend(map(lambda c: os.path.join(d, 'candidate', c, 'config'),
+                      os.listdir(os.path.join(d, 'candidate'))))
+    cfgs = map(ConfigFile, filter(os.path.isfile, cfgs))
+
+    sizes = set()
+    measured = set()
+    for path in caches:
+      progress.status("reading "+path)
+      db = measurementcache.MeasurementCache(path)
+      for binary, fp, n, results, timeout in db.db.execute(
+          'SELECT binary, config, n, results, timeout FROM trials'):
+        if binary.split()[0] not in hashes:
+          continue
+        if timeout is not None:
+          self.add(fp, n, [(TIMEOUT_FACTOR*timeout, None)])
+        elif results is not None and json.loads(results)[timeidx] is not None:
+          results = json.loads(results)
+          self.add(fp, n, zip(results[timeidx], results[accidx] or [None]*len(results[timeidx])))
+        else:
+          continue
+        sizes.add(n)
+        measured.add((fp, n))
+
+    for d in rundirs:
+      s = recordedConfig(d)
+      p = os.path.join(d, 'stats', 'onlinecandidates.csv')
+      if os.path.isfile(p):
+        for row in readCsvStats(p):
+          if not row['timeexp'] and row['timesafe']:
+            #the child was stopped by the race, at the parent's time times the race multiplier
+            row['timeexp'] = TIMEOUT_FACTOR*s['race_multiplier']*float(row['timesafe'])
+          for t, acc, cfg in ((row['timesafe'], row['accsafe'], row['safe']),
+                              (row['timeexp'], row['accexp'], row['experimental'])):
+            cfg = ConfigFile(os.path.join(d, cfg))
+            try:
+              t = float(t)
+            except ValueError:
+              continue
+            if t < MAXVAL:
+              self.add(effectiveFingerprint(cfg, self.info, s['n']), s['n'], [(t, parseAccuracy(acc))])
+              sizes.add(s['n'])
+      #candidate stats summarize trials already in the cache, unless it was off
+      for c in os.listdir(os.path.join(d, 'candidate')):
+        p = os.path.join(d, 'candidate', c, 'stats')
+        if not os.path.isfile(p):
+          continue
+        cfg = ConfigFile(os.path.join(d, 'candidate', c, 'config'))
+        for line in open(p):
+          if line.startswith('#'):
+            continue
+          v = map(float, filter(len, map(str.strip, line.split(','))))
+          n = int(v[0])
+          fp = effectiveFingerprint(cfg, self.info, n)
+          if v[1] >= 0 and (fp, n) not in measured:
+            self.add(fp, n, [(v[1], parseAccuracy(v[5]))])
+            sizes.add(n)
+
+    #trials that were stopped have no accuracy, give them that of the config's
+    #other trials, or the lowest recorded at their input size
+    lowest = dict()
+    for (fp, n), samples in self.samples.items():
+      for t, acc in samples:
+        if acc is not None:
+          lowest[n] = min(lowest.get(n, acc), acc)
+    for (fp, n), samples in self.samples.items():
+      known = filter(lambda x: x is not None, map(lambda x: x[1], samples))
+      if known:
+        acc = sum(known)/len(known)
+      else:
+        acc = lowest.get(n, 0.0)
+      self.samples[(fp, n)] = map(lambda x: (x[0], acc if x[1] is None else x[1]), samples)
+
+    #configs are indexed by the fingerprint the measurements are keyed by
+    for cfg in cfgs:
+      for n in sizes:
+        fp = effectiveFingerprint(cfg, self.info, n)
+        if (fp, n) in self.samples:
+          self.configs.setdefault(n, dict())[fp] = (cfg, self.bands(cfg, n))
+    self.sizes = sorted(self.configs.keys())
+    progress.clear()
+    if not self.sizes:
+      raise Exception("no measurements recorded in "+', '.join(rundirs))
+
+  def add(self, fp, n, samples):
+    self.samples.setdefault((fp, n), []).extend(samples)
+
+  def bands(self, cfg, n):
+    return map(lambda (transform, site): choiceSiteBands(cfg, transform, site, n),
+               self.info.choiceSites())
+
+  def lookup(self, cfg, n):
+    '''the recorded (time, accuracy) samples of cfg at n, or an estimate of them'''
+    samples, exact = self.estimate(cfg, n)
+    if exact:
+      self.exact += 1
+    else:
+      self.estimated += 1
+    return samples
+
+  def estimate(self, cfg, n):
+    fp = effectiveFingerprint(cfg, self.info, n)
+    if (fp, n) in self.samples:
+      return self.samples[(fp, n)], True
+    if n not in self.configs:
+      #scale from the nearest input size with recorded configs
+      m = min(self.sizes, key=lambda m: abs(math.log(float(n)/m)))
+      samples, exact = self.estimate(cfg, m)
+      return map(lambda (t, acc): (t*n/float(m), acc), samples), False
+    if (fp, n) not in self.estimates:
+      me = (cfg, self.bands(cfg, n))
+      near = min(self.configs[n].items(), key=lambda x: distance(me, x[1]))[0]
+      self.estimates[(fp, n)] = self.samples[(near, n)]
+    return self.estimates[(fp, n)], False
+
+  def mean(self, cfg, n):
+    samples = map(lambda x: x[0], self.estimate(cfg, n)[0])
+    return sum(samples)/len(samples)
+
+def parseAccuracy(v):
+  try:
+    v = float(v)
+  except ValueError:
+    return None
+  if v == -1:
+    return None
+  return v
+
+class Replay(Session):
+  '''a session answered by a Recording'''
+  def __init__(self, recording, n, budget=None):
+    self.recording = recording
+    Session.__init__(self, n,
+                     lambda cfg: recording.mean(cfg, n),
+                     lambda cfg, n: random.choice(recording.lookup(cfg, n)),
+                     budget)
+
+def main():
+  from optparse import OptionParser
+  parser = OptionParser(usage="usage: replay.py [options] RUNDIR...")
+  addOptions(parser)
+  parser.add_option("--repeat", type="int", default=5, help="runs of each setting, with different seeds")
+  parser.add_option("-n", type="int", help="input size to tune for (default: that of the first run)")
+  parser.add_option("--cache", action="append", default=[],
+                    help="measurement cache to read (default: that of each run, if kept)")
+  (options, args) = parser.parse_args()
+  if not args or options.tuner not in TUNERS:
+    parser.print_usage()
+    sys.exit(1)
+  fixed, settings = settingsFromOptions(options)
+
+  caches = options.cache
+  if not caches:
+    for d in args:
+      p = os.path.join(os.path.expanduser(recordedConfig(d)['output_dir']), 'measurements.db')
+      if os.path.isfile(p) and p not in caches:
+        caches.append(p)
+  recording = Recording(args, caches)
+  n = options.n
+  if n is None:
+    if options.tuner == 'onlinelearning':
+      n = recording.settings['n']
+    else:
+      n = recording.settings['max_input_size']
+  fixed = [('seed', initialConfig(args[0])),
+           ('min_input_size', recording.settings['min_input_size'])] + fixed
+
+  runs = dict()
+  start = time.time()
+  for r in xrange(options.repeat):
+    for s in settings:
+      progress.status("replaying %s, run %d of %d" % (label(s), r+1, options.repeat))
+      session = Replay(recording, n, options.time)
+      runs[(s, r)] = session, simulate(options.tuner, recording.bin, recording.main, session,
+                                       fixed+parseSetting(s), options.seed+r)
+  progress.clear()
+  report(runs, settings, options.repeat, options, time.time()-start)
+  total = recording.exact+recording.estimated
+  print "%d of %d trials (%.0f%%) answered from recorded measurements, %d recorded configs" % (
+        recording.exact, total, 100.0*recording.exact/max(1, total),
+        sum(map(len, recording.configs.values())))
+
+if __name__ == "__main__":
+  main()
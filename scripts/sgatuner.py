@@ -7,6 +7,7 @@ import storagedirs
 import candidatetester
 import shutil 
 import tunerconfig
+import tracing
 import configtool 
 import math
 import time
@@ -15,7 +16,7 @@ from candidatetester import Candidate, CandidateTester
 from mutators import MutateFailed
 from traininginfo import TrainingInfo
 from tunerconfig import config, option_callback
-from tunerwarnings import InitialProgramCrash,ExistingProgramCrash,NewProgramCrash,TargetNotMet
+from tunerwarnings import InitialProgramCrash,ExistingProgramCrash,NewProgramCrash,TargetNotMet,MemoryBudgetNotMet
 from storagedirs import timers
 import tunerwarnings
 from pprint import pprint
@@ -56,7 +57,9 @@ class Population:
                                                         'config_path',
                                                         'input_size',
                                                         'end_of_round',
-                                                        'round_number'])
+                                                        'round_number',
+                                                        'cpu_sec',
+                                                        'maxrss_kb'])
       self.candidateloglast = None
     self.starttime = time.time()
     self.onMembersChanged(True)
@@ -68,18 +71,20 @@ class Population:
     for z in xrange(count):
       tests.extend(self.members)
     random.shuffle(tests)
-    for m in tests:
+    def accept(m, testNumber):
       check_timeout()
-      if m not in self.failed and m.numTests(self.inputSize())<config.max_trials:
-        try:
-          self.testers[-1].test(m)
-        except candidatetester.CrashException, e:
-          if m.numTotalTests()==0:
-            warnings.warn(InitialProgramCrash(e))
-          else:
-            warnings.warn(ExistingProgramCrash(e))
-          self.failed.add(m)
-          self.members.remove(m)
+      return m not in self.failed and testNumber<config.max_trials
+    def onCrash(e):
+      m = e.candidate
+      if m in self.failed:
+        return
+      if m.numTotalTests()==0:
+        warnings.warn(InitialProgramCrash(e))
+      else:
+        warnings.warn(ExistingProgramCrash(e))
+      self.failed.add(m)
+      self.members.remove(m)
+    self.testers[-1].testMany(map(lambda m: (m, None), tests), accept, onCrash)
 
   def countMutators(self, mutatorFilter=lambda m: True):
     return sum(map(lambda x: len(filter(mutatorFilter, x.mutators)), self.members))
@@ -89,44 +94,71 @@ class Population:
     originalPop = list(self.members)
     totalMutators = self.countMutators(mutatorFilter)
     tries = float(totalMutators)*config.mutations_per_mutator
-    while tries>0:
-      progress.remaining(tries)
-      check_timeout()
-      tries-=1
-      if maxpopsize and len(self.members) >= maxpopsize:
-        break
-      if config.multimutation:
-        p=random.choice(self.members)
-      else:
-        p=random.choice(originalPop)
-      try:
-        c=p.cloneAndMutate(self.inputSize(), mutatorFilter=mutatorFilter)
-      except candidatetester.NoMutators:
-        if self.countMutators(mutatorFilter)>0:
-          continue
+    stop = False
+    while tries>0 and not stop:
+      #create up to one child per trial slot, then test them together
+      children = []
+      while tries>0 and len(children)<self.testers[-1].parallelism():
+        progress.remaining(tries)
+        check_timeout()
+        tries-=1
+        if maxpopsize and len(self.members)+len(children) >= maxpopsize:
+          stop = True
+          break
+        if config.multimutation:
+          p=random.choice(self.members)
         else:
-          return tries
+          p=random.choice(originalPop)
+        try:
+          c=p.cloneAndMutate(self.inputSize(), mutatorFilter=mutatorFilter)
+        except candidatetester.NoMutators:
+          if self.countMutators(mutatorFilter)>0:
+            continue
+          else:
+            stop = True
+            break
+
+        fp = c.fingerprint(self.inputSize())
+        if fp in self.triedConfigs and c.lastMutator:
+          c.lastMutator.result('fail')
+          continue
+        self.triedConfigs.add(fp)
+        children.append((p, c))
+      tracing.wrap('birth', 'testing', lambda: self.birth(children), {'children': len(children)})
+    if len(originalPop)<len(self.members):
+      logging.info("added "+', '.join(map(str,set(self.members)-set(originalPop))))
+    return tries
 
-      if c.config in self.triedConfigs and c.lastMutator:
+  def birth(self, children):
+    '''test a list of (parent, child) pairs and add the children that pass birthFilter'''
+    crashed = set()
+    def crash(c, e):
+      if c in crashed:
+        return
+      crashed.add(c)
+      c.rmfiles()
+      if c.lastMutator:
         c.lastMutator.result('fail')
+      warnings.warn(NewProgramCrash(e))
+    trials = []
+    for z in xrange(config.min_trials):
+      for p, c in children:
+        trials.append((c, p.reasonableLimit(self.inputSize())))
+    self.testers[-1].testMany(trials,
+                              lambda c, testNumber: c not in crashed and testNumber<config.min_trials,
+                              lambda e: crash(e.candidate, e))
+    for p, c in children:
+      if c in crashed:
         continue
-      self.triedConfigs.add(c.config)
       try:
-        self.testers[-1].testN(c, config.min_trials, limit=p.reasonableLimit(self.inputSize()))
-        if self.birthFilter(p,c):
+        if tracing.wrap('birthFilter', 'comparison', lambda: self.birthFilter(p,c)):
           self.members.append(c)
           self.onMembersChanged(False)
         else:
           c.rmfiles()
           self.notadded.append(c)
       except candidatetester.CrashException, e:
-        c.rmfiles()
-        if c.lastMutator:
-          c.lastMutator.result('fail')
-        warnings.warn(NewProgramCrash(e))
-    if len(originalPop)<len(self.members):
-      logging.info("added "+', '.join(map(str,set(self.members)-set(originalPop))))
-    return tries
+        crash(c, e)
 
   def guidedMutation(self):
     if config.print_log:
@@ -136,6 +168,16 @@ class Population:
   
   def birthFilter(self, parent, child):
     '''called when considering adding child to population'''
+    n = self.inputSize()
+    if child.withinMemoryBudget(n) != parent.withinMemoryBudget(n):
+      if child.withinMemoryBudget(n):
+        logging.debug("adding %s through memory budget"%str(child))
+        if child.lastMutator:
+          child.lastMutator.result('better')
+        return True
+      if child.lastMutator:
+        child.lastMutator.result('worse')
+      return False
     same=True
     for m in xrange(len(config.metrics)):
       if config.accuracy_metric_idx == m and not self.isVariableAccuracy():
@@ -171,6 +213,7 @@ class Population:
         testCount = sum(map(lambda x: x.testCount, self.testers))
         timeoutCount = sum(map(lambda x: x.timeoutCount, self.testers))
         crashCount = sum(map(lambda x: x.crashCount, self.testers))
+        tracing.begin('candidatelog', 'logging')
         self.candidatelog.writerow(("%.10f"%(time.time()-self.starttime),
                                     Candidate.nextCandidateId,
                                     testCount-timeoutCount-crashCount,
@@ -179,26 +222,24 @@ class Population:
                                     storagedirs.relpath(best.cfgfile()),
                                     self.inputSize(),
                                     endOfRound,
-                                    self.roundNumber))
+                                    self.roundNumber)+best.usageSummary(self.inputSize())[0:2])
+        tracing.end()
 
   def markBestN(self, population, n, metric = config.timing_metric_idx):
     '''shrink the population to popsize by removing low scoring candidates'''
-    fastCmp = self.testers[-1].comparer(metric, 0.00, 0)
-    fullCmp = self.testers[-1].comparer(metric, config.confidence_pct, config.max_trials)
-    # a rough partitioning based on fastCmp
-    population.sort(cmp=fastCmp)
-    membersfast=list(population[0:n])
-    membersslow=list(population[n:])
-    # fully order membersfast
-    membersfast.sort(cmp=fullCmp)
-    # check if any of membersslow should make the cut
-    cutoffAlg=membersfast[-1]
-    membersfast.extend(filter(lambda x: fullCmp(cutoffAlg,x)>0, membersslow))
-    # fully order membersfast again and store final population
-    membersfast.sort(cmp=fullCmp)
-    for m in membersfast[0:n]:
+    best = self.testers[-1].selectBestN(population, n, metric, config.confidence_pct, config.max_trials)
+    for m in best:
       m.keep=True
-    return membersfast[0:n]
+    return best
+
+  def budgetFilter(self, population):
+    '''the members of population within the memory budget, all of them if none are'''
+    t = filter(lambda x: x.withinMemoryBudget(self.inputSize()), population)
+    if len(t):
+      return t
+    if len(population):
+      warnings.warn(MemoryBudgetNotMet(self.inputSize(), config.memory_budget))
+    return population
 
   def isVariableAccuracy(self):
     return self.members[0].infoxml.isVariableAccuracy()
@@ -215,6 +256,7 @@ class Population:
 
     if config.accuracy_target is not None:
       t = filter(lambda x: x.hasAccuracy(self.inputSize(), config.accuracy_target), self.members)
+      t = self.budgetFilter(t)
       if len(t):
         best=self.markBestN(t, popsize)
         if isLast:
@@ -222,13 +264,14 @@ class Population:
           self.best = best[0]
           best[0].writestats(self.inputSize(), storagedirs.cur.results())
     elif isLast and len(self.members):
-      best=self.markBestN(self.members, popsize, config.timing_metric_idx)
+      best=self.markBestN(self.budgetFilter(self.members), popsize, config.timing_metric_idx)
       storagedirs.cur.markBest(best[0].cid, self.inputSize(), None)
       self.best = best[0]
       best[0].writestats(self.inputSize(), storagedirs.cur.results())
 
     for accLevel,accTarg in enumerate(self.accuracyTargets()):
       t = filter(lambda x: x.hasAccuracy(self.inputSize(), accTarg), self.members)
+      t = self.budgetFilter(t)
       if len(t):
         best=self.markBestN(t, popsize)
         if isLast:
@@ -239,8 +282,10 @@ class Population:
 
 
     if len(filter(lambda m: m.keep, self.members)) == 0:
-      self.markBestN(self.members, popsize, config.timing_metric_idx)
+      self.markBestN(self.budgetFilter(self.members), popsize, config.timing_metric_idx)
       self.markBestN(self.members, popsize, config.accuracy_metric_idx)
+      if config.memory_metric_idx is not None:
+        self.markBestN(self.members, popsize, config.memory_metric_idx)
 
     self.removed  += filter(lambda m: not m.keep, self.members)
     self.members  = filter(lambda m: m.keep, self.members)
@@ -262,11 +307,14 @@ class Population:
 
   def generation(self):
     progress.push()
+    tracing.begin('generation', 'tuner', {'round': self.roundNumber+1, 'n': self.inputSize()})
     try:
       self.roundNumber += 1
-      self.triedConfigs = set(map(lambda x: x.config, self.members))
+      self.triedConfigs = set(map(lambda x: x.fingerprint(self.inputSize()), self.members))
       self.removed=[]
       self.notadded=[]
+      if self.inputSize() < config.max_input_size:
+        self.testers[-1].prefetchNext(config.max_trials)
       self.test(config.max_trials)
       if len(self.members):
         for z in xrange(config.rounds_per_input_size):
@@ -274,8 +322,8 @@ class Population:
                            lambda: self.randomMutation(config.population_high_size))
           if not self.accuracyTargetsMet():
             self.guidedMutation()
-          self.prune(config.population_low_size, False)
-        self.prune(config.population_low_size, True)
+          tracing.wrap('prune', 'comparison', lambda: self.prune(config.population_low_size, False))
+        tracing.wrap('prune', 'comparison', lambda: self.prune(config.population_low_size, True))
 
         self.firstRound=False
       elif self.firstRound and len(self.failed) and config.min_input_size_nocrash>=self.inputSize():
@@ -305,15 +353,18 @@ class Population:
       else:
         warnings.warn(tunerwarnings.AlwaysCrashes())
     finally:
+      tracing.end()
       progress.pop()
 
   def nextInputSize(self):
+    #taken first so that the inputs it prefetched survive the cleanup
+    tester = self.testers[-1].nextTester()
     self.testers[-1].cleanup()
-    self.testers.append(self.testers[-1].nextTester())
+    self.testers.append(tester)
 
   def statsHeader(self):
     return '#pop','#removed','#notadded', 'pop_trials_avg','removed_trials_avg','notadded_trials_avg', \
-           '#total_trials', '#timeout_trials', '#crash_trials'
+           '#total_trials', '#timeout_trials', '#crash_trials', 'cpu_sec', 'maxrss_kb'
 
   def stats(self):
     def mean(x):
@@ -326,7 +377,8 @@ class Population:
     t3 = map(lambda m: m.numTests(self.inputSize()), self.notadded)
     
     return len(t1),len(t2),len(t3),mean(t1),mean(t2),mean(t3),\
-           self.testers[-1].testCount, self.testers[-1].timeoutCount, self.testers[-1].crashCount
+           self.testers[-1].testCount, self.testers[-1].timeoutCount, self.testers[-1].crashCount, \
+           self.testers[-1].cpuSec, self.testers[-1].maxRss
 
 def intorfloat(v):
   try:
@@ -402,18 +454,20 @@ def addMutators(candidate, info, acf, taf, ignore=None, weight=1.0):
   for sub in info.calls():
     addMutators(candidate, sub, acf, taf, ignore, weight/2.0)
 
-def init(benchmark, acf=createChoiceSiteMutators, taf=createTunableMutators):
+def init(benchmark, acf=createChoiceSiteMutators, taf=createTunableMutators, newTester=CandidateTester):
   if config.debug:
     logging.basicConfig(level=logging.DEBUG)
     config.pause_on_crash = True
   if not config.threads:
     config.threads = pbutil.cpuCount()
+  if config.memory_metric or config.memory_budget is not None:
+    tunerconfig.applypatch(tunerconfig.patch_memory)
   for k in filter(len, config.abort_on.split(',')):
     warnings.simplefilter('error', getattr(tunerwarnings,k))
   infoxml = TrainingInfo(pbutil.benchmarkToInfo(benchmark))
   if not config.main:
     config.main = mainname([pbutil.benchmarkToBin(benchmark)])
-  tester = CandidateTester(benchmark, config.min_input_size)
+  tester = newTester(benchmark, config.min_input_size)
   if config.seed is None:
     cfg = defaultConfigFile(pbutil.benchmarkToBin(tester.app))
   else:
@@ -429,10 +483,10 @@ def init(benchmark, acf=createChoiceSiteMutators, taf=createTunableMutators):
     storagedirs.cur.saveFile(pbutil.benchmarkToBin(benchmark))
   return candidate, tester
 
-def autotuneInner(benchmark):
+def autotuneInner(benchmark, newTester=CandidateTester):
   progress.push()
   config.benchmark = benchmark
-  candidate, tester = init(benchmark)
+  candidate, tester = init(benchmark, newTester=newTester)
   try:
     pop = Population(candidate, tester, None)
     
@@ -454,22 +508,24 @@ def autotuneInner(benchmark):
       while pop.inputSize() < config.max_input_size:
         progress.status("autotuning %s: input %d of %d" % (config.benchmark, pop.inputSize(), config.max_input_size))
         pop.generation()
-        stats.writerow((pop.roundNumber,
-                        pop.inputSize(),
-                        timers.total.total(),
-                        timers.total.lap(),
-                        timers.testing.lap(),
-                        timers.inputgen.lap())+pop.stats())
+        tracing.wrap('roundstats', 'logging',
+                     lambda: stats.writerow((pop.roundNumber,
+                                             pop.inputSize(),
+                                             timers.total.total(),
+                                             timers.total.lap(),
+                                             timers.testing.lap(),
+                                             timers.inputgen.lap())+pop.stats()))
         pop.nextInputSize()
         progress.remaining(config.max_input_size - pop.inputSize() + config.max_input_size*config.final_rounds)
       for z in xrange(config.final_rounds):
         pop.generation()
-        stats.writerow((pop.roundNumber,
-                        pop.inputSize(),
-                        timers.total.total(),
-                        timers.total.lap(),
-                        timers.testing.lap(),
-                        timers.inputgen.lap())+pop.stats())
+        tracing.wrap('roundstats', 'logging',
+                     lambda: stats.writerow((pop.roundNumber,
+                                             pop.inputSize(),
+                                             timers.total.total(),
+                                             timers.total.lap(),
+                                             timers.testing.lap(),
+                                             timers.inputgen.lap())+pop.stats()))
         progress.remaining((config.final_rounds - z)*config.max_input_size)
     except TrainingTimeout:
       pass
@@ -489,7 +545,7 @@ def autotuneInner(benchmark):
     if len(at):
       storagedirs.openCsvStats("timers", at.keys()).writerow(at.values())
     if tester:
-      tester.cleanup()
+      pop.testers[-1].teardown()
     progress.pop()
 
 def autotune(benchmark):
@@ -520,6 +576,15 @@ if __name__ == "__main__":
   parser.add_option("--debug",
                     action="store_true", dest="debug", default=False,
                     help="enable debugging options")
+  parser.add_option("--fresh",
+                    action="store_true", dest="fresh", default=False,
+                    help="don't reuse measurements from earlier runs")
+  parser.add_option("--memory_metric",
+                    action="store_true", dest="memory_metric", default=False,
+                    help="tune peak memory as an additional metric")
+  parser.add_option("--trace",
+                    action="store_true", dest="trace", default=False,
+                    help="write a timeline of the tuner to stats/trace.json")
   parser.add_option("-n", type="int", help="input size to train for")
   parser.add_option("--max_time",              type="float",  action="callback", callback=option_callback)
   parser.add_option("--rounds_per_input_size", type="int",    action="callback", callback=option_callback)
@@ -530,9 +595,12 @@ if __name__ == "__main__":
   parser.add_option("--min_input_size",        type="int",    action="callback", callback=option_callback)
   parser.add_option("--offset",                type="int",    action="callback", callback=option_callback)
   parser.add_option("--threads",               type="int",    action="callback", callback=option_callback)
+  parser.add_option("--parallel_trials",       type="int",    action="callback", callback=option_callback)
+  parser.add_option("--trials_per_run",        type="int",    action="callback", callback=option_callback)
   parser.add_option("--name",                  type="string", action="callback", callback=option_callback)
   parser.add_option("--abort_on",              type="string", action="callback", callback=option_callback)
   parser.add_option("--accuracy_target",       type="float",  action="callback", callback=option_callback)
+  parser.add_option("--memory_budget",         type="float",  action="callback", callback=option_callback)
   (options, args) = parser.parse_args()
   if len(args)!=1:
     parser.print_usage()
@@ -543,6 +611,12 @@ if __name__ == "__main__":
     tunerconfig.applypatch(tunerconfig.patch_debug)
   if options.n:
     tunerconfig.applypatch(tunerconfig.patch_n(options.n))
+  if options.fresh:
+    config.fresh_measurements = True
+  if options.trace:
+    config.trace_timeline = True
+  if options.memory_metric:
+    config.memory_metric = True
   config.benchmark=args[0]
   recompile()
   autotune(config.benchmark)
@@ -0,0 +1,343 @@
+#!/usr/bin/python
+'''
+run sgatuner or onlinelearning in process against a synthetic fitness
+landscape instead of a benchmark, for comparing search settings
+
+the landscape is a mockbenchmark cost model (random, or loaded from a
+.model file), trials are answered from it without running anything and
+only advance a simulated clock, so a tuning session that would take hours
+of benchmark runs takes seconds
+
+  simtuner.py --tuner=onlinelearning --vary=os_method=ROC_AREA,WEIGHTED_SUM,ROULETTE,ABS_ROC
+  simtuner.py --tuner=sgatuner --vary=population_high_size=5,10,20 --repeat=10
+
+each setting is run once per landscape, and its convergence curve (the true
+time at the target size of the best config it has tested, against simulated
+tuning time) is reported relative to the best config any setting found on
+that landscape, replay.py does the same against the measurements
+recorded by real tuning runs
+'''
+import csv, itertools, json, math, os, random, shutil, sys, tempfile, time, warnings
+import numpy
+import mockbenchmark
+import onlinelearning
+import pbutil
+import progress
+import sgatuner
+import storagedirs
+import tunerconfig
+import tunerwarnings
+from candidatetester import CandidateTester
+from configtool import ConfigFile
+from mockbenchmark import CostModel, MAXVAL
+from tunerconfig import config, OperatorSelectionMethod
+
+TUNERS = ['sgatuner', 'onlinelearning']
+
+def randomModel(rng, n, transforms=2, rules=4, tunables=2, levels=4, noise=0.05):
+  '''
+  a random landscape in the format of mockbenchmark.DEFAULT_MODEL, each
+  transform calling the next, with rules whose a*n**e is around a second at size n
+  and differ in their overheads, so the best rule changes with input size
+  '''
+  names = map(lambda i: 'Sim%d' % i, xrange(transforms))
+  model = {'main': names[0], 'levels': levels, 'noise': noise, 'sleep': 0.0, 'transforms': []}
+  for i, name in enumerate(names):
+    site = []
+    for r in xrange(rules):
+      e = rng.choice([1.0, 1.5, 2.0])
+      rule = {'e': e, 'a': rng.uniform(0.25, 2.0)/float(n)**e,
+              'fixed': rng.choice([0.0, 1.0e-6, 1.0e-4, 1.0e-2])}
+      if e == 1.0 and rng.random() < 0.5:
+        rule['recursive'] = 2
+        rule['a'] /= math.log(n, 2)
+      site.append(rule)
+    ts = []
+    for t in xrange(tunables):
+      hi = 2**rng.randint(8, 16)
+      ts.append({'name': '%s_tunable%d' % (name, t), 'type': 'user.tunable',
+                 'initial': 1, 'min': 1, 'max': hi,
+                 'best': int(2**rng.uniform(0, math.log(hi, 2))),
+                 'weight': rng.uniform(0.01, 0.1)})
+    model['transforms'].append({'name': name, 'sites': [site], 'tunables': ts,
+                                'calls': names[i+1:i+2]})
+  return model
+
+class Session:
+  '''
+  the simulated clock of one tuning session and its convergence curve,
+  (simulated sec, trials, true time) each time a better config is tested;
+  truth(cfg) is the time of cfg at the target input size n, and trial(cfg,
+  n) the (time, accuracy) of a single run of cfg at input size n
+  '''
+  def __init__(self, n, truth, trial, budget=None):
+    self.n = n
+    self.truth = truth
+    self.trial = trial
+    self.budget = budget
+    self.clock = 0.0
+    self.trials = 0
+    self.best = None
+    self.curve = []
+    self.configs = dict()
+
+  def config(self, path):
+    if path not in self.configs:
+      self.configs[path] = ConfigFile(path)
+    return self.configs[path]
+
+  def observe(self, cfg):
+    self.trials += 1
+    t = self.truth(cfg)
+    if self.best is None or t < self.best:
+      self.best = t
+      self.curve.append((self.clock, self.trials, t))
+
+  def spend(self, sec):
+    self.clock += sec
+    if self.budget is not None and self.clock > self.budget:
+      raise sgatuner.TrainingTimeout()
+
+class Landscape(Session):
+  '''a session answered by a mockbenchmark cost model'''
+  def __init__(self, model, n, budget=None):
+    self.model = CostModel(model)
+    self.main = model['main']
+    Session.__init__(self, n,
+                     lambda cfg: self.model.time(cfg, self.main, n),
+                     lambda cfg, n: (self.model.sample(cfg, self.main, n),
+                                     self.model.accuracy(cfg, self.main, n)),
+                     budget)
+
+class SimulatedTester(CandidateTester):
+  '''a CandidateTester whose trials are answered by a Session'''
+  def __init__(self, session, app, n, args=[]):
+    CandidateTester.__init__(self, app, n, args)
+    self.session = session
+
+  def withInputSize(self, n):
+    return SimulatedTester(self.session, self.app, n, self.args)
+
+  def execute(self, args, slot=None, limit=None):
+    opts = parseArgs(args)
+    cfg = self.session.config(opts['config'])
+    timing = []
+    accuracy = []
+    for z in xrange(int(opts.get('trials', 1))):
+      t, acc = self.session.trial(cfg, self.n)
+      self.session.observe(cfg)
+      if limit is not None and t > limit:
+        self.session.spend(limit)
+        raise pbutil.TimingRunTimeout()
+      self.session.spend(t)
+      timing.append(t)
+      accuracy.append(acc)
+    results = {'timing': {'average': sum(timing)/len(timing), 'samples': timing},
+               'accuracy': {'average': sum(accuracy)/len(accuracy), 'samples': accuracy}}
+    return map(results.get, config.metrics) + [None] #no rusage
+
+  def executeRace(self, cmd, cfgfilea, cfgfileb, limit=None):
+    opts = parseArgs(cmd)
+    racers = []
+    for path in (cfgfilea, cfgfileb):
+      if path == 'None':
+        racers.append((MAXVAL, -MAXVAL))
+      else:
+        cfg = self.session.config(path)
+        self.session.observe(cfg)
+        racers.append(self.session.trial(cfg, self.n))
+    #as in the runtime, the slower racer is stopped at a multiple of the faster one
+    t, acc = min(racers)
+    if acc >= float(opts.get('race-accuracy', -MAXVAL)):
+      cutoff = t*float(opts.get('race-multiplier', config.race_multiplier))
+    else:
+      cutoff = t*float(opts.get('race-multiplier-lowacc', config.race_multiplier_lowacc))
+    if limit is not None:
+      cutoff = min(cutoff, limit)
+    self.session.spend(min(max(map(lambda r: r[0], racers)), cutoff))
+    rv = []
+    for label, (t, acc) in enumerate(racers):
+      if t > cutoff:
+        t, acc = MAXVAL, -MAXVAL
+      rv.append({'label': label, 'timing': t, 'accuracy': acc, 'crashed': 0, 'hash': 0})
+    return rv
+
+def parseArgs(args):
+  '''benchmark --key=value arguments as a dict'''
+  return dict(map(lambda a: a[2:].split('=', 1), filter(lambda a: a.startswith('--') and '=' in a, args)))
+
+def parseValue(v):
+  if hasattr(OperatorSelectionMethod, v):
+    return getattr(OperatorSelectionMethod, v)
+  if v == 'None':
+    return None
+  try:
+    return sgatuner.intorfloat(v)
+  except ValueError:
+    return v
+
+def simulate(tuner, bin, main, session, settings, seed):
+  '''
+  tune bin with tuner and the (name, value) pairs in settings, answering
+  every trial from session, returns the true time of the config the tuner
+  settled on (None if it ran out of time first)
+  '''
+  tunerconfig.applypatch(tunerconfig.config_defaults)
+  if tuner == 'onlinelearning':
+    tunerconfig.applypatch(tunerconfig.patch_onlinelearning)
+  tunerconfig.applypatch(tunerconfig.patch_noninteractive)
+  config.use_iogen         = False
+  config.measurement_cache = False
+  config.input_library     = None
+  config.trace_timeline    = False
+  config.use_server        = False
+  config.parallel_trials   = 1
+  config.threads           = 1
+  config.main              = main
+  config.max_input_size    = session.n
+  config.max_time          = 2**30
+  for k, v in settings:
+    assert hasattr(config, k), "unknown setting "+k
+    setattr(config, k, v)
+  random.seed(seed)
+  numpy.random.seed(seed)
+  newTester = lambda app, n: SimulatedTester(session, app, n)
+  if tuner == 'sgatuner':
+    fn = lambda: sgatuner.autotuneInner(bin, newTester)
+  elif tuner == 'onlinelearning':
+    config.min_input_size = session.n
+    config.n              = session.n
+    fn = lambda: onlinelearning.onlinelearnInner(bin, newTester)
+  else:
+    raise Exception("unknown tuner "+tuner)
+  best = storagedirs.callWithLogDir(fn, config.output_dir, True)
+  if best is None:
+    return None
+  return session.truth(best.config)
+
+def bestAt(curve, sec):
+  '''true time of the best config tested by sec'''
+  rv = None
+  for clock, trials, t in curve:
+    if clock > sec:
+      break
+    rv = t
+  return rv
+
+def addOptions(parser):
+  '''options shared with replay.py'''
+  parser.add_option("--tuner", default="sgatuner", help="one of "+', '.join(TUNERS))
+  parser.add_option("--vary", action="append", default=[],
+                    help="NAME=V1,V2,.. compare each value of a config setting (repeatable)")
+  parser.add_option("--set", action="append", default=[],
+                    help="NAME=VALUE config setting for every run (repeatable)")
+  parser.add_option("--seed", type="int", default=0)
+  parser.add_option("--time", type="float", default=3600.0, help="simulated seconds of tuning per run")
+  parser.add_option("--points", type="int", default=8, help="columns of the convergence table")
+  parser.add_option("--output", help="write every convergence curve to this csv file")
+
+def settingsFromOptions(options):
+  '''
+  returns the --set pairs and the list of settings to compare, the product
+  of the --vary values, each a tuple of (name, value string) pairs
+  '''
+  warnings.simplefilter('ignore', tunerwarnings.TunerWarning)
+  warnings.simplefilter('error',  tunerwarnings.FatalTunerWarning)
+  fixed = map(lambda s: (s.split('=', 1)[0], parseValue(s.split('=', 1)[1])), options.set)
+  axes = []
+  for v in options.vary:
+    k, vals = v.split('=', 1)
+    axes.append(map(lambda x: (k, x), vals.split(',')))
+  return fixed, list(itertools.product(*axes))
+
+def parseSetting(s):
+  return map(lambda kv: (kv[0], parseValue(kv[1])), s)
+
+label = lambda s: ' '.join(map(lambda kv: '%s=%s' % kv, s)) or 'default'
+
+def report(runs, settings, repeat, options, wall):
+  '''
+  print the mean convergence curve of each setting, runs maps (setting,
+  repeat number) to (session, final true time), each repeat is scored against
+  the best config found in it by any setting
+  '''
+  ref = dict()
+  for (s, r), (session, final) in runs.items():
+    ref[r] = min(filter(lambda x: x is not None, [ref.get(r), session.best, final]))
+
+  if options.output:
+    out = csv.writer(open(options.output, 'w'))
+    out.writerow(['setting', 'repeat', 'sim_sec', 'trials', 'best_time', 'relative'])
+    for (s, r), (session, final) in sorted(runs.items()):
+      for clock, trials, t in session.curve:
+        out.writerow([label(s), r, clock, trials, t, t/ref[r]])
+
+  points = map(lambda i: options.time/2.0**i, reversed(xrange(options.points)))
+  width = max(map(len, map(label, settings))+[7])
+  print "mean slowdown vs. the best config found in each repeat, by simulated tuning time"
+  print "%-*s" % (width, 'setting') + ''.join(map(lambda p: "%10s" % ("%.4gs" % p), points)) \
+        + "%10s%10s" % ('final', 'trials')
+  for s in settings:
+    row = "%-*s" % (width, label(s))
+    for p in points:
+      v = filter(lambda x: x is not None,
+                 map(lambda r: bestAt(runs[(s, r)][0].curve, p), xrange(repeat)))
+      if len(v) < repeat:
+        row += "%10s" % '-'
+      else:
+        row += "%10.3f" % (sum(map(lambda r: v[r]/ref[r], xrange(repeat)))/repeat)
+    v = filter(lambda r: runs[(s, r)][1] is not None, xrange(repeat))
+    if v:
+      row += "%10.3f" % (sum(map(lambda r: runs[(s, r)][1]/ref[r], v))/len(v))
+    else:
+      row += "%10s" % '-'
+    row += "%10d" % (sum(map(lambda r: runs[(s, r)][0].trials, xrange(repeat)))/repeat)
+    print row
+  simulated = sum(map(lambda x: x[0].clock, runs.values()))
+  print "simulated %.4g sec of tuning in %.1f sec (%.3gx real time)" % (simulated, wall, simulated/wall)
+
+def main():
+  from optparse import OptionParser
+  parser = OptionParser(usage="usage: simtuner.py [options]")
+  addOptions(parser)
+  parser.add_option("--repeat", type="int", default=5, help="landscapes to run each setting on")
+  parser.add_option("-n", type="int", default=4096, help="input size to tune for")
+  parser.add_option("--model", help="tune this mockbenchmark .model file instead of random landscapes")
+  parser.add_option("--transforms", type="int", default=2, help="transforms in random landscapes")
+  parser.add_option("--rules", type="int", default=4, help="rules per choice site in random landscapes")
+  parser.add_option("--tunables", type="int", default=2, help="tunables per transform in random landscapes")
+  parser.add_option("--noise", type="float", default=0.05, help="stddev of the log of each trial's time")
+  (options, args) = parser.parse_args()
+  if args or options.tuner not in TUNERS:
+    parser.print_usage()
+    sys.exit(1)
+  fixed, settings = settingsFromOptions(options)
+
+  models = []
+  for r in xrange(options.repeat):
+    if options.model:
+      models.append(json.load(open(options.model)))
+      models[-1]['noise'] = options.noise
+    else:
+      models.append(randomModel(random.Random(options.seed+r), options.n,
+                                options.transforms, options.rules, options.tunables,
+                                noise=options.noise))
+
+  runs = dict()
+  start = time.time()
+  for r, model in enumerate(models):
+    d = tempfile.mkdtemp(prefix='simtuner_')
+    try:
+      bin = mockbenchmark.create(os.path.join(d, model['main']), model)
+      for s in settings:
+        progress.status("simulating %s on landscape %d of %d" % (label(s), r+1, len(models)))
+        session = Landscape(model, options.n, options.time)
+        runs[(s, r)] = session, simulate(options.tuner, bin, model['main'], session,
+                                         fixed+parseSetting(s), options.seed+r)
+    finally:
+      shutil.rmtree(d, True)
+  progress.clear()
+  report(runs, settings, len(models), options, time.time()-start)
+
+if __name__ == "__main__":
+  main()
@@ -145,8 +145,17 @@ if 'nocheck' in sys.argv[1:]:
   sys.argv[1:] = filter(lambda x: x!='nocheck', sys.argv[1:])
   CHECK = False
 
+#--logdir=DIR keeps the output of each test and a summary.json of their durations
+LOGDIR=None
+SUMMARY=None
+for a in filter(lambda x: x.startswith('--logdir='), sys.argv[1:]):
+  LOGDIR=os.path.abspath(a[len('--logdir='):])
+  SUMMARY=os.path.join(LOGDIR, "summary.json")
+  sys.argv.remove(a)
+
 t1=time.time()
-results,b=pbutil.loadAndCompileBenchmarks("./scripts/smoketest.tests", sys.argv[1:], testBenchmark, postfn=checkBenchmark)
+results,b=pbutil.loadAndCompileBenchmarks("./scripts/smoketest.tests", sys.argv[1:], testBenchmark, postfn=checkBenchmark,
+                                          logdir=LOGDIR, summary=SUMMARY)
 t2=time.time()
 
 
@@ -2,6 +2,8 @@ import os, shutil, tempfile, csv, time
 import subprocess
 import warnings
 import tunerconfig
+import inputlibrary
+import tracing
 from tunerconfig import config
 
 class dialect(csv.excel_tab):
@@ -81,6 +83,8 @@ class StorageDirsTemplate:
     self.bestd      = os.path.join(root, 'best')
     self.statsd     = os.path.join(root, 'stats')
     self.configd    = os.path.join(root, 'tunerconfig')
+    self.cfgstored  = os.path.join(root, 'configs')
+    self.storedcfgs = set()
     os.mkdir(self.candidated)
     os.mkdir(self.statsd)
     os.mkdir(self.bestd)
@@ -88,12 +92,26 @@ class StorageDirsTemplate:
     if config.mutatorlog:
       os.mkdir(self.mutatord)
     os.mkdir(self.configd)
+    os.mkdir(self.cfgstored)
   
+  def candidatedir(self, cid):
+    return os.path.join(self.candidated, "%05d" % cid)
+
   def candidate(self, cid):
-    d = os.path.join(self.candidated, "%05d" % cid)
+    d = self.candidatedir(cid)
     if not os.path.isdir(d):
       os.mkdir(d)
     return d
+
+  def configfile(self, cfg):
+    '''path of cfg in the content addressed config store, written on first use'''
+    fp = cfg.fingerprint()
+    path = os.path.join(self.cfgstored, fp+'.cfg')
+    if fp not in self.storedcfgs:
+      tracing.wrap('save config', 'config', lambda: cfg.save(path+'.tmp'))
+      os.rename(path+'.tmp', path)
+      self.storedcfgs.add(fp)
+    return path
   
   def mutatorlog(self, m):
     return os.path.join(self.mutatord, m.uniquename()+'.csv')
@@ -120,12 +138,26 @@ class StorageDirsTemplate:
     else:
       return os.path.join(self.statsd, "timing.csv")
   
-  def inputpfx(self, size, number):
+  def inputpfx(self, size, number, bin=None):
+    lib = inputlibrary.library()
+    if bin is not None and lib is not None:
+      return lib.pfx(bin, size, number)
     return os.path.join(self.inputd, "n%010d_i%02d_" % (size, number))
       
-  def clearInputs(self):
+  def clearInputs(self, size=None):
+    if size is None:
+      pfx = ''
+    else:
+      pfx = os.path.basename(self.inputpfx(size, 0))[:12]
     for f in os.listdir(self.inputd):
-      os.unlink(os.path.join(self.inputd, f))
+      if f.startswith(pfx) and os.path.isfile(os.path.join(self.inputd, f)):
+        os.unlink(os.path.join(self.inputd, f))
+
+  def inputBytes(self):
+    total = 0
+    for d, dirs, files in os.walk(self.inputd):
+      total += sum(map(lambda f: os.path.getsize(os.path.join(d, f)), files))
+    return total
 
   def openCsvStats(self, name, headerRow):
     w=csv.writer(open(os.path.join(self.statsd, name + ".csv"), "w"), dialect=dialect)
@@ -164,18 +196,25 @@ def callWithLogDir(fn, root, delete):
     print d
   global cur
   cur = StorageDirsTemplate(d)
+  if config.trace_timeline:
+    tracing.start(os.path.join(cur.statsd, 'trace.json'))
   try:
     return fn()
   finally:
+    tracing.stop()
     if delete:
       shutil.rmtree(d)
     else:
       print d
 
 candidate    = lambda cid:          cur.candidate(cid)
+candidatedir = lambda cid:          cur.candidatedir(cid)
+configfile   = lambda cfg:          cur.configfile(cfg)
 mutatorlog   = lambda m:            cur.mutatorlog(m)
-inputpfx     = lambda size, number: cur.inputpfx(size, number)
-clearInputs  = lambda :             cur.clearInputs()
+inputpfx     = lambda size, number, bin=None: cur.inputpfx(size, number, bin)
+clearInputs  = lambda size=None:    cur.clearInputs(size)
+inputBytes   = lambda :             cur.inputBytes()
+inputdir     = lambda :             cur.inputd
 openCsvStats = lambda name, header: cur.openCsvStats(name, header)
 saveFile     = lambda path:         cur.saveFile(path)
 relpath      = lambda d: _relpath(d, cur.root)
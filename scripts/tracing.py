@@ -0,0 +1,108 @@
+#!/usr/bin/python
+'''
+spans of tuner work written as a chrome://tracing timeline (trace event
+format), one complete event per span as it ends, nested per thread
+
+events are flushed at least every FLUSH_SEC, so the timeline of a session
+that was killed still loads, as chrome://tracing accepts a missing ]
+'''
+import json, os, threading, time
+
+FLUSH_SEC = 1.0
+
+class Tracer:
+  def __init__(self, path):
+    self.out = open(path, 'w')
+    self.out.write('[\n')
+    self.count = 0
+    self.pid = os.getpid()
+    self.t0 = time.time()
+    self.flushed = self.t0
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.threads = set()
+
+  def stack(self):
+    if not hasattr(self.local, 'stack'):
+      self.local.stack = []
+    return self.local.stack
+
+  def begin(self, name, cat, args):
+    self.stack().append((name, cat, args, time.time()))
+
+  def end(self):
+    if self.stack():
+      name, cat, args, start = self.stack().pop()
+      self.event(name, cat, args, start, time.time())
+
+  def wrap(self, name, cat, fn, args):
+    self.begin(name, cat, args)
+    try:
+      return fn()
+    finally:
+      self.end()
+
+  def event(self, name, cat, args, start, stop):
+    thread = threading.currentThread()
+    e = {'name': name, 'cat': cat, 'ph': 'X', 'pid': self.pid, 'tid': thread.ident,
+         'ts': (start-self.t0)*1e6, 'dur': (stop-start)*1e6}
+    if args:
+      e['args'] = args
+    self.lock.acquire()
+    try:
+      if self.out is None:
+        return
+      if thread.ident not in self.threads:
+        self.threads.add(thread.ident)
+        self.write({'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                    'tid': thread.ident, 'args': {'name': thread.getName()}})
+      self.write(e)
+      #the outermost span of a thread may be the last for a long time
+      if stop-self.flushed >= FLUSH_SEC or not self.stack():
+        self.out.flush()
+        self.flushed = stop
+    finally:
+      self.lock.release()
+
+  def write(self, e):
+    if self.count:
+      self.out.write(',\n')
+    self.out.write(json.dumps(e, default=str))
+    self.count += 1
+
+  def close(self):
+    while self.stack():
+      self.end()
+    self.lock.acquire()
+    try:
+      self.out.write('\n]\n')
+      self.out.close()
+      self.out = None
+    finally:
+      self.lock.release()
+
+class NullTracer:
+  def begin(self, name, cat, args):
+    pass
+  def end(self):
+    pass
+  def wrap(self, name, cat, fn, args):
+    return fn()
+  def close(self):
+    pass
+
+_tracer = NullTracer()
+
+def start(path):
+  global _tracer
+  _tracer = Tracer(path)
+
+def stop():
+  global _tracer
+  t, _tracer = _tracer, NullTracer()
+  t.close()
+
+begin = lambda name, cat='tuner', args=None: _tracer.begin(name, cat, args)
+end   = lambda : _tracer.end()
+wrap  = lambda name, cat, fn, args=None: _tracer.wrap(name, cat, fn, args)
+
@@ -85,6 +85,14 @@ class TrainingInfo:
       rv.add(str(t.getAttribute('callee')))
     return map(self.transform, rv)
 
+  def choiceSites(self):
+    '''(transform name, algchoice number) for every choice site in the program'''
+    rv=set()
+    for t in self.transforms.values():
+      for ac in t.algchoices():
+        rv.add((t.name(), ac['number']))
+    return sorted(rv)
+
 
   
 
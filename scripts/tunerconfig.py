@@ -26,6 +26,14 @@ class config_defaults:
   limit_conf_pct        = 0.95
   '''multiply generated time limits by a factor'''
   limit_multiplier      = 6.0
+  '''number of trials to run at once, each on its own slice of the cores'''
+  parallel_trials       = 1
+  '''pin concurrent trials to their slice of the cores (requires taskset)'''
+  parallel_affinity     = True
+  '''keep one --serve benchmark process per trial slot instead of one process per trial'''
+  use_server            = False
+  '''seconds past a trial's time limit before the tuner kills it itself'''
+  kill_grace_sec        = 30.0
   '''offset added to input sizes'''
   offset                = 0
 
@@ -51,6 +59,8 @@ class config_defaults:
   print_log              = True
   candidatelog           = True
   mutatorlog             = True
+  '''write a chrome://tracing timeline of the tuner's phases to stats/trace.json'''
+  trace_timeline         = False
   pause_on_crash         = False
   '''confidence intervals when displaying numbers'''
   display_confidence    = 0.90
@@ -60,8 +70,32 @@ class config_defaults:
   use_iogen             = True
   '''delete iogen inputs at the end of each round'''
   cleanup_inputs        = True
+  '''iogen inputs generated at once, in the background ahead of the trials using them'''
+  inputgen_threads      = 2
+  '''most inputs created by a single --iogen-create process'''
+  inputgen_batch        = 4
+  '''generate inputs for the next input size during the current round'''
+  prefetch_inputs       = True
+  '''stop prefetching once the input directory holds this many megabytes'''
+  prefetch_inputs_mb    = 1024
+  '''keep iogen inputs here between sessions, relative to output_dir (None to disable)'''
+  input_library         = "inputs"
+  '''delete the least recently used library inputs beyond this many megabytes'''
+  input_library_mb      = 8192
   '''check output hash against peers, requires use_iogen'''
   check                 = False
+  '''trials run by each benchmark process (--trials), each one is a separate sample'''
+  trials_per_run        = 1
+  '''reuse trial results from earlier sessions, stored in output_dir (None: only if iogen inputs are kept in input_library)'''
+  measurement_cache      = None
+  '''maximum trials kept in the measurement cache'''
+  measurement_cache_rows = 1000000
+  '''record new trials in the measurement cache, but don't read from it'''
+  fresh_measurements     = False
+  '''tune peak resident memory (MB, from the run's rusage) as an additional metric'''
+  memory_metric          = False
+  '''only keep candidates whose peak resident memory is below this many MB'''
+  memory_budget          = None
 
   name=''
   score_decay = 0.9
@@ -102,6 +136,7 @@ class config_defaults:
   metric_orders         = [1, -1] #1 = minimize, -1 = maximize
   timing_metric_idx     = 0
   accuracy_metric_idx   = 1
+  memory_metric_idx     = None #set by patch_memory
 
   #mutators config, dont change
   fmt_cutoff     = "%s_%d_lvl%d_cutoff"
@@ -183,13 +218,22 @@ class patch_noninteractive:
   candidatelog             = False
   mutatorlog               = False
   output_dir               = "/tmp"
+  input_library            = None
 
 class patch_regression(patch_noninteractive, patch_check):
   pass
 
 
 class patch_pbbenchmark(patch_noninteractive):
-  pass
+  #training time is part of the score
+  measurement_cache = False
+  input_library     = None
+
+class patch_memory:
+  '''add peak resident memory as a third metric, for memory_metric or memory_budget'''
+  metrics               = ['timing', 'accuracy', 'memory']
+  metric_orders         = [1, -1, 1]
+  memory_metric_idx     = 2
 
 class patch_reset:
   accuracy_target = None
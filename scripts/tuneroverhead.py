@@ -0,0 +1,113 @@
+#!/usr/bin/python
+'''
+measure the tuners' own overhead against a mockbenchmark, so no real
+benchmark is compiled or run: each tuner runs in its own process and is
+scored by its cpu time per trial, trials per second and peak memory
+'''
+import os, resource, shutil, subprocess, sys, tempfile, time
+import mockbenchmark
+
+TUNERS = ['sgatuner', 'onlinelearning', 'oldtuner']
+
+def runTuner(tuner, bin, options):
+  '''tune bin with tuner in this process'''
+  import tunerconfig
+  from tunerconfig import config
+  if tuner == 'sgatuner':
+    import sgatuner
+    tunerconfig.applypatch(tunerconfig.patch_noninteractive)
+    config.max_time           = options.time
+    config.min_input_size     = options.min
+    config.max_input_size     = options.n
+    config.measurement_cache  = False
+    config.input_library      = None
+    config.benchmark          = bin
+    sgatuner.autotune(bin)
+  elif tuner == 'onlinelearning':
+    import onlinelearning
+    tunerconfig.applypatch(tunerconfig.patch_onlinelearning)
+    tunerconfig.applypatch(tunerconfig.patch_noninteractive)
+    config.max_time           = None
+    config.max_gen            = options.generations
+    config.n                  = options.n
+    config.min_input_size     = options.n
+    config.max_input_size     = options.n
+    config.measurement_cache  = False
+    config.benchmark          = bin
+    onlinelearning.onlinelearn(bin)
+  elif tuner == 'oldtuner':
+    import oldtuner
+    #oldtuner parses sys.argv itself
+    sys.argv = ['oldtuner.py', '--nocompile', '-n', str(options.n), bin]
+    oldtuner.main(sys.argv)
+  else:
+    raise Exception("unknown tuner "+tuner)
+
+def measure(tuner, options):
+  '''
+  run tuner against a fresh mockbenchmark in a subprocess
+  returns (trials, wall sec, tuner cpu sec, tuner peak rss kB)
+  '''
+  d = tempfile.mkdtemp(prefix='tuneroverhead_')
+  try:
+    bin = mockbenchmark.create(os.path.join(d, 'MockSort'))
+    env = dict(os.environ)
+    env['MOCKBENCHMARK_LOG'] = os.path.join(d, 'trials.log')
+    cmd = [sys.executable, os.path.abspath(__file__), '--run='+tuner,
+           '--result='+os.path.join(d, 'result'),
+           '--time=%f'%options.time, '--generations=%d'%options.generations,
+           '-n', str(options.n), '--min=%d'%options.min, bin]
+    if options.verbose:
+      out = None
+    else:
+      out = open(os.devnull, 'w')
+    rv = subprocess.call(cmd, env=env, stdout=out, stderr=out)
+    if rv != 0 or not os.path.isfile(os.path.join(d, 'result')):
+      raise Exception("%s failed (exit code %d)" % (tuner, rv))
+    wall, cpu, maxrss = map(float, open(os.path.join(d, 'result')).read().split())
+    trials = 0
+    if os.path.isfile(env['MOCKBENCHMARK_LOG']):
+      trials = sum(map(int, open(env['MOCKBENCHMARK_LOG'])))
+    return trials, wall, cpu, maxrss
+  finally:
+    shutil.rmtree(d, True)
+
+def main():
+  from optparse import OptionParser
+  parser = OptionParser(usage="usage: tuneroverhead.py [options]")
+  parser.add_option("--tuners", default=','.join(TUNERS),
+                    help="comma separated tuners to measure")
+  parser.add_option("--time", type="float", default=60.0,
+                    help="wall clock seconds sgatuner is given")
+  parser.add_option("--generations", type="int", default=200,
+                    help="generations onlinelearning is given")
+  parser.add_option("-n", type="int", default=4096, help="input size to tune for")
+  parser.add_option("--min", type="int", default=64, help="first input size of sgatuner")
+  parser.add_option("--verbose", action="store_true", default=False,
+                    help="show the tuners' output")
+  parser.add_option("--run", help="(internal) tune in this process with the given tuner")
+  parser.add_option("--result", help="(internal) where --run writes its measurements")
+  (options, args) = parser.parse_args()
+
+  if options.run:
+    start = time.time()
+    runTuner(options.run, args[0], options)
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    fd = open(options.result, 'w')
+    fd.write("%f %f %d\n" % (time.time()-start, ru.ru_utime+ru.ru_stime, ru.ru_maxrss))
+    fd.close()
+    return
+
+  print "%-16s %8s %11s %17s %15s" % ('tuner', 'trials', 'trials/sec', 'cpu/trial (ms)', 'peak rss (MB)')
+  for tuner in filter(len, options.tuners.split(',')):
+    try:
+      trials, wall, cpu, maxrss = measure(tuner, options)
+    except Exception, e:
+      print "%-16s %s" % (tuner, e)
+      continue
+    print "%-16s %8d %11.2f %17.3f %15.1f" % (tuner, trials, trials/wall,
+                                              1000.0*cpu/max(1, trials), maxrss/1024.0)
+
+if __name__ == "__main__":
+  main()
+
@@ -67,6 +67,14 @@ class TargetNotMet(TunerWarning):
   def __str__(self):
     return "accuracy %.2f not met for input size %d"%(self.acc, self.n)
 
+class MemoryBudgetNotMet(TunerWarning):
+  '''no candidate stayed under the memory budget'''
+  def __init__(self, n, budget):
+    self.n = n
+    self.budget = budget
+  def __str__(self):
+    return "memory budget %.1f MB not met for input size %d"%(self.budget, self.n)
+
 class ProgramTimeout(IgnoredTunerWarning):
   '''an accuracy target was not attainable through search'''
   def __init__(self, candidate, n, timeout):
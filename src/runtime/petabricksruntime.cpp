@@ -39,6 +39,7 @@
 #include <algorithm>
 #include <limits>
 #include <iostream>
+#include <sstream>
 #include <math.h>
 
 #include <sys/time.h>
@@ -97,6 +98,7 @@ static std::string ATLOG;
 static jalib::Hash theLastHash;
 static std::string IOGEN_PFX="tmp_";
 static int IOGEN_N=-1;
+static int IOGEN_COUNT=-1;
 static double RACE_MULTIPLIER=1;
 static double RACE_MULTIPLIER_LOWACC=1;
 static double RACE_ACCURACY_TARGET=jalib::minval<double>();
@@ -149,6 +151,7 @@ static enum {
   MODE_GRAPH_THREADS,
   MODE_GRAPH_TEMPLATE,
   MODE_RACE_CONFIGS,
+  MODE_SERVE,
   MODE_AUTOTUNE_PARAM,
   MODE_ABORT,
   MODE_HELP
@@ -197,6 +200,33 @@ namespace{//file local
       << " median=\""   << median              << '"'
       << " variance=\"" << variance            << '"'
       << " stddev=\""   << sqrt(variance)      << '"';
+
+    //individual trials, in the order they ran
+    o << " samples=\"";
+    for(size_t i=0; i<_data.size(); ++i)
+      o << (i>0 ? " " : "") << _data[i];
+    o << '"';
+  }
+
+  void _dumpResults(std::ostream& o, bool always){
+    bool acc = !theAccuracies.empty();
+    bool timing = !theTimings.empty();
+    if(!(acc || timing || HASH || always)) return;
+    o << "<root>\n  <stats>\n";
+    if(acc){
+      o << "    <accuracy";
+      _dumpStats(o, theAccuracies);
+      o << " />\n";
+    }
+    if(timing){
+      o << "    <timing";
+      _dumpStats(o, theTimings);
+      o << " />\n";
+    }
+    if(HASH){
+      o << "    <outputhash value=\"0x" << theLastHash << "\" />\n";
+    }
+    o << "  </stats>\n</root>\n" << std::flush;
   }
 }
 
@@ -282,9 +312,12 @@ petabricks::PetabricksRuntime::PetabricksRuntime(int argc, const char** argv, Ma
     JASSERT(jalib::Filesystem::FileExists(CONFIG_FILENAME));
     JASSERT(jalib::Filesystem::FileExists(CONFIG_FILENAME_ALT) || CONFIG_FILENAME_ALT=="None");
     MODE=MODE_RACE_CONFIGS;
+  }else if(args.param("serve").help("answer timing requests read from stdin until EOF")){
+    MODE=MODE_SERVE;
   }
   
   args.param("iogen-n", IOGEN_N);
+  args.param("iogen-count", IOGEN_COUNT).help("with --iogen-create, generate this many input sets with the prefix suffixed by 0..count-1");
   
   //flags that cause aborts
   if(args.param("reset").help("reset the config file to the default state and exit")){
@@ -360,6 +393,7 @@ petabricks::PetabricksRuntime::PetabricksRuntime(int argc, const char** argv, Ma
     case MODE_GRAPH_TEMPLATE:
     case MODE_AUTOTUNE_PARAM:
     case MODE_IOGEN_RUN:
+    case MODE_SERVE:
       if(ISOLATION)
         break;
       //fall through
@@ -422,7 +456,13 @@ int petabricks::PetabricksRuntime::runMain(){
       runNormal();
       break;
     case MODE_IOGEN_CREATE:
-      iogenCreate(iogenFiles(IOGEN_PFX));
+      if(IOGEN_COUNT<0){
+        iogenCreate(iogenFiles(IOGEN_PFX));
+      }else{
+        //sequential, generators are singletons so sets can't be built concurrently
+        for(int i=0; i<IOGEN_COUNT; ++i)
+          iogenCreate(iogenFiles(IOGEN_PFX+jalib::XToString(i)));
+      }
       break;
     case MODE_IOGEN_RUN:
       iogenRun(iogenFiles(IOGEN_PFX));
@@ -431,6 +471,10 @@ int petabricks::PetabricksRuntime::runMain(){
       raceConfigs(_randSize);
       return _rv;
       break;
+    case MODE_SERVE:
+      runServeMode();
+      return _rv;
+      break;
     case MODE_RUN_RANDOM:
 #ifdef HAVE_OPENCL
       if( 0 != ( err = OpenCLUtil::init( ) ) )
@@ -472,23 +516,7 @@ int petabricks::PetabricksRuntime::runMain(){
     _main->writeOutputs(tmp);
   }
 
-  ACCURACY=!theAccuracies.empty();
-  DUMPTIMING=!theTimings.empty();
-  if(ACCURACY || DUMPTIMING || HASH) std::cout << "<root>\n  <stats>\n";
-  if(ACCURACY){
-    std::cout << "    <accuracy";
-    _dumpStats(std::cout, theAccuracies);
-    std::cout << " />\n";
-  }
-  if(DUMPTIMING){
-    std::cout << "    <timing";
-    _dumpStats(std::cout, theTimings);
-    std::cout << " />\n";
-  }
-  if(HASH){
-    std::cout << "    <outputhash value=\"0x" << theLastHash << "\" />\n";
-  }
-  if(ACCURACY || DUMPTIMING || HASH) std::cout << "  </stats>\n</root>\n" << std::flush;
+  _dumpResults(std::cout, false);
 
   return _rv;
 }
@@ -539,7 +567,72 @@ void petabricks::PetabricksRuntime::iogenRun(const std::vector<std::string>& fil
   TestIsolation* ti;
   if(ISOLATION) ti = &sti;
   else          ti = &dti;
-  computeWrapper(*ti, -1, -1, &files);
+  JASSERT(GRAPH_TRIALS>=1).Text("invalid --trials");
+  //every trial reloads the same inputs, the tuner counts each one as a sample
+  for(int i=0; i<GRAPH_TRIALS; ++i){
+    if(computeWrapper(*ti, -1, -1, &files) >= jalib::maxval<double>()/2.0)
+      break;
+  }
+}
+
+void petabricks::PetabricksRuntime::runServeMode(){
+  TunableManager& tm = TunableManager::instance();
+  std::string loaded;
+  std::string line;
+  //each request is one line of key=value pairs, for example:
+  //  config=FILE iogen-run=PFX iogen-n=N max-sec=SEC trials=K
+  //the reply is the same xml printed by --time/--accuracy in normal runs
+  while(std::getline(std::cin, line)){
+    std::string cfg = CONFIG_FILENAME;
+    std::string pfx;
+    int n = -1;
+    int trials = 1;
+    double maxsec = jalib::maxval<double>();
+    std::istringstream req(line);
+    std::string tok;
+    while(req >> tok){
+      size_t eq = tok.find('=');
+      JASSERT(eq!=std::string::npos)(tok).Text("malformed --serve request");
+      std::string k = tok.substr(0, eq);
+      std::string v = tok.substr(eq+1);
+      if(k=="config")         cfg    = v;
+      else if(k=="iogen-run") pfx    = v;
+      else if(k=="iogen-n")   n      = jalib::StringToX<int>(v);
+      else if(k=="n")         n      = jalib::StringToX<int>(v);
+      else if(k=="max-sec")   maxsec = jalib::StringToX<double>(v);
+      else if(k=="trials")    trials = jalib::StringToX<int>(v);
+      else JASSERT(false)(k).Text("unknown --serve request key");
+    }
+    if(tm.size()>0 && jalib::Filesystem::FileExists(cfg))
+      tm.load(cfg);
+    CONFIG_FILENAME = cfg;
+
+    std::vector<std::string> files;
+    if(!pfx.empty()){
+      //inputs are loaded once here and shared copy-on-write with each test
+      std::string key = pfx + " " + jalib::XToString(n);
+      if(key != loaded){
+        IOGEN_N = n;
+        files = iogenFiles(pfx);
+        loadTestInput(-1, &files);
+        loaded = key;
+      }
+      n = -1;
+    }else{
+      JASSERT(n>0)(line).Text("n=... or iogen-run=... required");
+      setSize(n);
+      loaded = "";
+    }
+
+    theTimings.clear();
+    theAccuracies.clear();
+    for(int i=0; i<trials; ++i){
+      SubprocessTestIsolation ti(maxsec);
+      if(computeWrapper(ti, n) >= jalib::maxval<double>()/2.0)
+        break;
+    }
+    _dumpResults(std::cout, true);
+  }
 }
 
 void petabricks::PetabricksRuntime::runGraphMode(){
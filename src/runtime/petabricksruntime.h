@@ -149,6 +149,8 @@ public:
 
   void runNormal();
 
+  void runServeMode();
+
   void runGraphMode();
   void runGraphTemplate();
 